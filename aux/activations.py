@@ -1,13 +1,20 @@
 """
 activations.py, SciML-SCD, RAL
 
-Extracts the activations from the specified layer, scales 
-these activations or apply tSNE. The output is then used 
-as latent index points by the Gaussian process. 
+Extracts the activations from the specified layer, scales
+these activations or apply tSNE. The output is then used
+as latent index points by the Gaussian process.
+
+All the approaches share a single latent pipeline built from
+generator stages over batches of structures: extraction of the
+activations, optional scaling or dimension reduction and finally
+splitting of the latent points by index. Intermediate arrays are
+memory-mapped to file in the results directory.
 """
-import sys 
+import json
+import sys
 import logging
-import os 
+import os
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
                     format="%(levelname)s:gp-net: %(message)s")
 
@@ -15,82 +22,291 @@ import numpy as np
 np.random.seed(1)
 import matplotlib
 matplotlib.use("agg")
-import matplotlib.pyplot as plt 
+import matplotlib.pyplot as plt
 
 from tensorflow.compat.v2.keras import backend as K
 from megnet.models import MEGNetModel
 
+from aux.reduction import reduce_dimensions, landmark_reduce
+from aux.instrument import timed
+from aux.dataset import save_splits, run_fingerprint
+from aux import writer
+from aux.results import save_results
+
+
+def extract(model_file, layer, activations_input_full, batch=1000, max_atoms=0):
+    """
+    extract(model_file, layer, activations_input_full, batch, max_atoms)
+
+    Generator stage which extracts the activations of a layer of
+    a fitted MEGNet model.
+
+    Inputs:
+    model_file-                Fitted MEGNet model file.
+    layer-                     Layer of a MEGNet model of interest.
+    activations_input_full-    Input to the specific layer for
+                               extraction of activations for the full dataset.
+    batch-                     Number of structures per yielded batch.
+    max_atoms-                 Maximum total number of atoms of the graphs
+                               passed through the model at once. The
+                               graphs are grouped by size and the layer
+                               must have one output per structure, e.g.
+                               readout_0. 0 => one structure at a time.
+
+    Outputs:
+    1-                         Batches of activations.
+    """
+    model_pretrained = MEGNetModel.from_file(model_file)
+
+    logging.info("Extracting activations from the %s layer ..." %layer)
+    net_layer = [i.output for i in model_pretrained.layers if i.name.startswith("%s" %layer)]
+    compute_graph = K.function([model_pretrained.input], [net_layer])
+    if max_atoms > 0:
+        from train.input_pipeline import batch_indices, assemble
+
+        print("Extracting graphs of up to %s atoms at once ..." %max_atoms)
+    for start in range(0, len(activations_input_full), batch):
+        inputs = activations_input_full[start:start+batch]
+        if max_atoms <= 0:
+            yield np.array([np.squeeze(compute_graph(full)) for full in inputs])
+            continue
+        output = None
+        for idx in batch_indices([g[0].shape[1] for g in inputs], batch, max_atoms):
+            activations = np.asarray(compute_graph(assemble([inputs[i] for i in idx]))[0])
+            if activations.shape[:3] != (1, 1, len(idx)):
+                logging.error("Layer %s does not have one output per structure. Extract without -maxatoms!" %layer)
+                sys.exit()
+            if output is None:
+                output = np.empty((len(inputs),) + activations.shape[3:], dtype=activations.dtype)
+            output[idx] = activations[0, 0]
+        yield output
+
+
+def chunks(array, batch=1000):
+    """
+    chunks(array, batch)
+
+    Generator stage which yields an array in batches.
+
+    Inputs:
+    array-          Array to be batched.
+    batch-          Number of rows per yielded batch.
+
+    Outputs:
+    1-              Batches of the array.
+    """
+    for start in range(0, len(array), batch):
+        yield array[start:start+batch]
+
+
+def scale(activations, batch=1000):
+    """
+    scale(activations, batch)
+
+    Generator stage which scales each feature to range 0, 1. The
+    range of each feature is accumulated over a first pass of the
+    batches so the full array is never held in memory.
+
+    Inputs:
+    activations-    Extracted activations, possibly memory-mapped.
+    batch-          Number of rows per yielded batch.
+
+    Outputs:
+    1-              Batches of the scaled activations.
+    """
+    from sklearn.preprocessing import MinMaxScaler
+
+    scaler = MinMaxScaler()
+    for activations_batch in chunks(activations, batch):
+        scaler.partial_fit(activations_batch)
+    for activations_batch in chunks(activations, batch):
+        yield scaler.transform(activations_batch)
+
+
+def collect(batches, nsamples, filename):
+    """
+    collect(batches, nsamples, filename)
+
+    Final stage which writes batches into a memory-mapped .npy file.
+
+    Inputs:
+    batches-        Iterable of batches.
+    nsamples-       Total number of rows.
+    filename-       The .npy file to be written.
+
+    Outputs:
+    1-              The memory-mapped array.
+    """
+    output = None
+    start = 0
+    for output_batch in batches:
+        if output is None:
+            output = np.lib.format.open_memmap(filename, mode="w+", dtype=output_batch.dtype,
+                                               shape=(nsamples,) + output_batch.shape[1:])
+        output[start:start+len(output_batch)] = output_batch
+        start += len(output_batch)
+    output.flush()
+    return output
+
+
+def labelled_targets(yfull, labelled):
+    """
+    labelled_targets(yfull, labelled)
+
+    Hides the targets outside the labelled pool so the landmarks are not
+    stratified on the labels of the test set or the candidates.
+
+    Inputs:
+    yfull-      Targets of the full dataset. None => no targets.
+    labelled-   Indices of the labelled structures.
+
+    Outputs:
+    1-          Targets of the labelled structures and NaN elsewhere.
+    """
+    if yfull is None:
+        return None
+    targets = np.full(len(yfull), np.nan)
+    targets[labelled] = np.asarray(yfull, dtype=float)[labelled]
+    return targets
+
 
 class latent:
 
-    def train_test_split(datadir, prop, layer, activations_input_full, Xpool,
-                         ytest, perp, ndims, niters):
+    @timed
+    def pipeline(datadir, prop, layer, activations_input_full, perp, ndims, niters,
+                 reducer="tsne", landmarks=0, yfull=None, batch=1000, max_atoms=0):
         """
-        latent.train_test_split(datadir, prop, layer, activations_input_full, 
-                                Xpool, ytest, perp, ndims, niters)
+        latent.pipeline(datadir, prop, layer, activations_input_full, perp,
+                        ndims, niters, reducer, landmarks, yfull, batch,
+                        max_atoms)
 
-        tSNE analysis or feature scaling of the activations of a layer of a 
-        neural network.
+        Extracts the activations of a layer of a neural network for the full
+        dataset and scales them or reduces their dimensions. The activations
+        are cached in the results directory and reused while the fitted model
+        and the structures of the run are unchanged.
 
         Inputs:
         datadir-                   Directory into which results are written into.
         prop-                      Optical property of interest.
-        layer-                     Layer of a MEGNet model of interest. 
-        activations_input_full-    Input to the specific layer for 
-                                   extraction of activations for the full dataset. 
-        Xpool-                     Structures in pool.
-        ytest-                     Targets in the test set. 
+        layer-                     Layer of a MEGNet model of interest.
+        activations_input_full-    Input to the specific layer for
+                                   extraction of activations for the full dataset.
         perp-                      Perplexity value for tSNE analysis.
         ndims-                     Dimensions of embedded space.
-        niters-                    The maximum number of iterations for 
+        niters-                    The maximum number of iterations for
                                    tSNE optimisation.
+        reducer-                   Backend for dimensionality reduction.
+        landmarks-                 Number of landmarks on which the reducer is
+                                   fitted. 0 => fit on the full dataset.
+        yfull-                     Targets of the full dataset for stratifying
+                                   the landmarks, NaN if not labelled.
+        batch-                     Number of structures processed at a time.
+        max_atoms-                 Maximum total number of atoms of the graphs
+                                   passed through the model at once. 0 =>
+                                   one structure at a time.
 
         Outputs:
-        1-                         GP latent points for the pool and test sets. 
+        1-                         GP latent points for the full dataset.
         """
-        if ndims > 3: 
-            logging.error("0 <= ndims < 4!") 
-            sys.exit() 
-        model_pretrained = MEGNetModel.from_file("%s/fitted_%s_model.hdf5" %(datadir, prop))
-
-        logging.info("Extracting activations from the %s layer ..." %layer)
-        net_layer = [i.output for i in model_pretrained.layers if i.name.startswith("%s" %layer)]
-        compute_graph = K.function([model_pretrained.input], [net_layer])
-        extracted_activations_full = [ ]
-        for full in activations_input_full:
-            extracted_activations_full.append(compute_graph(full))
-
-        activations = np.array(np.squeeze(extracted_activations_full))
+        if ndims > 3:
+            logging.error("0 <= ndims < 4!")
+            sys.exit()
+        nsamples = len(activations_input_full)
+        model_file = "%s/fitted_%s_model.hdf5" %(datadir, prop)
+        cache_file = "%s/activations_%s.npy" %(datadir, layer)
+        # The cache is only valid for the same rows of the same dataset
+        meta_file = "%s/activations_%s.json" %(datadir, layer)
+        meta = {"nsamples": nsamples, "fingerprint": run_fingerprint()}
+        cached = None
+        if (os.path.isfile(cache_file) and os.path.isfile(meta_file) and os.path.isfile(model_file)
+                and os.path.getmtime(cache_file) >= os.path.getmtime(model_file)):
+            with open(meta_file) as f:
+                cached = json.load(f)
+        if cached == meta and meta["fingerprint"] is not None:
+            logging.info("Loading cached activations from the %s layer ..." %layer)
+            activations = np.load(cache_file, mmap_mode="r")
+        else:
+            if not os.path.isfile(model_file):
+                logging.error("No fitted model %s to extract the activations from!" %model_file)
+                sys.exit()
+            activations = collect(extract(model_file, layer, activations_input_full, batch,
+                                          max_atoms), nsamples, cache_file)
+            with open(meta_file, "w") as f:
+                json.dump(meta, f)
+
+        latent_file = "%s/latent_full.npy" %datadir
+        # Never write through a link to the activations left by ndims = 0
+        if os.path.islink(latent_file):
+            os.remove(latent_file)
         if ndims in (0, 1):
             if np.ndim(activations) > 2:
                 logging.error("Dimension of extracted activations > 2 so apply tSNE instead!")
                 sys.exit()
             if ndims == 0:
                 logging.info("No pre-processing on the extracted activations ...")
-                latent_full  = activations
+                # The latent points are the activations, linked rather than copied
+                if os.path.isfile(latent_file):
+                    os.remove(latent_file)
+                os.symlink(os.path.basename(cache_file), latent_file)
+                latent_full = activations
             elif ndims == 1:
                 logging.info("Scaling each feature to range 0, 1 ...")
-                from sklearn.preprocessing import MinMaxScaler
-            
-                latent_full = MinMaxScaler().fit(activations).transform(activations)
+                latent_full = collect(scale(activations, batch), nsamples, latent_file)
         elif ndims > 1:
-            logging.info("Dimensionality reduction using tSNE begins ...")
-            print("Requested number of components = ", ndims)
-            print("Using max iterations = ", niters)
-            print("Processing perplexity = ", perp)
-            from sklearn.manifold import TSNE            
-            
-            latent_full = TSNE(n_components=ndims, n_iter=niters, n_jobs=-1, random_state=0,
-                          perplexity=perp).fit_transform(activations)
-
-        latent_pool = latent_full[:len(Xpool)]
-        latent_test = latent_full[len(Xpool):]
-
-        logging.info("Writing results to file ...") 
-        np.save("%s/latent_full.npy" %datadir, latent_full)
-        np.save("%s/latent_pool.npy" %datadir, latent_pool)
-        np.save("%s/latent_test.npy" %datadir, latent_test)
+            if landmarks > 0:
+                latent_full = landmark_reduce(activations, ndims, perp, niters, reducer,
+                                              landmarks, yfull)
+            else:
+                latent_full = reduce_dimensions(activations, ndims, perp, niters, reducer)
+            latent_full = collect(chunks(latent_full, batch), nsamples, latent_file)
+
+        return latent_full
+
 
+    @timed
+    def split(datadir, latent_full, **index_sets):
+        """
+        latent.split(datadir, latent_full, **index_sets)
+
+        Splits the latent points by index and saves each split to the
+        results as latent_<name>.
+
+        Inputs:
+        datadir-          Directory into which results are written into.
+        latent_full-      GP latent points for the full dataset.
+        **index_sets-     Indices of each named split.
+
+        Outputs:
+        1-                GP latent points for each split in the order passed.
+        """
+        logging.info("Writing latent points to file ...")
+        splits = [np.asarray(latent_full[idx]) for idx in index_sets.values()]
+        save_results(datadir, **{"latent_%s" %name: latent_split
+                                 for name, latent_split in zip(index_sets, splits)})
+        return splits
+
+
+    @timed
+    def plot(datadir, prop, layer, latent_test, ytest, perp, ndims, niters):
+        """
+        writer.submit(latent.plot, datadir, prop, layer, latent_test, ytest, perp, ndims, niters)
+
+        Plots the latent points of the test set coloured by their targets.
+
+        Inputs:
+        datadir-          Directory into which results are written into.
+        prop-             Optical property of interest.
+        layer-            Layer of a MEGNet model of interest.
+        latent_test-      GP latent points for the test set.
+        ytest-            Targets in the test set.
+        perp-             Perplexity value for tSNE analysis.
+        ndims-            Dimensions of embedded space.
+        niters-           The maximum number of iterations for tSNE
+                          optimisation.
+
+        Outputs:
+        1-                Plot of the latent points.
+        """
         if ndims == 0:
             logging.info("Saving extracted activations plot ...")
             plt.figure(figsize = [12, 6])
@@ -104,7 +320,7 @@ class latent:
             plt.scatter(latent_test[:,0], latent_test[:,1], c=ytest)
             plt.savefig("%s/activations_%s.pdf" %(datadir, prop))
         elif ndims > 1:
-            logging.info("Saving tSNE plots ...")            
+            logging.info("Saving tSNE plots ...")
             if ndims == 2:
                 plt.figure(figsize = [12, 6])
                 plt.title("tSNE transformed activations of %s layer \nNumber of iterations = %s \nperplexity = %s"
@@ -117,218 +333,173 @@ class latent:
                 plt.title("tSNE transformed activations of %s layer \nNumber of iterations = %s \nperplexity = %s"
                           %(layer, niters, perp))
                 ax.scatter(latent_test[:,0], latent_test[:,1], latent_test[:,2], c=ytest)
-            
+
             plt.savefig("%s/tSNE_%s.pdf" %(datadir, prop))
-        
+
+
+    @timed
+    def train_test_split(datadir, prop, layer, activations_input_full, Xpool,
+                         ytest, perp, ndims, niters, reducer="tsne", landmarks=0,
+                         yfull=None, max_atoms=0):
+        """
+        latent.train_test_split(datadir, prop, layer, activations_input_full,
+                                Xpool, ytest, perp, ndims, niters, reducer,
+                                landmarks, yfull, max_atoms)
+
+        tSNE analysis or feature scaling of the activations of a layer of a
+        neural network.
+
+        Inputs:
+        datadir-                   Directory into which results are written into.
+        prop-                      Optical property of interest.
+        layer-                     Layer of a MEGNet model of interest.
+        activations_input_full-    Input to the specific layer for
+                                   extraction of activations for the full dataset.
+        Xpool-                     Structures in pool.
+        ytest-                     Targets in the test set.
+        perp-                      Perplexity value for tSNE analysis.
+        ndims-                     Dimensions of embedded space.
+        niters-                    The maximum number of iterations for
+                                   tSNE optimisation.
+        reducer-                   Backend for dimensionality reduction.
+        landmarks-                 Number of landmarks on which the reducer is
+                                   fitted. 0 => fit on the full dataset.
+        yfull-                     Targets of the full dataset. Only those of
+                                   the pool stratify the landmarks.
+        max_atoms-                 Maximum total number of atoms of the graphs
+                                   passed through the model at once. 0 =>
+                                   one structure at a time.
+
+        Outputs:
+        1-                         GP latent points for the pool and test sets.
+        """
+        latent_full = latent.pipeline(datadir, prop, layer, activations_input_full, perp,
+                                      ndims, niters, reducer, landmarks,
+                                      labelled_targets(yfull, np.arange(len(Xpool))),
+                                      max_atoms=max_atoms)
+
+        nsamples = len(latent_full)
+        latent_pool, latent_test = latent.split(
+            datadir, latent_full,
+            pool=np.arange(len(Xpool)),
+            test=np.arange(len(Xpool), nsamples))
+
+        writer.submit(latent.plot, datadir, prop, layer, latent_test, ytest, perp, ndims, niters)
         return latent_pool, latent_test
 
 
+    @timed
     def k_fold(datadir, fold, prop, layer, activations_input_full, train_idx,
-               val_idx, Xpool, perp, ndims, niters):
+               val_idx, Xpool, perp, ndims, niters, reducer="tsne", landmarks=0,
+               yfull=None, max_atoms=0):
         """
-        latent.k_fold(datadir, fold, prop, layer, activations_input_full, 
-                      train_idx, val_idx, Xpool, perp, ndims, niters)
-        
-        tSNE analysis or feature scaling of the activations of a layer of a 
-        neural network for k-fold cross-validation. 
+        latent.k_fold(datadir, fold, prop, layer, activations_input_full,
+                      train_idx, val_idx, Xpool, perp, ndims, niters, reducer,
+                      landmarks, yfull, max_atoms)
+
+        tSNE analysis or feature scaling of the activations of a layer of a
+        neural network for k-fold cross-validation.
 
         Inputs:
         datadir-                   Directory into which results are written into.
         fold-                      Number of fold to be processed.
-        prop-                      Optical property of interest.  
-        layer-                     Layer of a MEGNet model of interest. 
-        activations_input_full-    Input to the specific layer for  extraction 
-                                   of activations for the full dataset. 
+        prop-                      Optical property of interest.
+        layer-                     Layer of a MEGNet model of interest.
+        activations_input_full-    Input to the specific layer for  extraction
+                                   of activations for the full dataset.
         train_idx-                 Indices to extract training set from the pool.
         val_idx-                   Indices to extrct validation set from the pool.
-        Xpool-                     Structures in pool.     
-        perp-                      Perplexity value for tSNE analysis. 
-        ndims-                     Dimensions of embedded space.  
-        niters-                    The maximum number of iterations for tSNE 
+        Xpool-                     Structures in pool.
+        perp-                      Perplexity value for tSNE analysis.
+        ndims-                     Dimensions of embedded space.
+        niters-                    The maximum number of iterations for tSNE
                                    optimisation.
-        
+        reducer-                   Backend for dimensionality reduction.
+        landmarks-                 Number of landmarks on which the reducer is
+                                   fitted. 0 => fit on the full dataset.
+        yfull-                     Targets of the full dataset. Only those of
+                                   the pool stratify the landmarks.
+        max_atoms-                 Maximum total number of atoms of the graphs
+                                   passed through the model at once. 0 =>
+                                   one structure at a time.
+
         Outputs:
         1-                         GP latent points for the training, validation,
                                    and test sets.
         """
-        if ndims > 3:
-            logging.error("0 <= ndims < 4 !")
-            sys.exit()
-        model_pretrained = MEGNetModel.from_file("%s/fitted_%s_model.hdf5" %(datadir, prop))
+        latent_full = latent.pipeline(datadir, prop, layer, activations_input_full, perp,
+                                      ndims, niters, reducer, landmarks,
+                                      labelled_targets(yfull, np.arange(len(Xpool))),
+                                      max_atoms=max_atoms)
+
+        nsamples = len(latent_full)
+        latent_pool, latent_train, latent_val, latent_test = latent.split(
+            datadir, latent_full,
+            pool=np.arange(len(Xpool)),
+            train=train_idx,
+            val=val_idx,
+            test=np.arange(len(Xpool), nsamples))
 
-        logging.info("Extracting activations from the %s layer ..." %layer)
-        net_layer = [i.output for i in model_pretrained.layers if i.name.startswith("%s" %layer)]
-        compute_graph = K.function([model_pretrained.input], [net_layer])
-        extracted_activations_full = [ ]
-        for full in activations_input_full:
-            extracted_activations_full.append(compute_graph(full))
+        return latent_train, latent_val, latent_test
 
-        activations = np.array(np.squeeze(extracted_activations_full))
-        if ndims in (0, 1):
-            if np.ndim(activations) > 2:
-                logging.error("Dimension of extracted activations > 2 so apply tSNE instead!")
-                sys.exit()
-            if ndims == 0:
-                logging.info("No pre-processing on the extracted activations ...")
-                latent_full  = activations
-            elif ndims == 1:
-                logging.info("Scaling each feature to range 0, 1 ...")
-                from sklearn.preprocessing import MinMaxScaler
 
-                latent_full = MinMaxScaler().fit(activations).transform(activations)
-        elif ndims > 1:
-            logging.info("Dimensionality reduction using tSNE begins ...")
-            print("Requested number of components = ", ndims)
-            print("Using max iterations = ", niters)
-            print("Processing perplexity = ", perp)
-            from sklearn.manifold import TSNE
-            
-            latent_full = TSNE(n_components=ndims, n_iter=niters, n_jobs=-1, random_state=0,
-                               perplexity=perp).fit_transform(activations)
-            
-        logging.info("Writing results to file ...") 
-        np.save("%s/latent_full.npy" %datadir, latent_full)
-        
-        latent_pool = latent_full[:len(Xpool)]
-        np.save("%s/latent_pool.npy" %datadir, latent_pool)
-        
-        latent_train = latent_pool[train_idx]
-        np.save("%s/latent_train.npy" %datadir, latent_train)
-        
-        latent_val = latent_pool[val_idx]
-        np.save("%s/latent_val.npy" %datadir, latent_val)
-
-        latent_test  = latent_full[len(Xpool):]
-        np.save("%s/latent_test.npy" %datadir, latent_test)
-
-        return latent_train, latent_val, latent_test 
-        
-    
+    @timed
     def active(datadir, prop, layer, sampling, activations_input_full,
-               Xfull, Xtest, ytest, Xtrain, Xval, perp, ndims, niters):
+               Xfull, ytest, train_idx, val_idx, test_idx, perp, ndims, niters,
+               reducer="tsne", landmarks=0, yfull=None, max_atoms=0):
         """
-        latent.active(datadir, prop, layer, sampling, activations_input_full, 
-                      Xfull, Xtest, ytest, Xtrain, Xval, perp, ndims, niters)
+        latent.active(datadir, prop, layer, sampling, activations_input_full,
+                      Xfull, ytest, train_idx, val_idx, test_idx, perp, ndims,
+                      niters, reducer, landmarks, yfull, max_atoms)
 
-        tSNE analysis or feature scaling of the activations of a layer of a 
-        neural network for active learning purposes. 
+        tSNE analysis or feature scaling of the activations of a layer of a
+        neural network for active learning purposes.
 
         Inputs:
-        datadir-                  Directory into which results are written into. 
+        datadir-                  Directory into which results are written into.
         prop-                     Optical property of interest.
-        layer-                    Layer of a MEGNet model of interest. 
-        sampling-                 Type of sampling the test set for performing 
-                                  active learning. 
+        layer-                    Layer of a MEGNet model of interest.
+        sampling-                 Type of sampling the test set for performing
+                                  active learning.
         activations_input_full-   Input to the specific layer for extraction
                                   of activations for the full dataset.
-        Xfull-                    Structures of the full dataset. 
-        Xtest-                    Structures in test set. 
+        Xfull-                    Structures of the full dataset.
         ytest-                    Targets in the test set.
-        Xtrain-                   Structures for training. 
-        Xval-                     Structures for validation. 
+        train_idx-                Indices of the training set in the full 
+                                  dataset.
+        val_idx-                  Indices of the validation set in the full 
+                                  dataset.
+        test_idx-                 Indices of the test set in the full dataset.
         perp-                     Perplexity value for tSNE analysis.
         ndims-                    Dimensions of embedded space.
         niters-                   The maximum number of iterations for tSNE
-                                  optimisation. 
+                                  optimisation.
+        reducer-                  Backend for dimensionality reduction.
+        landmarks-                Number of landmarks on which the reducer is
+                                  fitted. 0 => fit on the full dataset.
+        yfull-                    Targets of the full dataset. Only those of
+                                  the training and validation sets stratify
+                                  the landmarks.
+        max_atoms-                Maximum total number of atoms of the graphs
+                                  passed through the model at once. 0 => one
+                                  structure at a time.
 
         Outputs:
-        1-                         GP latent points for the full, pool, training, 
-                                   validation, and test sets. 
+        1-                         GP latent points for the training, validation, 
+                                   and test sets.
         """
-        if ndims > 3:
-            logging.error("0 <= ndims < 4!")
-            sys.exit() 
-        model_pretrained = MEGNetModel.from_file("%s/fitted_%s_model.hdf5" %(datadir, prop))
-
-        logging.info("Extracting activations from the %s layer ..." %layer)
-        net_layer = [i.output for i in model_pretrained.layers if i.name.startswith("%s" %layer)]
-        compute_graph = K.function([model_pretrained.input], [net_layer])
-        extracted_activations_full = [ ]
-        for full in activations_input_full:
-            extracted_activations_full.append(compute_graph(full))
-
-        activations = np.array(np.squeeze(extracted_activations_full))
-        if ndims in (0, 1):
-            if np.ndim(activations) > 2:
-                logging.error("Dimension of extracted activations > 2 so apply tSNE instead!")
-                sys.exit()
-            if ndims == 0:
-                logging.info("No pre-processing on the extracted activations ...")
-                latent_full  = activations
-            elif ndims == 1:
-                logging.info("Scaling each feature to range 0, 1 ...")
-                from sklearn.preprocessing import MinMaxScaler
-
-                latent_full = MinMaxScaler().fit(activations).transform(activations)
-        elif ndims > 1:
-            logging.info("Dimensionality reduction using tSNE begins ...")
-            print("Requested number of components = ", ndims)
-            print("Using max iterations = ", niters)
-            print("Processing perplexity = ", perp)
-            from sklearn.manifold import TSNE
-            
-            latent_full = TSNE(n_components=ndims, n_iter=niters, n_jobs=-1, random_state=0,
-                             perplexity=perp).fit_transform(activations)
-            
-        # Update the tsne values for the training and test sets
-        latent_test = [ ]
-        latent_train = [ ]
-        latent_val = [ ]
-        for test in Xtest:
-            for full, tr in zip(Xfull, latent_full):
-                if test == full:
-                    latent_test.append(tr)
-        for train in Xtrain:
-            for full, tr in zip(Xfull, latent_full):
-                if train == full:
-                    latent_train.append(tr)
-        for val in Xval:
-            for full, tr in zip(Xfull, latent_full):
-                if val == full:
-                    latent_val.append(tr)
-
-        latent_train = np.array(latent_train)
-        latent_val = np.array(latent_val)
-        latent_test = np.array(latent_test)
-
-        print("\nWriting latent points to file ...")
-        np.save("%s/latent_full.npy" %datadir, latent_full)
-        np.save("%s/latent_train.npy" %datadir, latent_train)
-        np.save("%s/latent_val.npy" %datadir, latent_val)
-        np.save("%s/latent_test.npy" %datadir, latent_test)
-        np.save("%s/Xtest.npy" %datadir, Xtest) 
-        np.save("%s/ytest.npy" %datadir, ytest) 
-        
-        if ndims == 0:
-            logging.info("Saving extracted activations plot ...")
-            plt.figure(figsize = [12, 6])
-            plt.title("Raw activations from %s layer" %layer)
-            plt.scatter(latent_test[:,0], latent_test[:,1], c=ytest)
-            plt.savefig("%s/activations_%s.pdf" %(datadir, prop))
-        elif ndims == 1:
-            logging.info("Saving scaled activations plot ...")
-            plt.figure(figsize = [12, 6])
-            plt.title("Scaled activations from %s layer" %layer)
-            plt.scatter(latent_test[:,0], latent_test[:,1], c=ytest)
-            plt.savefig("%s/activations_%s.pdf" %(datadir, prop))        
-        elif ndims > 1: 
-            logging.info("Saving tSNE plots ...")
-            if ndims == 2:
-                plt.figure(figsize = [12, 6])
-                plt.title("tSNE transformed activations of %s layer \nNumber of iterations = %s \nperplexity = %s"
-                          %(layer, niters, perp))
-                plt.scatter(latent_test[:,0], latent_test[:,1], c=ytest)
-            elif ndims == 3:
-                from mpl_toolkits.mplot3d import Axes3D
-                fig = plt.figure(figsize = [14, 6])
-                ax = fig.add_subplot(111, projection="3d")
-                plt.title("tSNE transformed activations of %s layer \nNumber of iterations = %s \nperplexity = %s"
-                          %(layer, niters, perp))
-                ax.scatter(latent_test[:,0], latent_test[:,1], latent_test[:,2], c=ytest)
-
-            if not os.path.isfile("%s/tSNE_%s.pdf" %(sampling, prop)):
-                plt.savefig("%s/tSNE_%s.pdf" %(datadir, prop))
-
+        latent_full = latent.pipeline(datadir, prop, layer, activations_input_full, perp,
+                                      ndims, niters, reducer, landmarks,
+                                      labelled_targets(yfull, np.concatenate((train_idx, val_idx))),
+                                      max_atoms=max_atoms)
+
+        latent_train, latent_val, latent_test = latent.split(
+            datadir, latent_full,
+            train=train_idx,
+            val=val_idx,
+            test=test_idx)
+        save_splits(datadir, Xtest=Xfull[test_idx])
+        save_results(datadir, ytest=ytest)
+
+        writer.submit(latent.plot, datadir, prop, layer, latent_test, ytest, perp, ndims, niters)
         return latent_train, latent_val, latent_test
-
-    
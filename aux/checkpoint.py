@@ -0,0 +1,98 @@
+"""
+checkpoint.py, SciML-SCD, RAL
+
+Per-cycle state of the active learning runs. After each completed
+cycle the status of the pool, the acquired samples, the GP
+hyperparameters, the state of the NumPy random number generator and
+the metric histories are written to a single .npz file. The file is
+first written next to the checkpoint and then renamed over it, so an
+interrupted run always leaves the last complete checkpoint behind.
+
+The settings of the run which change the selection are stored with
+the state, and a run is only resumed with the same settings.
+"""
+import json
+import sys
+import logging
+import os
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
+                    format="%(levelname)s:gp-net: %(message)s")
+
+import numpy as np
+
+
+def save_checkpoint(filename, pool, cycle, settings=None, **state):
+    """
+    save_checkpoint(filename, pool, cycle, settings, **state)
+
+    Inputs:
+    filename-       Checkpoint file in .npz format.
+    pool-           Pool of training, validation and candidate
+                    (test) sets.
+    cycle-          Last completed cycle of active learning.
+    settings-       Dictionary of the settings of the run, e.g. query
+                    and batchsel. None => no settings.
+    **state-        Hyperparameters, metric histories and references
+                    to the latent points to be restored on resume.
+    """
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    tmp = "%s.tmp" %filename
+    with open(tmp, "wb") as f:
+        np.savez(f, status=pool.status, acquired=pool.acquired, cycle=cycle,
+                 rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss,
+                 rng_cached_gaussian=cached_gaussian,
+                 settings=json.dumps(settings or {}, sort_keys=True), **state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def load_checkpoint(filename, pool, settings=None):
+    """
+    load_checkpoint(filename, pool, settings)
+
+    Restores the pool and the random number generator from a
+    checkpoint.
+
+    Inputs:
+    filename-       Checkpoint file in .npz format.
+    pool-           Pool of training, validation and candidate
+                    (test) sets built for the same dataset.
+    settings-       Dictionary of the settings of the run, which must
+                    match those of the checkpoint. None => no settings.
+
+    Outputs:
+    1-              Last completed cycle of active learning. -1 => no
+                    checkpoint was found.
+    2-              Dictionary of the remaining state.
+    """
+    if not os.path.isfile(filename):
+        logging.info("No checkpoint found at %s. Starting from cycle 0 ..." %filename)
+        return -1, {}
+
+    with np.load(filename) as checkpoint:
+        state = {key: checkpoint[key] for key in checkpoint.files}
+    if len(state["status"]) != len(pool.status):
+        logging.error("Checkpoint %s was written for a dataset of %s samples, not %s!"
+                      %(filename, len(state["status"]), len(pool.status)))
+        sys.exit()
+
+    saved = json.loads(str(state.pop("settings", "{}")))
+    settings = json.loads(json.dumps(settings or {}, sort_keys=True))
+    if saved != settings:
+        changed = sorted(k for k in set(saved) | set(settings) if saved.get(k) != settings.get(k))
+        logging.error("Checkpoint %s was written with other settings: %s!"
+                      %(filename, ", ".join("%s=%s (now %s)" %(k, saved.get(k), settings.get(k))
+                                            for k in changed)))
+        sys.exit()
+
+    pool.restore(state.pop("status"), state.pop("acquired"))
+    np.random.set_state(("MT19937", state.pop("rng_keys"), int(state.pop("rng_pos")),
+                         int(state.pop("rng_has_gauss")),
+                         float(state.pop("rng_cached_gaussian"))))
+    cycle = int(state.pop("cycle"))
+    logging.info("Resuming after cycle %s from %s ..." %(cycle, filename))
+    return cycle, state
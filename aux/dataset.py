@@ -0,0 +1,382 @@
+"""
+dataset.py, SciML-SCD, RAL
+
+Columnar format for the datasets of structures and targets. The
+pickled dataframes of pymatgen structures written on download
+are converted into a directory of flat arrays:
+
+    <prop>_data/lattice.npy         Lattice matrices, (structures, 3, 3)
+    <prop>_data/offsets.npy         Offsets of each structure into the
+                                    site arrays, (structures + 1,)
+    <prop>_data/species.npy         Atomic numbers of the sites, (sites,)
+    <prop>_data/frac_coords.npy     Fractional coordinates of the sites,
+                                    (sites, 3)
+    <prop>_data/targets.npy         Optical property values, (structures,)
+    <prop>_data/meta.json           Property name and counts.
+
+The arrays are memory-mapped on reading so the dataset can be
+sliced and its targets inspected without building every
+pymatgen structure. Only ordered structures are supported; site
+properties and oxidation states are not stored.
+
+The training, validation, pool and test sets written to the results
+directories are stored in splits.npz as indices into the source
+dataset of the run together with a fingerprint of that dataset, and
+their structures are rebuilt on demand by load_split.
+"""
+import hashlib
+import json
+import logging
+import os
+import sys
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
+                    format="%(levelname)s:gp-net: %(message)s")
+
+import numpy as np
+
+COLUMNS = ("lattice", "offsets", "species", "frac_coords", "targets")
+
+
+def columnar_path(prop):
+    """
+    columnar_path(prop)
+
+    Inputs:
+    prop-       Optical property of interest.
+
+    Outputs:
+    1-          Directory of the columnar dataset of the property.
+    """
+    return "%s_data" %prop
+
+
+def convert_data(datafile, outdir=None):
+    """
+    convert_data(datafile, outdir)
+
+    Converts a pickled dataframe of structures and targets into the
+    columnar format.
+
+    Inputs:
+    datafile-   The data in .pkl format.
+    outdir-     Directory of the columnar dataset. [default: the name
+                of datafile without the .pkl extension]
+
+    Outputs:
+    1-          Directory of the columnar dataset.
+    """
+    import pandas as pd
+
+    prop = os.path.basename(datafile).split("_data")[0]
+    outdir = outdir or datafile.split(".pkl")[0]
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    logging.info("Converting %s into columnar format ..." %datafile)
+    inputs = pd.read_pickle(datafile)
+    structures = inputs["structure"].to_numpy()
+    nsites = np.array([len(s) for s in structures], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(nsites)))
+
+    lattice = np.lib.format.open_memmap("%s/lattice.npy" %outdir, mode="w+",
+                                        dtype=np.float64, shape=(len(structures), 3, 3))
+    species = np.lib.format.open_memmap("%s/species.npy" %outdir, mode="w+",
+                                        dtype=np.int16, shape=(offsets[-1],))
+    frac_coords = np.lib.format.open_memmap("%s/frac_coords.npy" %outdir, mode="w+",
+                                            dtype=np.float64, shape=(offsets[-1], 3))
+    for i, s in enumerate(structures):
+        lattice[i] = s.lattice.matrix
+        species[offsets[i]:offsets[i+1]] = s.atomic_numbers
+        frac_coords[offsets[i]:offsets[i+1]] = s.frac_coords
+    for column in (lattice, species, frac_coords):
+        column.flush()
+    np.save("%s/offsets.npy" %outdir, offsets)
+    np.save("%s/targets.npy" %outdir, inputs[prop].to_numpy(dtype=np.float64))
+
+    with open("%s/meta.json" %outdir, "w") as f:
+        json.dump({"prop": prop, "structures": len(structures), "sites": int(offsets[-1])}, f)
+    print("Number of structures written to %s = %s" %(outdir, len(structures)))
+    return outdir
+
+
+class ColumnarData:
+
+    def __init__(self, path, index=None):
+        """
+        ColumnarData(path, index)
+
+        Memory-mapped reader of a columnar dataset. Structures are built
+        only when accessed.
+
+        Inputs:
+        path-       Directory of the columnar dataset.
+        index-      Indices of the structures in the dataset exposed by
+                    this reader. [default: all structures]
+        """
+        self.path = path
+        with open("%s/meta.json" %path) as f:
+            self.meta = json.load(f)
+        self.prop = self.meta["prop"]
+        self.columns = {column: np.load("%s/%s.npy" %(path, column), mmap_mode="r")
+                        for column in COLUMNS}
+        if index is None:
+            index = np.arange(self.meta["structures"])
+        self.index = np.asarray(index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for i in self.index:
+            yield self.structure(i)
+
+    def __getitem__(self, key):
+        """ An integer builds a structure, anything else returns a sliced reader """
+        if np.isscalar(key):
+            return self.structure(self.index[key])
+        return self.subset(key)
+
+    @property
+    def targets(self):
+        """ Targets of the exposed structures """
+        return np.asarray(self.columns["targets"][self.index])
+
+    def subset(self, key):
+        """
+        subset(key)
+
+        Inputs:
+        key-        Slice, indices or boolean mask into the exposed
+                    structures.
+
+        Outputs:
+        1-          A reader over the selected structures. No structure
+                    is built.
+        """
+        reader = ColumnarData.__new__(ColumnarData)
+        reader.__dict__.update(self.__dict__)
+        reader.index = self.index[key]
+        return reader
+
+    def structure(self, i):
+        """
+        structure(i)
+
+        Inputs:
+        i-          Index of the structure in the full dataset.
+
+        Outputs:
+        1-          The pymatgen structure.
+        """
+        from pymatgen import Structure
+
+        start, end = self.columns["offsets"][i:i+2]
+        return Structure(np.asarray(self.columns["lattice"][i]),
+                         np.asarray(self.columns["species"][start:end]),
+                         np.asarray(self.columns["frac_coords"][start:end]))
+
+
+# Source dataset of the structures of the run, set by register_source
+_source = {}
+
+
+def dataset_fingerprint(path):
+    """
+    dataset_fingerprint(path)
+
+    The digest is cached next to the dataset, in <path>.fingerprint.json
+    or <path>/fingerprint.json, together with the size and modification
+    time of its files, and only recomputed when they change.
+
+    Inputs:
+    path-       Dataset in .pkl format or directory in columnar format.
+
+    Outputs:
+    1-          SHA-1 digest of the content of the dataset.
+    """
+    if os.path.isfile(path):
+        files = [path]
+        cache_file = "%s.fingerprint.json" %path
+    else:
+        files = ["%s/meta.json" %path] + ["%s/%s.npy" %(path, c) for c in COLUMNS]
+        cache_file = "%s/fingerprint.json" %path
+    stats = [[os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files]
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached.get("files") == stats:
+            return cached["sha1"]
+
+    digest = hashlib.sha1()
+    for filename in files:
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    try:
+        with open(cache_file, "w") as f:
+            json.dump({"files": stats, "sha1": digest.hexdigest()}, f)
+    except OSError:
+        logging.warning("Cannot cache the fingerprint of %s in %s ..." %(path, cache_file))
+    return digest.hexdigest()
+
+
+def register_source(path, structures, index):
+    """
+    register_source(path, structures, index)
+
+    Records the positions of the structures of the run in their source
+    dataset, so that the splits of these structures are saved as 
+    indices.
+
+    The structures are found by identity. Their keys, needed for the 
+    copies of the structures in worker processes, are only computed by
+    source_index.
+
+    Inputs:
+    path-           Dataset the structures were read from.
+    structures-     Structures of the run.
+    index-          Positions of the structures in the dataset.
+    """
+    index = np.asarray(index, dtype=np.int64)
+    _source.clear()
+    _source.update(path=path, fingerprint=dataset_fingerprint(path), index=index,
+                   ids={id(s): i for s, i in zip(structures, index)},
+                   structures=structures)
+
+
+def _source_keys():
+    """
+    _source_keys()
+
+    Outputs:
+    1-          Positions of the registered structures keyed by 
+                structure_key, computed on first use. A structure 
+                duplicated in the dataset is mapped to the position of
+                its first copy.
+    """
+    from aux.get_info import structure_key
+
+    if "keys" not in _source:
+        keys = {}
+        duplicates = 0
+        for s, i in zip(_source["structures"], _source["index"]):
+            key = structure_key(s)
+            if key in keys:
+                duplicates += 1
+                continue
+            keys[key] = i
+        if duplicates:
+            logging.warning("%s structures of %s are duplicates, their splits are saved with the position of the first copy ..."
+                            %(duplicates, _source["path"]))
+        _source["keys"] = keys
+    return _source["keys"]
+
+
+def run_fingerprint():
+    """
+    run_fingerprint()
+
+    Outputs:
+    1-          SHA-1 digest of the source dataset and of the positions
+                of the structures of the run in it, which change with
+                the dataset or with -include. None => no source 
+                dataset registered.
+    """
+    if not _source:
+        return None
+    digest = hashlib.sha1(_source["fingerprint"].encode())
+    digest.update(_source["index"].tobytes())
+    return digest.hexdigest()
+
+
+def source_index():
+    """
+    source_index()
+
+    Outputs:
+    1-          The registered source, without the identities of the
+                structure objects, for a worker process.
+    """
+    _source_keys()
+    return {k: v for k, v in _source.items() if k not in ("ids", "structures")}
+
+
+def set_source_index(source):
+    """
+    set_source_index(source)
+
+    Inputs:
+    source-     Output of source_index in the parent process.
+    """
+    _source.clear()
+    _source.update(source)
+
+
+def source_positions(structures):
+    """
+    source_positions(structures)
+
+    Inputs:
+    structures-     Structures registered with register_source.
+
+    Outputs:
+    1-              Their positions in the source dataset.
+    """
+    from aux.get_info import structure_key
+
+    ids = _source.get("ids", {})
+    return np.array([ids[id(s)] if id(s) in ids else _source_keys()[structure_key(s)]
+                     for s in structures], dtype=np.int64)
+
+
+def save_splits(datadir, **splits):
+    """
+    save_splits(datadir, **splits)
+
+    Adds the splits to <datadir>/splits.npz as indices into the source
+    dataset. Splits already in the file under other names are kept.
+
+    Inputs:
+    datadir-        Results directory.
+    **splits-       Structures of each split, e.g. Xpool=Xpool.
+    """
+    if not _source:
+        logging.warning("No source dataset registered, the splits are not saved ...")
+        return
+    filename = "%s/splits.npz" %datadir
+    saved = { }
+    if os.path.isfile(filename):
+        with np.load(filename) as f:
+            if str(f["fingerprint"]) == _source["fingerprint"]:
+                saved = {name: f[name] for name in f.files}
+    saved.update({name: source_positions(structures) for name, structures in splits.items()})
+    saved.update(source=_source["path"], fingerprint=_source["fingerprint"])
+    np.savez(filename, **saved)
+
+
+def load_split(datadir, name, source=None):
+    """
+    load_split(datadir, name, source)
+
+    Inputs:
+    datadir-        Results directory.
+    name-           Name of the split, e.g. Xpool.
+    source-         Path to the source dataset. [default: the path
+                    stored with the splits]
+
+    Outputs:
+    1-              The structures of the split, built on access for a
+                    dataset in columnar format.
+    """
+    with np.load("%s/splits.npz" %datadir) as f:
+        index = f[name]
+        source = source or str(f["source"])
+        fingerprint = str(f["fingerprint"])
+    if dataset_fingerprint(source) != fingerprint:
+        logging.error("%s is not the dataset the splits of %s were saved from!" %(source, datadir))
+        sys.exit()
+    if os.path.isdir(source):
+        return ColumnarData(source, index)
+    import pandas as pd
+
+    return pd.read_pickle(source)["structure"].to_numpy()[index]
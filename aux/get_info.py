@@ -11,14 +11,13 @@ import logging
 import os 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
                     format="%(levelname)s:gp-net: %(message)s")
-import pandas as pd
 import numpy as np 
 
-from pymatgen import MPRester
-from megnet.data.graph import GaussianDistance
-from megnet.data.graph import StructureGraph
-from megnet.data.crystal import CrystalGraph
-from megnet.models import MEGNetModel
+from aux.dataset import ColumnarData, columnar_path, register_source
+from aux.instrument import timed, stage
+
+# pandas, pymatgen and MEGNet are imported by the routines using them 
+# so that listing and checking datasets does not load TensorFlow
 
 
 def show_layers(model_file):
@@ -34,6 +33,8 @@ def show_layers(model_file):
     Outputs:
          1-              Layers in the model file.
     """
+    from megnet.models import MEGNetModel
+
     pretrained_model = MEGNetModel.from_file(model_file) 
     print(pretrained_model.summary())
 
@@ -53,6 +54,9 @@ def download(key):
          1-        List of requested material properties
                    to be trained on.
     """
+    import pandas as pd
+    from pymatgen import MPRester
+
     api = key[0]
     m = MPRester(api)
     criteria = {"elements": {"$all":["O"]}}
@@ -82,10 +86,87 @@ def load_data(data):
     """
     props = [ ]
     for dat in data:
-        props.append(dat.split("_data.pkl")[0])
+        props.append(os.path.basename(os.path.normpath(dat)).split("_data")[0])
     return props
 
 
+@timed
+def read_inputs(datafile, prop):
+    """
+    read_inputs(datafile, prop)
+
+    Reads the structures and targets of a dataset. A dataset in columnar
+    format is memory-mapped and its structures are built on access. 
+
+    Inputs:
+    datafile-     The data in .pkl format or a directory in columnar 
+                  format.
+    prop-         Optical property of interest.
+
+    Outputs:
+    1-            Structures.
+    2-            Targets.
+    """
+    if os.path.isdir(datafile):
+        dataset = ColumnarData(datafile)
+        return dataset, dataset.targets
+    import pandas as pd
+
+    inputs = pd.read_pickle(datafile)
+    return inputs["structure"].to_numpy(), inputs[prop].to_numpy()
+
+
+def find_data(prop):
+    """
+    find_data(prop)
+
+    Locates the dataset of a property. The columnar format is preferred 
+    over the pickled dataframe when both are present. 
+
+    Inputs:
+    prop-         Optical property of interest.
+
+    Outputs:
+    1-            Path to the dataset.
+    """
+    if os.path.isdir(columnar_path(prop)):
+        return columnar_path(prop)
+    return "%s_data.pkl" %prop
+
+
+def aligned_inputs(properties):
+    """
+    aligned_inputs(properties)
+
+    Reads the structures present in the datasets of all the properties.
+    The structures are matched by structure_key and kept in the order of
+    the dataset of the first property.
+
+    Inputs:
+    properties-   Optical properties of interest.
+
+    Outputs:
+    1-            Structures.
+    2-            Targets of shape (structures, properties).
+    3-            Positions of the structures in the dataset of the first
+                  property.
+    """
+    structures, targets = read_inputs(find_data(properties[0]), properties[0])
+    keys = [structure_key(structure) for structure in structures]
+    columns = [np.asarray(targets, dtype=np.float64)]
+    for prop in properties[1:]:
+        other, other_targets = read_inputs(find_data(prop), prop)
+        lookup = {structure_key(structure): i for i, structure in enumerate(other)}
+        idx = np.array([lookup.get(key, -1) for key in keys])
+        columns.append(np.where(idx >= 0, np.asarray(other_targets, dtype=np.float64)[idx],
+                                np.nan))
+    targets = np.column_stack(columns)
+    shared = np.flatnonzero(~np.isnan(targets).any(axis=1))
+    print("Number of structures shared by %s = %s of %s" %(", ".join(properties), len(shared),
+                                                           len(keys)))
+    return structures[shared], targets[shared], shared
+
+
 def ReadData(datafile, ZeroVals):
     """
     ReadData(datafile, ZeroVals) 
@@ -93,7 +174,8 @@ def ReadData(datafile, ZeroVals):
     can decide on how to split data for processing.
 
     Inputs:
-    datafile-     The data in .pkl format. 
+    datafile-     The data in .pkl format or a directory in columnar
+                  format. 
     ZeroVals-     Exclude/Include zero optical 
                   property values. 
     
@@ -101,32 +183,222 @@ def ReadData(datafile, ZeroVals):
     1-            Number of entries in the 
                   dataset.
     """
-    inputs = pd.read_pickle(datafile)
-    prop = datafile.split("_data")[0]
-    print("\nNumber of input entries found for %s data = %s" %(prop, len(inputs)))
+    prop = load_data([datafile])[0]
+    targets = read_inputs(datafile, prop)[1]
+    print("\nNumber of input entries found for %s data = %s" %(prop, len(targets)))
     if ZeroVals == False:
         logging.info("Excluding zero optical property values from the dataset ...")
-        mask = np.array([i for i,val in enumerate(inputs[prop]) if abs(val) == 0.])
-        structures = np.delete(inputs["structure"].to_numpy(), mask)
-        targets = np.delete(inputs[prop].to_numpy(), mask)
-        print("Remaining number of entries = %s" %len(targets))
+        print("Remaining number of entries = %s" %np.count_nonzero(np.asarray(targets) != 0.))
     else:
         logging.info("Optical property values zero will not be excluded ...")
-        structures = inputs["structure"].to_numpy()
-        targets = inputs[prop].to_numpy()
         print("Remaining number of entries = %s" %len(targets))
         
 
-def megnet_input(prop, ZeroVals, bond, nfeat_global, cutoff, width, *fraction):
+def crystal_graph(bond, cutoff, width):
     """
-    megnet_input(prop, ZeroVals, bond, nfeat_global, cutoff, width, *fraction)
+    crystal_graph(bond, cutoff, width)
+
+    Inputs:
+    bond-                   MEGNet feature bond.
+    cutoff-                 MEGNet radial cutoff.
+    width-                  MEGNet gaussian width.
+
+    Outputs:
+    1-                      The graph converter of the structures.
+    """
+    from megnet.data.graph import GaussianDistance
+    from megnet.data.crystal import CrystalGraph
+
+    gaussian_centers = np.linspace(0, cutoff, bond)
+    distance_converter = GaussianDistance(gaussian_centers, width)
+    return CrystalGraph(bond_converter=distance_converter)
+
+
+def build_model(bond, nfeat_global, cutoff, width, ntarget=1):
+    """
+    build_model(bond, nfeat_global, cutoff, width, ntarget)
+
+    Inputs:
+    bond-                   MEGNet feature bond.
+    nfeat_global-           MEGNet feature global.
+    cutoff-                 MEGNet radial cutoff.
+    width-                  MEGNet gaussian width.
+    ntarget-                Number of targets predicted jointly.
+
+    Outputs:
+    1-                      An untrained MEGNet model and its graph 
+                            converter.
+    """
+    from megnet.models import MEGNetModel
+
+    graph_converter = crystal_graph(bond, cutoff, width)
+    model = MEGNetModel(bond, nfeat_global, ntarget=ntarget, graph_converter=graph_converter)
+    # The targets of a batch of graphs have shape (1, structures, ntarget),
+    # so the weights of the structures, (1, structures), are temporal
+    model.compile(model.optimizer, model.loss, sample_weight_mode="temporal")
+    return model, graph_converter
+
+
+def structure_key(structure):
+    """
+    structure_key(structure)
+
+    Inputs:
+    structure-              A pymatgen structure.
+
+    Outputs:
+    1-                      Digest of the lattice, species and fractional
+                            coordinates identifying the structure in
+                            the graph cache.
+    """
+    import hashlib
+
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(structure.lattice.matrix, dtype=np.float64).tobytes())
+    digest.update(np.asarray(structure.atomic_numbers, dtype=np.int16).tobytes())
+    digest.update(np.ascontiguousarray(np.round(structure.frac_coords, 8)).tobytes())
+    return digest.hexdigest()
+
+
+def graph_cache_path(prop, bond, cutoff, width):
+    """
+    graph_cache_path(prop, bond, cutoff, width)
+
+    Inputs:
+    prop-                   Optical property, or list of properties, of
+                            the dataset.
+
+    Outputs:
+    1-                      File of the graph cache of the dataset. The 
+                            graphs depend on the settings of the graph 
+                            converter only, but a cache per dataset keeps
+                            a process from loading the graphs of the 
+                            other datasets.
+    """
+    if not isinstance(prop, str):
+        prop = "_".join(prop)
+    return "graph_cache/%s_bond%s_cutoff%s_width%s.pkl" %(prop, bond, cutoff, width)
+
+
+def load_graph_cache(filename):
+    """
+    load_graph_cache(filename)
+
+    Outputs:
+    1-                      Dictionary of the graph inputs keyed by 
+                            structure_key. None marks a structure which
+                            could not be converted.
+    """
+    import pickle
+
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def save_graph_cache(filename, cache):
+    """
+    save_graph_cache(filename, cache)
+
+    Writes the graph cache through a temporary file so readers never see
+    a partially written cache.
+    """
+    import pickle
+
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    tmp = "%s.tmp" %filename
+    with open(tmp, "wb") as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, filename)
+
+
+def graph_input(structure, graph_converter, cache=None):
+    """
+    graph_input(structure, graph_converter, cache)
+
+    Inputs:
+    structure-              A pymatgen structure.
+    graph_converter-        The graph converter of the structures.
+    cache-                  Graph cache updated in place. None => no
+                            caching.
+
+    Outputs:
+    1-                      Graph input to MEGNet. None => the structure 
+                            could not be converted, e.g. it contains an
+                            isolated atom.
+    """
+    from megnet.data.graph import StructureGraph
+
+    if cache is not None:
+        key = structure_key(structure)
+        if key in cache:
+            return cache[key]
+    try:
+        graph = StructureGraph.get_input(graph_converter, structure)
+    except:
+        graph = None
+    if cache is not None:
+        cache[key] = graph
+    return graph
+
+
+@timed
+def cache_graphs(properties, bond, cutoff, width):
+    """
+    cache_graphs(properties, bond, cutoff, width)
+
+    Converts the structures of the datasets of all the properties into
+    graphs and stores them in the graph cache of each property. A 
+    structure shared by several datasets is converted only once.
+
+    Inputs:
+    properties-             Optical properties of interest.
+    bond-                   MEGNet feature bond.
+    cutoff-                 MEGNet radial cutoff.
+    width-                  MEGNet gaussian width.
+
+    Outputs:
+    1-                      Files of the graph caches.
+    """
+    graph_converter = crystal_graph(bond, cutoff, width)
+    converted = {}
+    filenames = [ ]
+    for prop in properties:
+        logging.info("Caching the graphs of the %s structures ..." %prop)
+        filename = graph_cache_path(prop, bond, cutoff, width)
+        cache = load_graph_cache(filename)
+        ncached = len(cache)
+        converted.update(cache)
+        for structure in read_inputs(find_data(prop), prop)[0]:
+            key = structure_key(structure)
+            if key not in cache:
+                cache[key] = graph_input(structure, graph_converter, converted)
+        print("Number of %s graphs added = %s, reused = %s" %(prop, len(cache) - ncached,
+                                                             ncached))
+        if len(cache) > ncached:
+            save_graph_cache(filename, cache)
+        filenames.append(filename)
+    return filenames
+
+
+@timed
+def megnet_input(prop, ZeroVals, bond, nfeat_global, cutoff, width, *fraction, cache=False):
+    """
+    megnet_input(prop, ZeroVals, bond, nfeat_global, cutoff, width, *fraction, cache)
 
     Extracts valid structures and targets and splits them into user specified
     datsets. 
 
     Inputs:
-    prop-                   Optical property of interest. 
+    prop-                   Optical property of interest. A list of 
+                            properties gives the structures shared by 
+                            their datasets with one target column per 
+                            property.
     ZeroVals-               Exclude/Include zero optical property values.
+                            With several properties, a structure is 
+                            excluded if any of its values is zero.
     bond-                   MEGNet feature bond.
     nfeat_global-           MEGNet feature global.
     cutoff-                 MEGNet MEGNet radial cutoff. 
@@ -134,6 +406,7 @@ def megnet_input(prop, ZeroVals, bond, nfeat_global, cutoff, width, *fraction):
     *fraction-              Fraction of data to split into training and 
                             validation sets. Passing an extra argument to 
                             split data based on quantity is permissible.
+    cache-                  Reuse and update the graph cache.
 
     Outputs:
     1-                      Featurised structures for training with 
@@ -147,39 +420,58 @@ def megnet_input(prop, ZeroVals, bond, nfeat_global, cutoff, width, *fraction):
     print("Global features = ", nfeat_global)
     print("Radial cutoff = ", cutoff)
     print("Gaussian width = ", width)
-    gaussian_centers = np.linspace(0, cutoff, bond)
-    distance_converter = GaussianDistance(gaussian_centers, width)
-    graph_converter = CrystalGraph(bond_converter=distance_converter)
-    model = MEGNetModel(bond, nfeat_global, graph_converter=graph_converter)
+    cache_file = graph_cache_path(prop, bond, cutoff, width)
+    if isinstance(prop, str):
+        source = find_data(prop)
+        structures, targets = read_inputs(source, prop)
+        source_idx = np.arange(len(targets))
+    else:
+        source = find_data(prop[0])
+        structures, targets, source_idx = aligned_inputs(prop)
+        prop = ", ".join(prop)
+    targets = np.asarray(targets, dtype=np.float64)
+    model, graph_converter = build_model(bond, nfeat_global, cutoff, width,
+                                         1 if targets.ndim == 1 else targets.shape[1])
 
-    datafile = "%s_data.pkl" %prop
-    inputs = pd.read_pickle(datafile)
-    print("\nNumber of input entries found for %s data = %s" %(prop, len(inputs)))
+    print("\nNumber of input entries found for %s data = %s" %(prop, len(targets)))
     if ZeroVals == False:
         logging.info("Excluding zero optical property values from the dataset ...")
-        mask = np.array([i for i,val in enumerate(inputs[prop]) if abs(val) == 0.])
-        structures = np.delete(inputs["structure"].to_numpy(), mask)
-        targets = np.delete(inputs[prop].to_numpy(), mask)
-        print("Remaining number of entries = %s" %len(targets))
+        mask = targets != 0. if targets.ndim == 1 else np.all(targets != 0., axis=1)
+        print("Remaining number of entries = %s" %np.count_nonzero(mask))
     else:
         logging.info("Zero optical property values will be included ...")
-        structures = inputs["structure"].to_numpy()
-        targets = inputs[prop].to_numpy()        
+        mask = np.ones(len(targets), dtype=bool)
         
-    # Get the valid structures and targets i.e exclude isolated atoms
+    # Get the valid structures and targets i.e exclude isolated atoms.
+    # The valid structures are held in a single backing array and the 
+    # returned splits are views into it
     logging.info("Obtaining valid structures and targets ...")    
-    valid_structures = [ ]
-    valid_targets = [ ]
+    candidates = np.flatnonzero(mask)
+    backing = np.empty(len(candidates), dtype=object)
     activations_input_full = [ ]
-    for s, t in zip(structures, targets):
-        try:
-            activations_input_full.append(StructureGraph.get_input(graph_converter, s))
-        except:
-            print("Skipping structure with isolated atom ...")
-            continue
-        valid_structures.append(s)
-        valid_targets.append(t)
-    print("Number of invalid structures = %s" %(len(targets)-len(valid_targets)))
+    if cache:
+        graphs = load_graph_cache(cache_file)
+        ncached = len(graphs)
+    else:
+        graphs = None
+    with stage("graph_conversion"):
+        for k, i in enumerate(candidates):
+            structure = structures[i]
+            graph = graph_input(structure, graph_converter, graphs)
+            if graph is None:
+                print("Skipping structure with isolated atom ...")
+                mask[i] = False
+                continue
+            activations_input_full.append(graph)
+            backing[k] = structure
+    if cache and len(graphs) > ncached:
+        save_graph_cache(cache_file, graphs)
+    valid_idx = np.flatnonzero(mask)
+    valid_structures = backing[mask[candidates]]
+    valid_targets = targets[valid_idx]
+    # The splits are saved as indices into the source dataset
+    register_source(source, valid_structures, source_idx[valid_idx])
+    print("Number of invalid structures = %s" %(len(candidates)-len(valid_idx)))
     print("\nTotal number of entries available for analysis = %s" %len(valid_targets))
 
     pool_frac = fraction[0][0]    
@@ -194,10 +486,10 @@ def megnet_input(prop, ZeroVals, bond, nfeat_global, cutoff, width, *fraction):
         
             # Data split is based on percentages
             pool_boundary = int(len(valid_targets)*pool_frac)    
-            Xpool = np.array(valid_structures[0:pool_boundary])
-            ypool = np.array(valid_targets[0:pool_boundary])
-            Xtest = np.array(valid_structures[pool_boundary:])
-            ytest = np.array(valid_targets[pool_boundary:])
+            Xpool = valid_structures[:pool_boundary]
+            ypool = valid_targets[:pool_boundary]
+            Xtest = valid_structures[pool_boundary:]
+            ytest = valid_targets[pool_boundary:]
 
             logging.info("The pool is the same as the training set ...")
             print("Pool:", ypool.shape)
@@ -213,10 +505,10 @@ def megnet_input(prop, ZeroVals, bond, nfeat_global, cutoff, width, *fraction):
             test_frac = np.round(1 - pool_frac, decimals=2)
             
             pool_boundary = int(len(valid_targets)*pool_frac)
-            Xpool = np.array(valid_structures[0:pool_boundary])
-            ypool = np.array(valid_targets[0:pool_boundary])
-            Xtest = np.array(valid_structures[pool_boundary:])
-            ytest = np.array(valid_targets[pool_boundary:])
+            Xpool = valid_structures[:pool_boundary]
+            ypool = valid_targets[:pool_boundary]
+            Xtest = valid_structures[pool_boundary:]
+            ytest = valid_targets[pool_boundary:]
             
             val_boundary = int(pool_boundary * val_frac)
             Xtrain = Xpool[:-val_boundary]
@@ -238,5 +530,5 @@ def megnet_input(prop, ZeroVals, bond, nfeat_global, cutoff, width, *fraction):
     else:
         return ( model,
                  activations_input_full,
-                 np.array(valid_structures),
-                 np.array(valid_targets) )
+                 valid_structures,
+                 valid_targets )
@@ -0,0 +1,275 @@
+"""
+instrument.py, SciML-SCD, RAL
+
+Lightweight instrumentation of the stages of a run. A stage records
+its number of calls, its total wall time and the peak resident set
+size (RSS) of the process while it ran. The RSS is sampled by a
+background thread only while a stage is active. Counters record
+quantities such as the number of Cholesky factorisations and the
+largest kernel matrix. The profile of a run is written as JSON.
+
+Selected stages can also be profiled with cProfile, and with the
+TensorFlow profiler for the MEGNet training and GP optimisation
+stages. Profiling is off unless enable_profiling is called.
+
+Stages are wrapped with the timed decorator or the stage context
+manager:
+
+    @timed
+    def megnet_input(...):
+
+    with stage("graph_conversion"):
+        ...
+"""
+import contextlib
+import cProfile
+import fnmatch
+import functools
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+# Interval between two samples of the RSS in seconds
+SAMPLE_INTERVAL = 0.1
+
+_stages = {}
+_counters = {}
+_active = [ ]
+_lock = threading.Lock()
+_sampler = None
+_start = time.time()
+
+# Stages also traced with the TensorFlow profiler when profiled
+TRACED = ("training.*", "adam.*", "multitask.*")
+
+_profiling = {"patterns": (), "directory": "profile", "calls": {}, "tracing": False}
+# cProfile only sees the thread it runs in, so each thread, e.g. the
+# background writer running plot.*, profiles its own stages
+_thread = threading.local()
+
+
+def current_rss():
+    """
+    current_rss()
+
+    Outputs:
+    1-          Resident set size of the process in MB. The peak RSS of
+                the process is returned where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024.**2
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _sample():
+    """ Updates the peak RSS of the active stages until none is left """
+    while True:
+        rss = current_rss()
+        with _lock:
+            if not _active:
+                global _sampler
+                _sampler = None
+                return
+            for record in _active:
+                record["peak_rss_mb"] = max(record["peak_rss_mb"], rss)
+        time.sleep(SAMPLE_INTERVAL)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    stage(name)
+
+    Context manager recording the wall time and peak RSS of a stage.
+    Nested stages are recorded separately and both include the time of
+    the inner stage.
+
+    Inputs:
+    name-       Name of the stage in the profile.
+    """
+    global _sampler
+    rss = current_rss()
+    with _lock:
+        record = _stages.setdefault(name, {"calls": 0, "seconds": 0., "peak_rss_mb": 0.})
+        record["peak_rss_mb"] = max(record["peak_rss_mb"], rss)
+        _active.append(record)
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample, daemon=True)
+            _sampler.start()
+    start = time.perf_counter()
+    try:
+        if _profiling["patterns"]:
+            with _profiler(name):
+                yield record
+        else:
+            yield record
+    finally:
+        with _lock:
+            record["calls"] += 1
+            record["seconds"] += time.perf_counter() - start
+            _active.remove(record)
+
+
+def enable_profiling(patterns, directory="profile"):
+    """
+    enable_profiling(patterns, directory)
+
+    Inputs:
+    patterns-   Stages to be profiled, as shell-style patterns of their
+                names, e.g. adam.* or graph_conversion. None => no
+                profiling.
+    directory-  Directory into which the profiles are written.
+    """
+    _profiling["patterns"] = tuple(patterns or ())
+    _profiling["directory"] = directory
+
+
+def _start_trace(logdir):
+    """
+    _start_trace(logdir)
+
+    Starts the TensorFlow profiler. tf.profiler.experimental appears in
+    TensorFlow 2.2, so older versions trace through tf.summary.
+
+    Outputs:
+    1-          Function stopping the trace and writing it into logdir.
+    """
+    import tensorflow as tf
+
+    if hasattr(tf.profiler, "experimental") and hasattr(tf.profiler.experimental, "start"):
+        tf.profiler.experimental.start(logdir)
+        return tf.profiler.experimental.stop
+    if hasattr(tf.summary, "trace_on"):
+        tf.summary.trace_on(graph=True, profiler=True)
+
+        def stop():
+            with tf.summary.create_file_writer(logdir).as_default():
+                tf.summary.trace_export(os.path.basename(logdir), step=0,
+                                        profiler_outdir=logdir)
+        return stop
+    logging.warning("The TensorFlow profiler is not available, profiling with cProfile only ...")
+    return lambda: None
+
+
+@contextlib.contextmanager
+def _profiler(name):
+    """
+    _profiler(name)
+
+    Profiles a stage with cProfile into <directory>/<name>_<call>.prof
+    and, for the stages in TRACED, traces it with the TensorFlow
+    profiler into <directory>/<name>_<call>_trace. Stages nested in a
+    profiled stage of the same thread are included in its profile only.
+    The TensorFlow profiler traces the whole process, so a stage starting
+    while another thread traces is only profiled with cProfile.
+    """
+    if getattr(_thread, "active", False) or not any(fnmatch.fnmatchcase(name, pattern)
+                                                    for pattern in _profiling["patterns"]):
+        yield
+        return
+    trace = any(fnmatch.fnmatchcase(name, pattern) for pattern in TRACED)
+    with _lock:
+        call = _profiling["calls"][name] = _profiling["calls"].get(name, 0) + 1
+        if trace and _profiling["tracing"]:
+            logging.warning("%s starts while another stage is traced, profiling with cProfile only ..."
+                            %name)
+            trace = False
+        _profiling["tracing"] = _profiling["tracing"] or trace
+    filename = os.path.join(_profiling["directory"], "%s_%s" %(name, call))
+    os.makedirs(_profiling["directory"], exist_ok=True)
+    if trace:
+        stop_trace = _start_trace("%s_trace" %filename)
+    profiler = cProfile.Profile()
+    _thread.active = True
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _thread.active = False
+        if trace:
+            stop_trace()
+            _profiling["tracing"] = False
+        profiler.dump_stats("%s.prof" %filename)
+        print("Profile of %s written to %s.prof" %(name, filename))
+
+
+def timed(func):
+    """
+    timed(func)
+
+    Decorator recording every call of func as a stage named after its
+    qualified name, e.g. adam.active.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(func.__qualname__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def count(name, n=1):
+    """
+    count(name, n)
+
+    Inputs:
+    name-       Name of the counter.
+    n-          Increment.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def maximum(name, value):
+    """
+    maximum(name, value)
+
+    Inputs:
+    name-       Name of the counter keeping the largest value seen.
+    value-      Value to compare.
+    """
+    with _lock:
+        _counters[name] = max(_counters.get(name, value), value)
+
+
+def profile():
+    """
+    profile()
+
+    Outputs:
+    1-          Dictionary of the stages, counters, wall time and peak
+                RSS of the process since the last reset.
+    """
+    with _lock:
+        return {"wall_seconds": time.time() - _start,
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+                "stages": {name: dict(record) for name, record in _stages.items()},
+                "counters": dict(_counters)}
+
+
+def reset():
+    """ Clears the stages and counters, e.g. between properties """
+    global _start
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _start = time.time()
+
+
+def write_profile(filename):
+    """
+    write_profile(filename)
+
+    Inputs:
+    filename-   File of the profile in JSON format.
+    """
+    if os.path.dirname(filename) and not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, "w") as f:
+        json.dump(profile(), f, indent=2, sort_keys=True)
+    print("Profile of the run written to %s" %filename)
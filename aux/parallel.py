@@ -0,0 +1,112 @@
+"""
+parallel.py, SciML-SCD, RAL
+
+Runs the folds of k-fold cross-validation concurrently in a pool of
+processes. Each worker builds a fresh MEGNet model for every fold and
+the GP of every fold starts from the -amp and -length priors, whereas
+a sequential run carries the weights of the model and the optimised
+hyperparameters from one fold to the next, so the results differ from
+those of a sequential run. The cores of the node are shared evenly
+between the workers and the workers share the GPUs.
+"""
+import logging
+import multiprocessing
+import os
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
+                    format="%(levelname)s:gp-net: %(message)s")
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from aux.resources import (threads_per_worker, thread_limits, limit_tensorflow, configure,
+                           share_gpus)
+from aux.dataset import source_index, set_source_index
+from aux import writer
+
+# Inputs shared by all the folds run by a worker
+_shared = {}
+
+
+def _init_worker(threads, settings, shared):
+    """ Limits the threads of the worker and keeps the shared inputs """
+    configure(threads, 1)
+    limit_tensorflow(threads)
+    share_gpus()
+    set_source_index(shared.pop("source"))
+    _shared.update(shared)
+    _shared["settings"] = settings
+
+
+def _run_fold(fold, train_idx, val_idx):
+    """
+    _run_fold(fold, train_idx, val_idx)
+
+    MEGNet training, latent extraction and GP fitting of one fold.
+
+    Outputs:
+    1-          Output of adam.k_fold converted to NumPy.
+    """
+    from aux.get_info import build_model
+    from aux.activations import latent
+    from train.MEGNetTrain import training
+    from optimizers.adam import adam
+
+    s = _shared["settings"]
+    Xpool, ypool = _shared["Xpool"], _shared["ypool"]
+    datadir = "k_fold/%s_results/0%s_fold" %(s["prop"], fold)
+
+    if not s["nomeg"] and s["epochs"] > 0:
+        print("\nTraining MEGNet on fold %s training set ..." %fold)
+        model = build_model(s["bond"], s["nfeat_global"], s["cutoff"], s["width"])[0]
+        training.k_fold(datadir, fold, s["prop"], False, model, s["batch"], s["epochs"],
+                        Xpool[train_idx], ypool[train_idx], Xpool[val_idx], ypool[val_idx],
+                        _shared.get("graphs"), s["maxatoms"])
+
+    logging.info("Obtaining latent points for fold %s ..." %fold)
+    latent_train, latent_val, latent_test = latent.k_fold(
+        datadir, fold, s["prop"], s["layer"], _shared["activations_input_full"], train_idx,
+        val_idx, Xpool, s["perp"], s["ndims"], s["niters"], s["reducer"], s["landmarks"],
+        _shared["yfull"], s["maxatoms"])
+
+    logging.info("Gaussian Process initiated for fold %s ..." %fold)
+    result = adam.k_fold(datadir, s["prop"], latent_train, latent_val, latent_test,
+                         ypool[train_idx], ypool[val_idx], _shared["ytest"], s["maxiters"],
+                         s["amp"], s["length_scale"], s["rate"])
+    # Workers exit without running atexit so the fold is flushed here
+    writer.flush()
+    return tuple(None if value is None else np.asarray(value) for value in result)
+
+
+def run_folds(folds, workers, settings, **shared):
+    """
+    run_folds(folds, workers, settings, **shared)
+
+    Inputs:
+    folds-          List of the training and validation indices of each
+                    fold into the pool.
+    workers-        Number of concurrent workers.
+    settings-       Dictionary of the MEGNet, latent and GP parameters:
+                    prop, nomeg, epochs, batch, bond, nfeat_global,
+                    cutoff, width, layer, perp, ndims, niters, reducer,
+                    landmarks, maxatoms, maxiters, amp, length_scale
+                    and rate.
+    **shared-       Xpool, ypool, ytest, activations_input_full, yfull
+                    and graphs, sent once to each worker.
+
+    Outputs:
+    1-              Output of adam.k_fold for each fold in fold order.
+    """
+    workers = min(workers, len(folds))
+    threads = threads_per_worker(workers)
+    print("Running %s folds on %s workers with %s threads each ..." %(len(folds), workers,
+                                                                       threads))
+    # TensorFlow is not fork-safe so the workers are spawned
+    context = multiprocessing.get_context("spawn")
+    with thread_limits(threads):
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(threads, settings,
+                                           dict(shared, source=source_index()))) as executor:
+            futures = [executor.submit(_run_fold, fold, train_idx, val_idx)
+                       for fold, (train_idx, val_idx) in enumerate(folds)]
+            return [future.result() for future in futures]
@@ -20,8 +20,11 @@ import matplotlib
 matplotlib.use("agg")
 import matplotlib.pyplot as plt
 
+from aux.instrument import timed
+
 class plot:
 
+    @timed
     def train_test_split(datadir, prop, layer, maxiters, rate, OptLoss, OptAmp,
                          OptLength, ytest_dft, gp_mean, gp_stddev, best_mae_fold,
                          mae_test_fold, Optmae, Optmse, Optsae, R):
@@ -430,6 +433,7 @@ class plot:
         plt.savefig("%s/HyperParam_%s.pdf" %(datadir, prop))
 
 
+    @timed
     def active(datadir, prop, layer, maxiters, rate, OptLoss, OptAmp, OptLength,
                sampling, query, training_data, ytest_dft, gp_mean, gp_stddev,
                Optmae_val_cycle, mae_test_cycle, mae_test, mse_test, sae_test, R):
@@ -705,6 +709,7 @@ class plot:
         plt.savefig("%s/active_learn_%s.pdf" %(datadir, prop)) 
 
 
+    @timed
     def norepeat(datadir, prop, layer, sampling, query, maxiters):
         """
         plot.norepeat(datadir, prop, layer, sampling, query, maxiters)
@@ -725,16 +730,18 @@ class plot:
         1-                  Figures showing the performance of the active learning 
                             experiment.
         """
-        import os 
         from scipy.stats import pearsonr
-
-        ytest_dft = np.load("%s/ytest.npy" %datadir)
-        gp_mean = np.load("%s/gp_mean.npy" %datadir)
-        gp_stddev = np.load("%s/gp_stddev.npy" %datadir)
-        mae_test_cycle = np.load("%s/gp_mae.npy" %datadir)
-        mse_test_cycle = np.load("%s/gp_mse.npy" %datadir)[np.argmin(mae_test_cycle)]
-        sae_test_cycle  = np.load("%s/gp_sae.npy" %datadir)[np.argmin(mae_test_cycle)]
-        training_data = np.load("%s/training_data_for_plotting.npy" %datadir)
+        from aux.results import load_results, has_result
+
+        results = load_results(datadir, "ytest", "gp_mean", "gp_stddev", "gp_mae", "gp_mse",
+                               "gp_sae", "training_data_for_plotting")
+        ytest_dft = results["ytest"]
+        gp_mean = results["gp_mean"]
+        gp_stddev = results["gp_stddev"]
+        mae_test_cycle = results["gp_mae"]
+        mse_test_cycle = results["gp_mse"][np.argmin(mae_test_cycle)]
+        sae_test_cycle  = results["gp_sae"][np.argmin(mae_test_cycle)]
+        training_data = results["training_data_for_plotting"]
         
         residuals = ytest_dft - gp_mean
         rmse = np.sqrt(mse_test_cycle) 
@@ -827,10 +834,9 @@ class plot:
         plt.figure(figsize=[30, 20])
         plt.suptitle("GP results of %s layer for %s \nType of sampling: %s \nSamples per query = %s"
                      %(layer, prop, sampling, query), fontsize=20)
-        if os.path.isfile("%s/OptLoss.npy" %datadir):
-            OptLoss = np.load("%s/OptLoss.npy" %datadir)
-            OptAmp = np.load("%s/OptAmp.npy" %datadir)
-            OptLength = np.load("%s/OptLength.npy" %datadir)
+        if has_result(datadir, "OptLoss"):
+            OptLoss, OptAmp, OptLength = load_results(datadir, "OptLoss", "OptAmp",
+                                                      "OptLength").values()
             
             plt.subplot(421)
             plt.plot(OptLoss, "r")
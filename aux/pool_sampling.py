@@ -5,65 +5,468 @@ Samples data from the test set and transfers them
 into the training set for the purposes of active 
 learning. Go to https://www.kdnuggets.com/2018/10/introduction-active-learning.html
 for other means of sampling. 
+
+The training, validation and candidate sets are tracked by index 
+into the full dataset, so an acquisition does not copy any data.
+
+The acquisition functions of the registry ACQUISITIONS score the
+candidates from the GP posterior mean and variance and are evaluated
+chunk by chunk on chunked predictions.
 """
+import logging
+import os
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
+                    format="%(levelname)s:gp-net: %(message)s")
 
 import numpy as np
 
+from aux.instrument import timed
+
+
+def entropy(mean, variance, **params):
+    """
+    entropy(mean, variance)
+
+    The entropy of a Gaussian is monotonic in its variance so the 
+    variance is used as the score.
+    """
+    return np.array(variance, dtype=np.float64)
+
+
+def ucb(mean, variance, kappa=2., **params):
+    """
+    ucb(mean, variance, kappa)
+
+    Upper confidence bound, mean + kappa * standard deviation.
+    """
+    return mean + kappa * np.sqrt(variance)
+
+
+def expected_improvement(mean, variance, best=None, target=None, **params):
+    """
+    expected_improvement(mean, variance, best, target)
+
+    Closed-form expected improvement. Without a target, the 
+    improvement is over the highest training value. With a target, 
+    the improvement is the reduction of the distance |y - target| 
+    below that of the closest training value, best. This is a 
+    triangular function of y, so its expectation is a combination of 
+    three Gaussian ramp expectations.
+    """
+    from scipy.special import ndtr
+
+    std = np.maximum(np.sqrt(variance), 1e-12)
+
+    def ramp(shift):
+        # E[max(y - shift, 0)] for y ~ N(mean, variance)
+        z = (mean - shift) / std
+        return (mean - shift) * ndtr(z) + std * np.exp(-0.5 * z**2) / np.sqrt(2 * np.pi)
+
+    if target is None:
+        return ramp(best)
+    return ramp(target - best) - 2 * ramp(target) + ramp(target + best)
+
+
+# Acquisition functions accepted by -samp besides random
+# BALD is not included: with the homoscedastic noise of the GP, the
+# mutual information 0.5 log(1 + variance / noise) ranks the candidates
+# exactly as entropy does
+ACQUISITIONS = {"entropy": entropy, "ucb": ucb, "ei": expected_improvement}
+
+
+def acquisition_scores(acquisition, predictions, ytrain=None, **params):
+    """
+    acquisition_scores(acquisition, predictions, ytrain, **params)
+
+    Generator over the scores of chunks of candidates.
+
+    Inputs:
+    acquisition-        Name of the acquisition function in ACQUISITIONS.
+    predictions-        Iterable of the posterior mean and variance of 
+                        chunks of candidates.
+    ytrain-             Targets of the training set. Required by ei.
+    **params-           kappa for ucb and target for ei.
+
+    Outputs:
+    1-                  Scores of each chunk.
+    """
+    score = ACQUISITIONS[acquisition]
+    if acquisition == "ei":
+        ytrain = np.asarray(ytrain, dtype=np.float64)
+        if params.get("target") is None:
+            params["best"] = ytrain.max()
+        else:
+            params["best"] = np.abs(ytrain - params["target"]).min()
+    for mean, variance in predictions:
+        yield score(np.asarray(mean, dtype=np.float64), np.asarray(variance, dtype=np.float64),
+                    **params)
+
+
+def top_k(scores, k):
+    """
+    top_k(scores, k)
+
+    Partial selection of the k highest scores with argpartition 
+    followed by a sort of the k selected scores only. 
+
+    Inputs:
+    scores-             Scores of the candidates.
+    k-                  Number of candidates to select.
+
+    Outputs:
+    1-                  Positions of the k highest scores in 
+                        descending order of score.
+    """
+    scores = np.asarray(scores)
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=int)
+    idx = np.argpartition(scores, len(scores) - k)[len(scores) - k:]
+    return idx[np.argsort(scores[idx])[::-1]]
+
+
+class StreamingTopK:
+
+    def __init__(self, k):
+        """
+        StreamingTopK(k)
+
+        Keeps the k highest scores over chunks of scores so that the 
+        scores of all candidates are never held in memory at once.
+
+        Inputs:
+        k-                  Number of candidates to select.
+        """
+        self.k = k
+        self.scores = np.array([])
+        self.idx = np.array([], dtype=int)
+        self.seen = 0
+
+    def update(self, scores):
+        """
+        topk.update(scores)
+
+        Inputs:
+        scores-             Scores of the next chunk of candidates.
+        """
+        scores = np.asarray(scores)
+        self.scores = np.concatenate((self.scores, scores))
+        self.idx = np.concatenate((self.idx, self.seen + np.arange(len(scores))))
+        self.seen += len(scores)
+        best = top_k(self.scores, self.k)
+        self.scores = self.scores[best]
+        self.idx = self.idx[best]
+
+    def result(self):
+        """
+        topk.result()
+
+        Outputs:
+        1-                  Positions of the k highest scores over all
+                            chunks in descending order of score.
+        """
+        return self.idx
+
+
+def select_top(scores, k):
+    """
+    select_top(scores, k)
+
+    Inputs:
+    scores-             Scores of the candidates as an array, or an 
+                        iterable of chunks of scores in candidate order.
+    k-                  Number of candidates to select.
+
+    Outputs:
+    1-                  Positions of the k highest scores in descending
+                        order of score.
+    """
+    if isinstance(scores, np.ndarray):
+        return top_k(scores, k)
+    topk = StreamingTopK(k)
+    for chunk in scores:
+        topk.update(chunk)
+    return topk.result()
+
+
+def sequential_batch(posterior, latent, query, score, noise=1e-6, chunk=10000):
+    """
+    sequential_batch(posterior, latent, query, score, noise, chunk)
+
+    Greedy batch construction in which each selected candidate is 
+    treated as observed at its posterior mean (kriging believer). The 
+    posterior mean is then unchanged while the variance of every 
+    candidate is reduced by a rank-1 update, so redundant neighbours 
+    of a selected candidate lose their score. With the variance as 
+    the score this is the greedy MAP of the determinantal point 
+    process whose kernel is the posterior covariance.
+
+    Inputs:
+    posterior-          GP posterior of the training set.
+    latent-             Latent points of the candidates.
+    query-              Number of candidates to select.
+    score-              Function of the posterior mean and variance 
+                        returning the score of each candidate.
+    noise-              Observation noise of the believed values.
+    chunk-              Number of candidates processed at a time.
+
+    Outputs:
+    1-                  Positions of the selected candidates in order
+                        of selection.
+    """
+    predictions = list(posterior.predict_chunks(latent, chunk=chunk))
+    mean = np.concatenate([m for m, _ in predictions])
+    variance = np.concatenate([v for _, v in predictions])
+    query = min(query, len(variance))
+
+    factors = np.zeros((query, len(variance)))
+    selected = [ ]
+    for j in range(query):
+        scores = np.array(score(mean, variance), dtype=np.float64)
+        scores[selected] = -np.inf
+        x = int(np.argmax(scores))
+        column = np.concatenate([posterior.covariance(latent[start:start+chunk], latent[x:x+1])[:,0]
+                                 for start in range(0, len(variance), chunk)])
+        column -= factors[:j].T @ factors[:j, x]
+        factors[j] = column / np.sqrt(column[x] + noise)
+        variance = np.maximum(variance - factors[j]**2, 0.)
+        selected.append(x)
+    return np.array(selected, dtype=int)
+
+
+def dpp_batch(posterior, latent, query, chunk=10000):
+    """
+    dpp_batch(posterior, latent, query, chunk)
+
+    Greedy MAP selection of a k-DPP with the quality-diversity kernel
+    L = diag(q) S diag(q), where the quality q of a candidate is its 
+    posterior standard deviation and S is the kernel correlation 
+    between candidates. The Cholesky factor of the selected submatrix 
+    is grown by one row per selection so only one column of S is 
+    computed per selected candidate.
+
+    Inputs:
+    posterior-          GP posterior of the training set.
+    latent-             Latent points of the candidates.
+    query-              Number of candidates to select.
+    chunk-              Number of candidates processed at a time.
+
+    Outputs:
+    1-                  Positions of the selected candidates in order
+                        of selection. Once no candidate has a positive
+                        marginal gain, the batch is filled with the
+                        candidates of highest quality.
+    """
+    from optimizers.posterior import matern_one_half
+
+    variance = np.concatenate([v for _, v in posterior.predict_chunks(latent, chunk=chunk)])
+    quality = np.sqrt(variance)
+    gain = variance.copy()
+    query = min(query, len(variance))
+
+    factors = np.zeros((query, len(variance)))
+    selected = [ ]
+    for j in range(query):
+        scores = gain.copy()
+        scores[selected] = -np.inf
+        x = int(np.argmax(scores))
+        if gain[x] <= 0.:
+            break
+        correlation = np.concatenate([matern_one_half(latent[start:start+chunk], latent[x:x+1],
+                                                      1., posterior.length_scale)[:,0]
+                                      for start in range(0, len(variance), chunk)])
+        column = quality * correlation * quality[x]
+        column -= factors[:j].T @ factors[:j, x]
+        factors[j] = column / np.sqrt(gain[x])
+        gain = np.maximum(gain - factors[j]**2, 0.)
+        selected.append(x)
+    if len(selected) < query:
+        # No candidate adds diversity, e.g. duplicated latent points
+        logging.warning("DPP selected %s of %s candidates, the rest are the most uncertain ..."
+                        %(len(selected), query))
+        remaining = np.setdiff1d(np.arange(len(variance)), selected)
+        selected += remaining[np.argsort(-quality[remaining], kind="stable")][
+            :query - len(selected)].tolist()
+    return np.array(selected, dtype=int)
+
+
+def variance_reduction_batch(posterior, latent, query, shortlist=None, noise=1e-6):
+    """
+    variance_reduction_batch(posterior, latent, query, shortlist, noise)
+
+    Greedy batch construction which selects the candidate whose 
+    observation most reduces the total posterior variance of the 
+    shortlisted candidates. The posterior covariance of the shortlist 
+    is downdated by a rank-1 update after each selection.
+
+    Inputs:
+    posterior-          GP posterior of the training set.
+    latent-             Latent points of the candidates.
+    query-              Number of candidates to select.
+    shortlist-          Number of highest-variance candidates 
+                        considered. [default: 10 x query]
+    noise-              Observation noise of the selected candidates.
+
+    Outputs:
+    1-                  Positions of the selected candidates in order
+                        of selection.
+    """
+    variance = np.concatenate([v for _, v in posterior.predict_chunks(latent)])
+    shortlist = top_k(variance, shortlist or 10 * query)
+    covariance = posterior.covariance(latent[shortlist], latent[shortlist])
+    query = min(query, len(shortlist))
+
+    selected = [ ]
+    for j in range(query):
+        reduction = (covariance**2).sum(axis=0) / (np.diag(covariance) + noise)
+        reduction[selected] = -np.inf
+        x = int(np.argmax(reduction))
+        column = covariance[:, x].copy()
+        covariance -= np.outer(column, column) / (column[x] + noise)
+        selected.append(x)
+    return shortlist[selected]
+
+
+class Pool:
+
+    # Status of each sample in the full dataset
+    UNUSED = -1
+    TRAIN = 0
+    VAL = 1
+    CANDIDATE = 2
+    ACQUIRED = 3
+
+    def __init__(self, nsamples, train_idx, val_idx, candidate_idx):
+        """
+        Pool(nsamples, train_idx, val_idx, candidate_idx)
+
+        Tracks the partition of the full dataset into the training, 
+        validation and candidate (test) sets with a single status array. 
+        An acquisition flips the status of the acquired candidates, and 
+        the indices of each partition are produced on demand. 
+
+        Inputs:
+        nsamples-           Size of the full dataset.
+        train_idx-          Indices of the training set.
+        val_idx-            Indices of the validation set.
+        candidate_idx-      Indices of the candidate (test) set.
+        """
+        self.status = np.full(nsamples, Pool.UNUSED, dtype=np.int8)
+        self.status[train_idx] = Pool.TRAIN
+        self.status[val_idx] = Pool.VAL
+        self.status[candidate_idx] = Pool.CANDIDATE
+        self.acquired = np.array([], dtype=int)
+        self._indices = {}
+
+    def indices(self, *statuses):
+        """
+        pool.indices(*statuses)
+
+        Inputs:
+        *statuses-          Statuses of interest.
+
+        Outputs:
+        1-                  Sorted indices of the samples in the full 
+                            dataset holding any of the statuses.
+        """
+        if statuses not in self._indices:
+            self._indices[statuses] = np.flatnonzero(np.isin(self.status, statuses))
+        return self._indices[statuses]
+
+    @property
+    def train(self):
+        """ Training set including the acquired samples """
+        return self.indices(Pool.TRAIN, Pool.ACQUIRED)
+
+    @property
+    def val(self):
+        return self.indices(Pool.VAL)
+
+    @property
+    def candidates(self):
+        return self.indices(Pool.CANDIDATE)
+
+    @property
+    def pool(self):
+        """ Training set followed by the validation set """
+        return np.concatenate((self.train, self.val))
+
+    def acquire(self, idx):
+        """
+        pool.acquire(idx)
+
+        Moves candidates into the training set. 
+
+        Inputs:
+        idx-                Positions in the current candidate set 
+                            of the samples to be acquired.
+
+        Outputs:
+        1-                  Indices of the acquired samples in the 
+                            full dataset.
+        """
+        acquired = self.candidates[idx]
+        self.status[acquired] = Pool.ACQUIRED
+        self.acquired = np.concatenate((self.acquired, acquired))
+        self._indices.clear()
+        return acquired
+
+    def restore(self, status, acquired):
+        """
+        pool.restore(status, acquired)
+
+        Inputs:
+        status-             Status of each sample in the full dataset.
+        acquired-           Indices of the acquired samples in order of
+                            acquisition.
+        """
+        self.status[:] = status
+        self.acquired = np.asarray(acquired, dtype=int)
+        self._indices.clear()
+
+
 class selection_fn:
 
-    def EntropySelection(i, Xtrain, ytrain, Xtest, ytest, Xval, yval,
-                         dft_variance, query, max_query):
+    @timed
+    def EntropySelection(i, pool, dft_variance, query, max_query):
         """
-        selection_fn.EntropySelection(i, Xtrain, ytrain, Xtest, ytest,
-                                      Xval, yval, dft_variance, query, 
-                                      max_query)
+        selection_fn.EntropySelection(i, pool, dft_variance, query, max_query)
 
         Sample selection based on the uncertainties obtained from the GP.
 
         Inputs:
         i-                  Number of active learning iterations
                             performed.
-        Xtrain-             Structures for training.
-        ytrain-             Targets for training 
-        Xtest-              Structures in test test.
-        ytest-              Targets in the test set.
-        Xval-               Structures in pool.
-        yval-               Targets in pool.
-        dft_variance-       Variance on the GP predicted values.
+        pool-               Pool of training, validation and candidate 
+                            (test) sets.
+        dft_variance-       Variance on the GP predicted values of the
+                            candidates, or an iterable of chunks of the 
+                            variance as produced by a chunked predictor.
         query-              Number of samples to move from the 
                             test set into the pool.
         max_query-          Maximum number of active learning 
                             iterations.
 
         Outputs
-        1-                  Updated pool, test sets and their 
-                            indices. 
+        1-                  Indices of the acquired samples in the 
+                            full dataset. 
         """
-        idx = (np.argsort(dft_variance)[::-1])[:query]
-
-        Xtrain = np.concatenate((Xtrain, Xtest[idx]))
-        ytrain = np.concatenate((ytrain, ytest[idx]))
-        
-        Xtest = np.delete(Xtest, idx, axis=0)
-        ytest = np.delete(ytest, idx, axis=0)
-
-        Xpool = np.concatenate((Xtrain, Xval))
-        ypool = np.concatenate((ytrain, yval))
+        idx = select_top(dft_variance, query)
+        acquired = pool.acquire(idx)
 
         if i < max_query:
             print("\nEntropy sampling ..")
-            print("Updated pool", ypool.shape)
-            print("Updated training set", ytrain.shape)
-            print("Updated test set:", ytest.shape)
+            print("Updated pool", pool.pool.shape)
+            print("Updated training set", pool.train.shape)
+            print("Updated test set:", pool.candidates.shape)
             
-        return idx, Xpool, ypool, Xtrain, ytrain, Xtest, ytest
+        return acquired
 
 
-    def RandomSelection(i, Xtrain, ytrain, Xtest, ytest, Xval, yval,
-                        dft_variance, query, max_query):
+    @timed
+    def RandomSelection(i, pool, dft_variance, query, max_query):
         """
-        selection_fn.RandomSelection(i, Xtrain, ytrain, Xtest, ytest, Xval, 
-                                     yval, dft_variance, query, max_query) 
+        selection_fn.RandomSelection(i, pool, dft_variance, query, max_query) 
 
         A random selection of samples. The uncertainties  obtained from the 
         GP do not really matter.
@@ -71,40 +474,114 @@ class selection_fn:
         Inputs:
         i-                  Number of active learning iterations
                             performed.
-        Xtrain-             Structures for training. 
-        ytrain-             Targets for training.
-        Xtest-              Structures in test set. 
-        ytest-              Targets in test set. 
-        Xval-               Structures in pool. 
-        yval-               Targets in pool. 
-        dft_variance-       Variance on the GP predicted values. 
+        pool-               Pool of training, validation and candidate 
+                            (test) sets.
+        dft_variance-       Variance on the GP predicted values of the
+                            candidates. 
         query-              Number of samples to move from the
                             test set into the pool.
         max_query-          Maximum number of active learning 
                             iterations.
 
         Outputs:
-        1-                  Updated pool, test sets and their 
-                            indices. 
+        1-                  Indices of the acquired samples in the 
+                            full dataset. 
         """
         np.random.seed(0)
         
-        idx = np.sort(np.random.choice(len(dft_variance), query,
+        idx = np.sort(np.random.choice(len(pool.candidates), query,
                                        replace=False))
-
-        Xtrain = np.concatenate((Xtrain, Xtest[idx]))
-        ytrain = np.concatenate((ytrain, ytest[idx]))
-
-        Xtest = np.delete(Xtest, idx, axis=0)
-        ytest = np.delete(ytest, idx, axis=0)
-                
-        Xpool = np.concatenate((Xtrain, Xval)) 
-        ypool = np.concatenate((ytrain, yval))
+        acquired = pool.acquire(idx)
 
         if i < max_query:
             print("\nRandom sampling ...")
-            print("Updated pool:", ypool.shape)
-            print("Updated training set", ytrain.shape)
-            print("Updated test set:", ytest.shape)
+            print("Updated pool:", pool.pool.shape)
+            print("Updated training set", pool.train.shape)
+            print("Updated test set:", pool.candidates.shape)
         
-        return idx, Xpool, ypool, Xtrain, ytrain, Xtest, ytest
+        return acquired
+
+
+    @timed
+    def BatchSelection(i, pool, method, posterior, latent_candidates, query, max_query,
+                       score=entropy):
+        """
+        selection_fn.BatchSelection(i, pool, method, posterior, latent_candidates,
+                                    query, max_query, score)
+
+        Batch selection which accounts for the redundancy between the 
+        selected samples so that a batch does not cluster in latent space. 
+
+        Inputs:
+        i-                  Number of active learning iterations
+                            performed.
+        pool-               Pool of training, validation and candidate 
+                            (test) sets.
+        method-             greedy => greedy reduction of the total 
+                            posterior variance, dpp => determinantal
+                            selection, believer => kriging believer.
+        posterior-          GP posterior of the training set.
+        latent_candidates-  Latent points of the candidates.
+        query-              Number of samples to move from the
+                            test set into the pool.
+        max_query-          Maximum number of active learning 
+                            iterations.
+        score-              Acquisition function of the posterior mean 
+                            and variance used by the kriging believer.
+
+        Outputs:
+        1-                  Indices of the acquired samples in the 
+                            full dataset. 
+        """
+        if method == "greedy":
+            idx = variance_reduction_batch(posterior, latent_candidates, query)
+        elif method == "dpp":
+            idx = dpp_batch(posterior, latent_candidates, query)
+        elif method == "believer":
+            idx = sequential_batch(posterior, latent_candidates, query, score)
+        acquired = pool.acquire(idx)
+
+        if i < max_query:
+            print("\nBatch sampling (%s) ..." %method)
+            print("Updated pool:", pool.pool.shape)
+            print("Updated training set", pool.train.shape)
+            print("Updated test set:", pool.candidates.shape)
+
+        return acquired
+
+
+    @timed
+    def AcquisitionSelection(i, pool, acquisition, scores, query, max_query):
+        """
+        selection_fn.AcquisitionSelection(i, pool, acquisition, scores, query, max_query)
+
+        Sample selection based on the scores of an acquisition function
+        of the registry.
+
+        Inputs:
+        i-                  Number of active learning iterations
+                            performed.
+        pool-               Pool of training, validation and candidate 
+                            (test) sets.
+        acquisition-        Name of the acquisition function.
+        scores-             Scores of the candidates, or an iterable of 
+                            chunks of scores from acquisition_scores.
+        query-              Number of samples to move from the 
+                            test set into the pool.
+        max_query-          Maximum number of active learning 
+                            iterations.
+
+        Outputs
+        1-                  Indices of the acquired samples in the 
+                            full dataset. 
+        """
+        idx = select_top(scores, query)
+        acquired = pool.acquire(idx)
+
+        if i < max_query:
+            print("\nAcquisition (%s) sampling .." %acquisition)
+            print("Updated pool", pool.pool.shape)
+            print("Updated training set", pool.train.shape)
+            print("Updated test set:", pool.candidates.shape)
+            
+        return acquired
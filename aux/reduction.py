@@ -0,0 +1,209 @@
+"""
+reduction.py, SciML-SCD, RAL
+
+Reduces the dimensions of the extracted activations. The exact
+tSNE from scikit-learn is used by default. For large datasets,
+backends that build the affinity graph from an approximate
+nearest-neighbour index and run multi-threaded gradients can be
+requested: openTSNE (FFT-accelerated tSNE) and UMAP (negative
+sampling). Both are optional dependencies.
+"""
+import sys
+import logging
+import os
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
+                    format="%(levelname)s:gp-net: %(message)s")
+
+import numpy as np
+
+from aux.instrument import timed
+from aux import resources
+
+# Backends accepted by -reducer
+REDUCERS = ("tsne", "fft-tsne", "umap")
+
+
+@timed
+def reduce_dimensions(activations, ndims, perp, niters, reducer="tsne", n_jobs=None):
+    """
+    reduce_dimensions(activations, ndims, perp, niters, reducer, n_jobs)
+
+    Reduces the dimensions of the activations with the requested backend.
+
+    Inputs:
+    activations-      Extracted activations of shape (samples, features).
+    ndims-            Dimensions of embedded space.
+    perp-             Perplexity value for tSNE analysis. For UMAP, this
+                      is used as the number of nearest neighbours.
+    niters-           The maximum number of iterations for tSNE
+                      optimisation.
+    reducer-          Backend for dimensionality reduction. One of tsne,
+                      fft-tsne or umap.
+    n_jobs-           Number of threads used by the backend. None => the
+                      threads of the run set in aux.resources.
+
+    Outputs:
+    1-                The embedded activations.
+    """
+    activations = np.asarray(activations)
+    n_jobs = n_jobs or resources.n_jobs()
+    if reducer == "tsne":
+        logging.info("Dimensionality reduction using tSNE begins ...")
+        print("Requested number of components = ", ndims)
+        print("Using max iterations = ", niters)
+        print("Processing perplexity = ", perp)
+        from sklearn.manifold import TSNE
+
+        return TSNE(n_components=ndims, n_iter=niters, n_jobs=n_jobs, random_state=0,
+                    perplexity=perp).fit_transform(activations)
+
+    elif reducer == "fft-tsne":
+        try:
+            from openTSNE import TSNE
+        except ImportError:
+            logging.error("openTSNE is required for -reducer fft-tsne. Install with pip install openTSNE!")
+            sys.exit()
+        logging.info("Dimensionality reduction using approximate-neighbour tSNE begins ...")
+        print("Requested number of components = ", ndims)
+        print("Using max iterations = ", niters)
+        print("Processing perplexity = ", perp)
+
+        # The interpolation grid of the FFT gradients is only available in
+        # one and two dimensions so fall back to Barnes-Hut for 3D embeddings
+        gradient = "fft" if ndims < 3 else "bh"
+        early_iters = min(250, niters)
+        embedding = TSNE(n_components=ndims, perplexity=perp, neighbors="approx",
+                         negative_gradient_method=gradient,
+                         early_exaggeration_iter=early_iters, n_iter=niters-early_iters,
+                         n_jobs=n_jobs, random_state=0).fit(activations)
+        return np.asarray(embedding)
+
+    elif reducer == "umap":
+        try:
+            from umap import UMAP
+        except ImportError:
+            logging.error("umap-learn is required for -reducer umap. Install with pip install umap-learn!")
+            sys.exit()
+        n_neighbors = int(np.clip(perp, 2, len(activations) - 1))
+        logging.info("Dimensionality reduction using UMAP begins ...")
+        print("Requested number of components = ", ndims)
+        print("Number of nearest neighbours = ", n_neighbors)
+        # A fixed random_state forces UMAP onto a single thread so the
+        # embedding is not seeded here
+        return UMAP(n_components=ndims, n_neighbors=n_neighbors,
+                    n_jobs=n_jobs).fit_transform(activations)
+
+    else:
+        logging.error("Dimensionality reduction backend %s not recognised!" %reducer)
+        sys.exit()
+
+
+def stratified_sample(nsamples, size, targets=None, nbins=10, seed=0):
+    """
+    stratified_sample(nsamples, size, targets, nbins, seed)
+
+    Draws a subsample whose distribution of targets follows that of 
+    the labelled points. The targets are binned into quantiles and each 
+    bin contributes in proportion to its population. Points without a
+    target, NaN, e.g. the candidates of active learning, are drawn 
+    uniformly in proportion to their number so their labels are never
+    used.
+
+    Inputs:
+    nsamples-         Size of the full dataset.
+    size-             Size of the subsample.
+    targets-          Targets of the full dataset, NaN if not labelled. 
+                      None => uniform random subsample.
+    nbins-            Number of quantile bins of the targets.
+    seed-             Seed of the random number generator.
+
+    Outputs:
+    1-                Sorted indices of the subsample.
+    """
+    rng = np.random.RandomState(seed)
+    if targets is None:
+        return np.sort(rng.choice(nsamples, size, replace=False))
+
+    targets = np.asarray(targets, dtype=float)
+    labelled = np.flatnonzero(~np.isnan(targets))
+    unlabelled = np.flatnonzero(np.isnan(targets))
+    nlabelled = int(round(size * len(labelled) / nsamples))
+    sample = [rng.choice(unlabelled, size - nlabelled, replace=False)]
+    if nlabelled > 0:
+        edges = np.unique(np.quantile(targets[labelled], np.linspace(0, 1, nbins + 1)[1:-1]))
+        strata = np.digitize(targets[labelled], edges)
+        counts = np.bincount(strata)
+
+        # Largest-remainder allocation so the stratum sizes add up to nlabelled
+        quota = counts * nlabelled / len(labelled)
+        alloc = np.floor(quota).astype(int)
+        remainder = nlabelled - alloc.sum()
+        alloc[np.argsort(alloc - quota)[:remainder]] += 1
+
+        order = labelled[np.argsort(strata, kind="stable")]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sample += [rng.choice(order[start:start+count], n, replace=False)
+                   for start, count, n in zip(starts, counts, alloc) if n > 0]
+    return np.sort(np.concatenate(sample))
+
+
+@timed
+def landmark_reduce(activations, ndims, perp, niters, reducer="tsne", landmarks=1000,
+                    targets=None, neighbours=10, chunk=10000, n_jobs=None):
+    """
+    landmark_reduce(activations, ndims, perp, niters, reducer, landmarks,
+                    targets, neighbours, chunk, n_jobs)
+
+    Fits the reducer on a stratified subsample of landmarks and places 
+    the remaining points by inverse-distance weighted interpolation of 
+    the embeddings of their nearest landmarks in activation space. The 
+    remaining points are processed in chunks so the cost of the 
+    reduction scales with the number of landmarks. 
+
+    Inputs:
+    activations-      Extracted activations of shape (samples, features).
+    ndims-            Dimensions of embedded space.
+    perp-             Perplexity value for tSNE analysis.
+    niters-           The maximum number of iterations for tSNE 
+                      optimisation.
+    reducer-          Backend for dimensionality reduction. 
+    landmarks-        Number of landmarks on which the reducer is fitted.
+    targets-          Targets used to stratify the landmarks, NaN for 
+                      points whose labels must not be used. 
+    neighbours-       Number of nearest landmarks used to place a point.
+    chunk-            Number of points placed at a time.
+    n_jobs-           Number of threads for the reducer and the 
+                      neighbour search. None => the threads of the run 
+                      set in aux.resources.
+
+    Outputs:
+    1-                The embedded activations.
+    """
+    from sklearn.neighbors import NearestNeighbors
+
+    activations = np.asarray(activations)
+    nsamples = len(activations)
+    n_jobs = n_jobs or resources.n_jobs()
+    if landmarks >= nsamples:
+        return reduce_dimensions(activations, ndims, perp, niters, reducer, n_jobs)
+
+    print("Fitting the reducer on %s of %s points ..." %(landmarks, nsamples))
+    landmark_idx = stratified_sample(nsamples, landmarks, targets)
+    landmark_embedding = reduce_dimensions(activations[landmark_idx], ndims, perp,
+                                           niters, reducer, n_jobs)
+
+    latent_full = np.empty((nsamples, ndims), dtype=landmark_embedding.dtype)
+    latent_full[landmark_idx] = landmark_embedding
+
+    logging.info("Placing the remaining points by interpolation of %s nearest landmarks ..."
+                 %neighbours)
+    knn = NearestNeighbors(n_neighbors=min(neighbours, landmarks),
+                           n_jobs=n_jobs).fit(activations[landmark_idx])
+    remaining = np.setdiff1d(np.arange(nsamples), landmark_idx, assume_unique=True)
+    for start in range(0, len(remaining), chunk):
+        idx = remaining[start:start+chunk]
+        dist, nn = knn.kneighbors(activations[idx])
+        weights = 1. / np.maximum(dist, 1e-12)
+        weights /= weights.sum(axis=1, keepdims=True)
+        latent_full[idx] = np.einsum("ij,ijk->ik", weights, landmark_embedding[nn])
+    return latent_full
@@ -0,0 +1,162 @@
+"""
+resources.py, SciML-SCD, RAL
+
+Thread limits of a run and of its concurrent workers. The run is
+given a number of cores at start-up by configure, e.g. its share of
+a node, and every stage draws from it: the BLAS/OpenMP libraries,
+the TensorFlow intra- and inter-op pools, the scikit-learn jobs of
+the dimension reduction and the pools of worker processes.
+
+The BLAS/OpenMP libraries read their thread counts from the
+environment when they are loaded, so the limits are placed in the
+environment inherited by the worker processes and applied with
+threadpoolctl to the libraries already loaded. TensorFlow reads its
+limits from the environment when its runtime starts.
+"""
+import contextlib
+import logging
+import os
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
+                    format="%(levelname)s:gp-net: %(message)s")
+
+# Environment variables read by the BLAS, OpenMP and TensorFlow runtimes
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+                    "TF_NUM_INTRAOP_THREADS")
+
+# Resources of this process, set once at start-up by configure
+_config = {"threads": None, "inter": None}
+
+
+def available_cores():
+    """
+    available_cores()
+
+    Outputs:
+    1-              Number of cores the process may run on, e.g. those
+                    allocated by the scheduler of a shared node.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def cores():
+    """
+    cores()
+
+    Outputs:
+    1-              Number of threads of the run set by configure. 
+                    [default: all available cores]
+    """
+    return _config["threads"] or available_cores()
+
+
+def configure(threads=0, inter=0):
+    """
+    configure(threads, inter)
+
+    Applies the thread limits of the run. Must be called before
+    TensorFlow is imported.
+
+    Inputs:
+    threads-        Number of threads of the BLAS/OpenMP libraries,
+                    the TensorFlow intra-op pool and the scikit-learn
+                    jobs, shared between the workers of a pool.
+                    0 => all available cores.
+    inter-          Number of TensorFlow operations run concurrently.
+                    0 => TensorFlow default.
+    """
+    _config["threads"] = threads or None
+    _config["inter"] = inter or None
+    os.environ.update({name: str(cores()) for name in THREAD_VARIABLES})
+    if inter:
+        os.environ["TF_NUM_INTEROP_THREADS"] = str(inter)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        logging.warning("threadpoolctl not found, the BLAS libraries already loaded are not limited")
+    else:
+        threadpool_limits(limits=cores())
+    print("Using %s threads per process%s" %(cores(), " and %s inter-op threads" %inter
+                                              if inter else ""))
+
+
+def n_jobs():
+    """
+    n_jobs()
+
+    Outputs:
+    1-              Number of jobs of the scikit-learn and other joblib
+                    based estimators.
+    """
+    return cores()
+
+
+def threads_per_worker(workers):
+    """
+    threads_per_worker(workers)
+
+    Inputs:
+    workers-        Number of concurrent workers.
+
+    Outputs:
+    1-              Number of cores available to each worker.
+    """
+    return max(1, cores() // workers)
+
+
+@contextlib.contextmanager
+def thread_limits(threads):
+    """
+    thread_limits(threads)
+
+    Context in which processes started by this process limit their
+    BLAS, OpenMP and TensorFlow intra-op threads to threads. The
+    environment is restored on exit.
+
+    Inputs:
+    threads-        Number of threads per process.
+    """
+    saved = {name: os.environ.get(name) for name in THREAD_VARIABLES + ("TF_NUM_INTEROP_THREADS",)}
+    os.environ.update({name: str(threads) for name in THREAD_VARIABLES})
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def limit_tensorflow(threads, inter=1):
+    """
+    limit_tensorflow(threads, inter)
+
+    Must be called before TensorFlow runs any operation.
+
+    Inputs:
+    threads-        Number of threads used within an operation.
+    inter-          Number of operations run concurrently.
+    """
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter)
+
+
+def share_gpus():
+    """
+    share_gpus()
+
+    Lets TensorFlow allocate GPU memory as it is needed instead of
+    taking all the memory of every GPU, so several processes can share
+    the GPUs. Must be called before TensorFlow runs any operation.
+    """
+    import tensorflow as tf
+
+    for gpu in tf.config.experimental.list_physical_devices("GPU"):
+        tf.config.experimental.set_memory_growth(gpu, True)
@@ -0,0 +1,171 @@
+"""
+results.py, SciML-SCD, RAL
+
+Store of the results of a run. The arrays written by training.*,
+latent.* and adam.* into a results directory are named datasets of
+a single HDF5 file, <datadir>/results.h5, chunked and compressed,
+together with metadata such as the property and the settings of
+the GP in the attributes of the file. One file per results directory
+replaces the tens of small .npy files per fold or cycle, which are
+slow to write and list on parallel filesystems.
+
+The arrays are written by the background writer, in the order they
+are submitted, so a task of the writer, e.g. plot.norepeat, reads the
+results submitted before it. Other readers flush the writer first.
+Results directories of earlier versions are read from their .npy
+files.
+"""
+import logging
+import os
+import sys
+import time
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
+                    format="%(levelname)s:gp-net: %(message)s")
+
+import numpy as np
+
+from aux import writer
+
+RESULTS = "results.h5"
+COMPRESSION = "gzip"
+COMPRESSION_LEVEL = 4
+
+
+def write_results(datadir, attrs, arrays):
+    """
+    write_results(datadir, attrs, arrays)
+
+    Writes the arrays into the store of the results directory. An
+    existing dataset of the same name is overwritten, in place when
+    only its length changes, e.g. ytrain between cycles.
+
+    Inputs:
+    datadir-        Results directory.
+    attrs-          Metadata added to the attributes of the store.
+    arrays-         Dictionary of the arrays keyed by dataset name.
+    """
+    import h5py
+
+    if not os.path.isdir(datadir):
+        os.makedirs(datadir)
+    with h5py.File("%s/%s" %(datadir, RESULTS), "a") as f:
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            dataset = f.get(name)
+            if (dataset is not None and dataset.ndim == array.ndim > 0 and
+                    dataset.dtype == array.dtype and dataset.maxshape[0] is None):
+                dataset.resize(array.shape)
+                dataset[...] = array
+                continue
+            if dataset is not None:
+                del f[name]
+            if array.ndim == 0:
+                f.create_dataset(name, data=array)
+            else:
+                f.create_dataset(name, data=array, chunks=True, shuffle=True,
+                                 compression=COMPRESSION, compression_opts=COMPRESSION_LEVEL,
+                                 maxshape=(None,) * array.ndim)
+        f.attrs.update(attrs)
+        f.attrs["updated"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def save_results(datadir, attrs=None, **arrays):
+    """
+    save_results(datadir, attrs, **arrays)
+
+    Queues the arrays for writing into <datadir>/results.h5. The arrays
+    are copied so they may be modified afterwards.
+
+    Inputs:
+    datadir-        Results directory.
+    attrs-          Metadata of the run, e.g. dict(prop=prop). None =>
+                    no metadata.
+    **arrays-       Arrays of the results, e.g. gp_mean=gp_mean.
+    """
+    writer.submit(write_results, datadir, dict(attrs or {}),
+                  {name: np.array(array) for name, array in arrays.items()})
+
+
+def result_names(datadir):
+    """
+    result_names(datadir)
+
+    Outputs:
+    1-              Names of the results stored in the directory.
+    """
+    writer.flush()
+    filename = "%s/%s" %(datadir, RESULTS)
+    if os.path.isfile(filename):
+        import h5py
+
+        with h5py.File(filename, "r") as f:
+            return sorted(f.keys())
+    return sorted(name[:-4] for name in os.listdir(datadir) if name.endswith(".npy"))
+
+
+def has_result(datadir, name):
+    """
+    has_result(datadir, name)
+
+    Outputs:
+    1-              True if the result is stored in the directory.
+    """
+    return name in result_names(datadir)
+
+
+def load_result(datadir, name):
+    """
+    load_result(datadir, name)
+
+    Inputs:
+    datadir-        Results directory.
+    name-           Name of the result, e.g. gp_mean.
+
+    Outputs:
+    1-              The array.
+    """
+    return load_results(datadir, name)[name]
+
+
+def load_results(datadir, *names):
+    """
+    load_results(datadir, *names)
+
+    Inputs:
+    datadir-        Results directory.
+    *names-         Names of the results. None => all the results.
+
+    Outputs:
+    1-              Dictionary of the arrays keyed by name.
+    """
+    names = names or result_names(datadir)
+    writer.flush()
+    filename = "%s/%s" %(datadir, RESULTS)
+    if os.path.isfile(filename):
+        import h5py
+
+        with h5py.File(filename, "r") as f:
+            missing = [name for name in names if name not in f]
+            if missing:
+                logging.error("No %s in %s!" %(", ".join(missing), filename))
+                sys.exit()
+            return {name: f[name][()] for name in names}
+    return {name: np.load("%s/%s.npy" %(datadir, name)) for name in names}
+
+
+def result_metadata(datadir):
+    """
+    result_metadata(datadir)
+
+    Outputs:
+    1-              Dictionary of the metadata of the results. Empty for
+                    results directories of earlier versions.
+    """
+    writer.flush()
+    filename = "%s/%s" %(datadir, RESULTS)
+    if not os.path.isfile(filename):
+        return {}
+    import h5py
+
+    with h5py.File(filename, "r") as f:
+        return dict(f.attrs)
@@ -0,0 +1,111 @@
+"""
+writer.py, SciML-SCD, RAL
+
+Background writer of the results. The arrays and figures of a stage
+are submitted to a writer thread so that the next stage, e.g. the
+next cycle of active learning, runs while they are written.
+
+The tasks run in a single thread in the order they are submitted,
+so a task may read the files written by earlier tasks and matplotlib
+is only used from one thread. The queue of pending tasks is bounded,
+and a stage submitting faster than the results are written waits,
+which bounds the memory held by pending arrays. Pending tasks are
+flushed at exit, and the first error of a task is raised by flush.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
+                    format="%(levelname)s:gp-net: %(message)s")
+
+# Maximum number of pending tasks
+MAXSIZE = 32
+
+
+class BackgroundWriter:
+
+    def __init__(self, maxsize=MAXSIZE):
+        """
+        BackgroundWriter(maxsize)
+
+        Inputs:
+        maxsize-        Maximum number of pending tasks.
+        """
+        self.queue = queue.Queue(maxsize)
+        self.errors = [ ]
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """ Runs the tasks until the sentinel None is received """
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                func, args, kwargs = task
+                func(*args, **kwargs)
+            except Exception as error:
+                logging.error("Background write by %s failed: %s" %(func.__qualname__, error))
+                self.errors.append(error)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        writer.submit(func, *args, **kwargs)
+
+        Queues func(*args, **kwargs). Blocks while the queue is full.
+        """
+        self.queue.put((func, args, kwargs))
+
+    def flush(self):
+        """
+        writer.flush()
+
+        Waits for the pending tasks and raises the first error of a task
+        since the last flush. A task flushing, e.g. by reading results,
+        only follows the tasks before it and does not wait.
+        """
+        if threading.current_thread() is self.thread:
+            return
+        self.queue.join()
+        if self.errors:
+            error, self.errors = self.errors[0], [ ]
+            raise error
+
+    def close(self):
+        """ Flushes the pending tasks and stops the thread """
+        self.queue.put(None)
+        self.thread.join()
+        self.flush()
+
+
+_writer = None
+
+
+def _get():
+    """ The writer of the process, started on first use """
+    global _writer
+    if _writer is None:
+        _writer = BackgroundWriter()
+        atexit.register(_writer.close)
+    return _writer
+
+
+def submit(func, *args, **kwargs):
+    """
+    submit(func, *args, **kwargs)
+
+    Queues a task on the writer, e.g. plot.active. The arguments must
+    not be modified afterwards.
+    """
+    _get().submit(func, *args, **kwargs)
+
+
+def flush():
+    """ Waits for the pending writes, e.g. before a checkpoint """
+    if _writer is not None:
+        _writer.flush()
@@ -0,0 +1,111 @@
+"""
+import_time.py, SciML-SCD, RAL
+
+Benchmarks the start-up time of the lightweight gp-net.py
+subcommands (-h and -checkdata) and fails if any of them imports
+a heavy framework. Each subcommand is run in a fresh interpreter.
+
+usage: python benchmarks/import_time.py [-repeats REPEATS] [-budget BUDGET]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which must not be loaded by the lightweight subcommands
+HEAVY = ("tensorflow", "tensorflow_probability", "megnet", "pymatgen", "keras",
+         "seaborn", "matplotlib", "scipy", "sklearn", "pandas")
+
+# Runs gp-net.py in-process and reports the wall time and heavy modules loaded
+CHILD = """
+import json, runpy, sys, time
+start = time.perf_counter()
+sys.argv = %r
+try:
+    runpy.run_path(%r, run_name="__main__")
+except SystemExit:
+    pass
+heavy = sorted({m.split(".")[0] for m in sys.modules} & set(%r))
+print(json.dumps({"time": time.perf_counter() - start, "heavy": heavy}))
+"""
+
+
+def write_dataset(path, nstructures=1000):
+    """
+    write_dataset(path, nstructures)
+
+    Writes a synthetic dataset in the columnar format for -checkdata.
+
+    Inputs:
+    path-           Directory of the columnar dataset.
+    nstructures-    Number of structures.
+    """
+    os.makedirs(path)
+    rng = np.random.RandomState(0)
+    nsites = rng.randint(1, 20, nstructures)
+    offsets = np.concatenate(([0], np.cumsum(nsites)))
+    np.save("%s/lattice.npy" %path, np.tile(5 * np.eye(3), (nstructures, 1, 1)))
+    np.save("%s/offsets.npy" %path, offsets)
+    np.save("%s/species.npy" %path, rng.randint(1, 90, offsets[-1]).astype(np.int16))
+    np.save("%s/frac_coords.npy" %path, rng.rand(offsets[-1], 3))
+    np.save("%s/targets.npy" %path, rng.exponential(size=nstructures))
+    with open("%s/meta.json" %path, "w") as f:
+        json.dump({"prop": "band_gap", "structures": nstructures,
+                   "sites": int(offsets[-1])}, f)
+
+
+def time_subcommand(argv, repeats):
+    """
+    time_subcommand(argv, repeats)
+
+    Inputs:
+    argv-       Command line arguments passed to gp-net.py.
+    repeats-    Number of fresh interpreters to time.
+
+    Outputs:
+    1-          Median wall time in seconds.
+    2-          Heavy modules imported.
+    """
+    script = os.path.join(ROOT, "gp-net.py")
+    times = [ ]
+    heavy = set()
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", CHILD %(["gp-net.py"] + argv, script, HEAVY)],
+                                cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result["time"])
+        heavy.update(result["heavy"])
+    return np.median(times), sorted(heavy)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start-up time of gp-net.py subcommands.")
+    parser.add_argument("-repeats", help="Number of runs per subcommand. [default: 5]",
+                        type=int, default=5)
+    parser.add_argument("-budget", help="Maximum median start-up time in seconds.\
+                        [default: 1.0]", type=float, default=1.0)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        data = os.path.join(tmp, "band_gap_data")
+        write_dataset(data)
+        for name, argv in (("help", ["-h"]),
+                           ("checkdata", ["-checkdata", "-data", data])):
+            median, heavy = time_subcommand(argv, args.repeats)
+            print("%-10s median start-up = %.3f s, heavy imports = %s"
+                  %(name, median, ", ".join(heavy) or "none"))
+            if heavy or median > args.budget:
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
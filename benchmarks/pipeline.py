@@ -0,0 +1,341 @@
+"""
+pipeline.py, SciML-SCD, RAL
+
+Benchmarks each stage of the gp-net pipeline on synthetic data of
+increasing size: graph conversion of random crystal structures,
+extraction of the activations of a tiny MEGNet model, dimension
+reduction, GP fitting and prediction, selection of the next batch
+and plotting. No data are downloaded and TensorFlow runs on CPU.
+
+The wall time and peak RSS of each stage and size are appended with
+the commit and the versions of the libraries to a JSON lines file,
+and compared with the previous run in that file so regressions
+between versions are visible.
+
+usage: python benchmarks/pipeline.py [-sizes SIZES [SIZES ...]]
+                                     [-stages STAGES [STAGES ...]]
+                                     [-repeats REPEATS] [-results RESULTS]
+                                     [-tolerance TOLERANCE] [-threads THREADS]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# Benchmarks run offline on CPU only
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aux.instrument import stage, profile, reset
+from aux.resources import configure, cores
+from aux import writer
+
+STAGES = ("graph_conversion", "extraction", "reduction", "gp_fit", "gp_predict",
+          "selection", "plotting")
+
+# MEGNet settings of the synthetic graphs, as the defaults of gp-net.py
+BOND, NFEAT_GLOBAL, CUTOFF, WIDTH = 10, 2, 5, 0.5
+LAYER = "readout_0"
+
+
+def synthetic_structures(nstructures, max_sites=20, seed=0):
+    """
+    synthetic_structures(nstructures, max_sites, seed)
+
+    Random periodic structures with about 12 A^3 per site so that every
+    site has neighbours within the MEGNet cutoff.
+
+    Inputs:
+    nstructures-    Number of structures.
+    max_sites-      Maximum number of sites per structure.
+    seed-           Seed of the random generator.
+
+    Outputs:
+    1-              List of pymatgen structures.
+    """
+    from pymatgen.core import Lattice, Structure
+
+    rng = np.random.RandomState(seed)
+    structures = [ ]
+    for _ in range(nstructures):
+        nsites = rng.randint(1, max_sites + 1)
+        lengths = (12. * nsites)**(1/3.) * rng.uniform(0.9, 1.1, 3)
+        angles = rng.uniform(80, 100, 3)
+        lattice = Lattice.from_parameters(*lengths, *angles)
+        structures.append(Structure(lattice, rng.randint(1, 84, nsites).tolist(),
+                                    rng.rand(nsites, 3)))
+    return structures
+
+
+def synthetic_latent(nsamples, nfeatures, seed=0):
+    """
+    synthetic_latent(nsamples, nfeatures, seed)
+
+    Inputs:
+    nsamples-       Number of latent points.
+    nfeatures-      Dimensions of the latent space.
+    seed-           Seed of the random generator.
+
+    Outputs:
+    1-              Latent points of shape (nsamples, nfeatures).
+    2-              Non-negative targets varying smoothly over the
+                    latent space, as band gaps.
+    """
+    rng = np.random.RandomState(seed)
+    latent = rng.randn(nsamples, nfeatures)
+    targets = np.abs(np.sin(latent[:, 0]) + 0.5 * latent[:, 1 % nfeatures]
+                     + 0.1 * rng.randn(nsamples))
+    return latent, targets
+
+
+def tiny_megnet(model_file):
+    """
+    tiny_megnet(model_file)
+
+    Saves an untrained MEGNet model with a single block of small layers.
+
+    Inputs:
+    model_file-     File of the saved model.
+    """
+    from megnet.models import MEGNetModel
+    from aux.get_info import crystal_graph
+
+    model = MEGNetModel(BOND, NFEAT_GLOBAL, nblocks=1, n1=16, n2=16, n3=8, npass=1,
+                        graph_converter=crystal_graph(BOND, CUTOFF, WIDTH))
+    model.save_model(model_file)
+
+
+class Benchmark:
+
+    def __init__(self, size, tmp):
+        """
+        Benchmark(size, tmp)
+
+        Synthetic inputs of one size. Inputs shared by several stages
+        are built on first use outside of the timed region.
+
+        Inputs:
+        size-       Number of structures or latent points.
+        tmp-        Directory for the files written by the stages.
+        """
+        self.size = size
+        self.tmp = tmp
+        self._inputs = {}
+
+    def inputs(self, name):
+        """ Builds the named input once """
+        if name not in self._inputs:
+            if name == "structures":
+                value = synthetic_structures(self.size)
+            elif name == "graphs":
+                from aux.get_info import crystal_graph, graph_input
+
+                converter = crystal_graph(BOND, CUTOFF, WIDTH)
+                value = [graph_input(s, converter) for s in self.inputs("structures")]
+                value = [g for g in value if g is not None]
+            elif name == "model":
+                value = "%s/tiny_megnet.hdf5" %self.tmp
+                tiny_megnet(value)
+            elif name == "activations":
+                value = synthetic_latent(self.size, 16)[0]
+            elif name == "latent":
+                value = synthetic_latent(self.size, 2)
+            elif name == "posterior":
+                from optimizers.posterior import Posterior
+
+                latent, targets = self.inputs("latent")
+                ntrain = self.size // 2
+                value = Posterior(latent[:ntrain], targets[:ntrain], 1., 1.)
+            self._inputs[name] = value
+        return self._inputs[name]
+
+    def prepare(self, name):
+        """ Builds the inputs of a stage and returns the stage """
+        for needed in {"graph_conversion": ("structures",),
+                       "extraction": ("graphs", "model"),
+                       "reduction": ("activations",),
+                       "gp_fit": ("latent",),
+                       "gp_predict": ("latent", "posterior"),
+                       "selection": ("latent", "posterior"),
+                       "plotting": ("latent",)}[name]:
+            self.inputs(needed)
+        return getattr(self, name)
+
+    def graph_conversion(self):
+        from aux.get_info import crystal_graph, graph_input
+
+        converter = crystal_graph(BOND, CUTOFF, WIDTH)
+        for structure in self.inputs("structures"):
+            graph_input(structure, converter)
+
+    def extraction(self):
+        from aux.activations import extract
+
+        for _ in extract(self.inputs("model"), LAYER, self.inputs("graphs")):
+            pass
+
+    def reduction(self):
+        from aux.reduction import reduce_dimensions
+
+        reduce_dimensions(self.inputs("activations"), 2, min(30, self.size // 4), 250)
+
+    def gp_fit(self):
+        from optimizers.adam import adam
+
+        latent, targets = self.inputs("latent")
+        ntrain = self.size // 2
+        adam.train_test_split(self.tmp, "band_gap", latent[:ntrain], latent[ntrain:],
+                              targets[:ntrain], targets[ntrain:], 20, 1., 1., 0.01)
+        # The results are written before the temporary directory is removed
+        writer.flush()
+
+    def gp_predict(self):
+        for _ in self.inputs("posterior").predict_chunks(self.inputs("latent")[0]):
+            pass
+
+    def selection(self):
+        from aux.pool_sampling import acquisition_scores, select_top, variance_reduction_batch
+
+        latent, targets = self.inputs("latent")
+        posterior = self.inputs("posterior")
+        ntrain = self.size // 2
+        predictions = posterior.predict_chunks(latent, np.arange(ntrain, self.size))
+        select_top(acquisition_scores("ei", predictions, targets[:ntrain]), 10)
+        variance_reduction_batch(posterior, latent[ntrain:], 10)
+
+    def plotting(self):
+        from aux.plotting import plot
+
+        latent, targets = self.inputs("latent")
+        rng = np.random.RandomState(0)
+        ytest = targets[self.size // 2:]
+        gp_mean = ytest + 0.1 * rng.randn(len(ytest))
+        gp_stddev = 0.1 + 0.05 * rng.rand(len(ytest))
+        error = np.abs(gp_mean - ytest)
+        history = np.linspace(1., 0.1, 20)
+        plot.train_test_split(self.tmp, "band_gap", LAYER, 20, 0.01, history, history,
+                              history, ytest, gp_mean, gp_stddev, None, None, error.mean(),
+                              (error**2).mean(), error.std(), np.corrcoef(ytest, gp_mean)[0, 1])
+
+
+def run(benchmark, name, repeats):
+    """
+    run(benchmark, name, repeats)
+
+    Inputs:
+    benchmark-      Benchmark of one size.
+    name-           Stage to be timed.
+    repeats-        Number of timed runs.
+
+    Outputs:
+    1-              Median wall time in seconds.
+    2-              Peak RSS in MB over the runs.
+    """
+    func = benchmark.prepare(name)
+    times = [ ]
+    peak = 0.
+    for _ in range(repeats):
+        reset()
+        with stage(name):
+            func()
+        record = profile()["stages"][name]
+        times.append(record["seconds"])
+        peak = max(peak, record["peak_rss_mb"])
+    return float(np.median(times)), peak
+
+
+def metadata():
+    """
+    metadata()
+
+    Outputs:
+    1-              Commit, date, host and library versions of the run.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    versions = {}
+    for module in ("numpy", "scipy", "sklearn", "tensorflow", "megnet", "pymatgen"):
+        try:
+            versions[module] = __import__(module).__version__
+        except (ImportError, AttributeError):
+            versions[module] = None
+    return {"commit": commit, "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(), "machine": platform.machine(),
+            "cpus": os.cpu_count(), "threads": cores(), "versions": versions}
+
+
+def previous_run(filename):
+    """
+    previous_run(filename)
+
+    Outputs:
+    1-              Last run in the results file. None => no earlier run.
+    """
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    return runs[-1] if runs else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the gp-net pipeline stages.")
+    parser.add_argument("-sizes", help="Numbers of structures or latent points.\
+                        [default: 100 500 2000]", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("-stages", help="Stages to benchmark. [default: all]", nargs="+",
+                        choices=STAGES, default=list(STAGES))
+    parser.add_argument("-repeats", help="Number of timed runs per stage and size.\
+                        [default: 3]", type=int, default=3)
+    parser.add_argument("-results", help="JSON lines file to which the results are\
+                        appended. [default: benchmarks/results/pipeline.jsonl]", type=str,
+                        default=os.path.join(ROOT, "benchmarks", "results", "pipeline.jsonl"))
+    parser.add_argument("-tolerance", help="Relative slowdown from the previous run\
+                        reported as a regression. [default: 0.2]", type=float, default=0.2)
+    parser.add_argument("-threads", help="Number of threads of the stages, as -threads of\
+                        gp-net.py. [default: 0 i.e all available cores]", type=int, default=0)
+    args = parser.parse_args()
+    configure(args.threads)
+
+    previous = previous_run(args.results)
+    results = {}
+    print("%-18s %8s %12s %12s %10s" %("stage", "size", "time (s)", "peak (MB)", "change"))
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            benchmark = Benchmark(size, tmp)
+            for name in args.stages:
+                seconds, peak = run(benchmark, name, args.repeats)
+                key = "%s/%s" %(name, size)
+                results[key] = {"seconds": seconds, "peak_rss_mb": peak}
+                change = ""
+                if previous is not None and key in previous["results"]:
+                    ratio = seconds / previous["results"][key]["seconds"]
+                    change = "%+.0f%%" %(100 * (ratio - 1))
+                    if ratio > 1 + args.tolerance:
+                        change += " slower"
+                print("%-18s %8s %12.3f %12.1f %10s" %(name, size, seconds, peak, change))
+
+    if os.path.dirname(args.results) and not os.path.isdir(os.path.dirname(args.results)):
+        os.makedirs(os.path.dirname(args.results))
+    with open(args.results, "a") as f:
+        f.write(json.dumps(dict(metadata(), sizes=args.sizes, repeats=args.repeats,
+                                results=results)) + "\n")
+    print("Results appended to %s" %args.results)
+    if previous is not None:
+        print("Changes are relative to commit %s run on %s" %(previous["commit"],
+                                                              previous["date"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+scaling.py, SciML-SCD, RAL
+
+Thread scaling of the stages of the gp-net pipeline. The pipeline
+benchmark is run in a fresh interpreter for each number of threads,
+so that the BLAS libraries are loaded with the requested limits, and
+the speed-up and parallel efficiency relative to one thread are
+reported. The curves are appended to a JSON lines file.
+
+usage: python benchmarks/scaling.py [-threads THREADS [THREADS ...]]
+                                    [-stages STAGES [STAGES ...]]
+                                    [-size SIZE] [-repeats REPEATS]
+                                    [-results RESULTS]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aux.resources import available_cores, THREAD_VARIABLES
+
+# Stages whose cost is dominated by multi-threaded libraries
+STAGES = ("extraction", "reduction", "gp_fit", "gp_predict", "selection")
+
+
+def default_threads():
+    """
+    default_threads()
+
+    Outputs:
+    1-              Powers of two up to the available cores, and the
+                    available cores.
+    """
+    threads = [1]
+    while threads[-1] * 2 < available_cores():
+        threads.append(threads[-1] * 2)
+    if threads[-1] != available_cores():
+        threads.append(available_cores())
+    return threads
+
+
+def run_pipeline(threads, stages, size, repeats):
+    """
+    run_pipeline(threads, stages, size, repeats)
+
+    Inputs:
+    threads-        Number of threads of the run.
+    stages-         Stages to be timed.
+    size-           Number of structures or latent points.
+    repeats-        Number of timed runs per stage.
+
+    Outputs:
+    1-              Results of benchmarks/pipeline.py.
+    """
+    env = dict(os.environ, **{name: str(threads) for name in THREAD_VARIABLES})
+    with tempfile.TemporaryDirectory() as tmp:
+        results = os.path.join(tmp, "pipeline.jsonl")
+        subprocess.run([sys.executable, os.path.join(ROOT, "benchmarks", "pipeline.py"),
+                        "-threads", str(threads), "-sizes", str(size), "-repeats",
+                        str(repeats), "-results", results, "-stages"] + stages,
+                       cwd=ROOT, env=env, stdout=subprocess.DEVNULL, check=True)
+        with open(results) as f:
+            return json.loads(f.readline())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Thread scaling of the gp-net pipeline stages.")
+    parser.add_argument("-threads", help="Numbers of threads. [default: powers of two up to\
+                        the available cores]", type=int, nargs="+", default=default_threads())
+    parser.add_argument("-stages", help="Stages to benchmark. [default: %s]" %" ".join(STAGES),
+                        nargs="+", default=list(STAGES))
+    parser.add_argument("-size", help="Number of structures or latent points. [default: 2000]",
+                        type=int, default=2000)
+    parser.add_argument("-repeats", help="Number of timed runs per stage. [default: 3]",
+                        type=int, default=3)
+    parser.add_argument("-results", help="JSON lines file to which the curves are appended.\
+                        [default: benchmarks/results/scaling.jsonl]", type=str,
+                        default=os.path.join(ROOT, "benchmarks", "results", "scaling.jsonl"))
+    args = parser.parse_args()
+
+    runs = {threads: run_pipeline(threads, args.stages, args.size, args.repeats)
+            for threads in sorted(args.threads)}
+    base = runs[min(runs)]
+    curves = {}
+    print("%-12s %8s %12s %10s %12s" %("stage", "threads", "time (s)", "speed-up",
+                                        "efficiency"))
+    for name in args.stages:
+        key = "%s/%s" %(name, args.size)
+        curves[name] = [ ]
+        for threads, run in runs.items():
+            seconds = run["results"][key]["seconds"]
+            speedup = base["results"][key]["seconds"] * min(runs) / seconds
+            curves[name].append({"threads": threads, "seconds": seconds, "speedup": speedup})
+            print("%-12s %8s %12.3f %10.2f %11.0f%%" %(name, threads, seconds, speedup,
+                                                       100 * speedup / threads))
+
+    if os.path.dirname(args.results) and not os.path.isdir(os.path.dirname(args.results)):
+        os.makedirs(os.path.dirname(args.results))
+    with open(args.results, "a") as f:
+        meta = {k: v for k, v in base.items() if k not in ("results", "sizes", "threads")}
+        f.write(json.dumps(dict(meta, size=args.size, curves=curves)) + "\n")
+    print("Scaling curves appended to %s" %args.results)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,11 +13,13 @@ logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
                     format="%(levelname)s:gp-net: %(message)s")
 import numpy as np
 
-from aux.get_info import megnet_input
-from aux.activations import latent
-from aux.plotting import plot
-from train.MEGNetTrain import training
-from optimizers.adam import adam 
+# Frameworks (TensorFlow, pymatgen, MEGNet, seaborn) are imported only
+# by the subcommands that need them so -ltype, -convert and -checkdata
+# start instantly. benchmarks/import_time.py keeps it that way.
+from aux.reduction import REDUCERS
+from aux.instrument import write_profile, reset, enable_profiling
+from aux import writer
+from aux.results import save_results
 
 VERSION = "1.0"
 
@@ -33,12 +35,22 @@ class Params:
         """
         # General arguents
         self.checkdata = False
+        self.convert = False
+        self.graphcache = False
+        self.jobs = 1
+        self.threads = 0
+        self.interop = 0
         self.ndims = 0
         
         # Specific to active learning 
         self.noactive = False
+        self.multitask = False
         self.repeat = False 
+        self.resume = False
         self.samp = "entropy"
+        self.batchsel = "topk"
+        self.kappa = 2.0
+        self.target = None
         self.cycle = 1, 5
         self.quan = 1000
         self.stop = 0.1 
@@ -52,7 +64,11 @@ class Params:
         self.include = False
         self.batch = 256
         self.prev = False
+        self.finetune = 0, 1.0
+        self.pipeline = False
+        self.maxatoms = 0
         self.layer = "readout_0"
+        self.workers = 1
         
         # For both MEGNet and GP
         self.epochs = 0
@@ -62,12 +78,15 @@ class Params:
         # For tSNE only 
         self.perp = 150
         self.niters = 1000
+        self.reducer = "tsne"
+        self.landmarks = 0
         
         # GP specific arguments
         self.rate = 0.01 
         self.amp = 1.0
         self.length = 1.0
         self.maxiters = [0]
+        self.refine = 0
 
 
 
@@ -77,6 +96,22 @@ def main():
     parser.add_argument("-checkdata", action="store_true",
                         help="Check number of entries in the dataset. [default: False]",
                         default = False)    
+    parser.add_argument("-convert", action="store_true",
+                        help="Convert the -data pickles, or those downloaded with -key, into the\
+                        memory-mapped columnar format. [default: False]", default=False)
+    parser.add_argument("-graphcache", action="store_true",
+                        help="Store the crystal graphs of the structures of each dataset in\
+                        graph_cache/ and reuse them across runs. [default: False]", default=False)
+    parser.add_argument("-jobs", help="Number of properties processed concurrently when several\
+                        datasets are passed. The graphs of all the datasets are converted once\
+                        and each property runs in its own process with an even share of the\
+                        cores. [default: 1]", type=int)
+    parser.add_argument("-threads", help="Number of cores used by the run, shared by the\
+                        BLAS, TensorFlow and scikit-learn thread pools and divided evenly\
+                        between the processes of -jobs and -workers. [default: 0 i.e all\
+                        cores available to the process]", type=int)
+    parser.add_argument("-interop", help="Number of TensorFlow operations run concurrently.\
+                        [default: 0 i.e TensorFlow default]", type=int)
     parser.add_argument("-ltype", help="Display the layers in a fitted MEGNet model.",
                         type=str)
     parser.add_argument("-nomeg", action="store_true",
@@ -84,14 +119,28 @@ def main():
 
     parser.add_argument("-noactive", action="store_true",
                         help="Don't do active learning [default: False]", default=False)
-    parser.add_argument("-samp", help="Type of sampling for active learning. Use random or\
-                         entropy [default: entropy]", type=str)
+    parser.add_argument("-samp", help="Type of sampling for active learning. Use random,\
+                         entropy, ucb (upper confidence bound) or ei (expected improvement)\
+                         [default: entropy]", type=str)
+    parser.add_argument("-kappa", help="Weight of the standard deviation in -samp ucb.\
+                        [default: 2.0]", type=float)
+    parser.add_argument("-target", help="Target value of the property for -samp ei. Without a\
+                        target, the improvement is over the highest training value.", type=float)
+    parser.add_argument("-batchsel", help="Construction of the batch of samples moved per cycle of\
+                        active learning. Use topk (highest uncertainties), greedy (greedy reduction\
+                        of the total posterior variance), dpp (determinantal selection) or believer\
+                        (kriging believer) [default: topk]", type=str)
     parser.add_argument("-cycle", help="Number of structures to sample and maximum number of times\
                         to sample separated by spaces for active learning. [default: 1 5]",
                         nargs=2, type=int)
     parser.add_argument("-repeat", action="store_true",
                         help="MEGNet train and pre-process activations in each active learning cycle\
                         [default: False]", default=False)
+    parser.add_argument("-resume", action="store_true",
+                        help="Continue active learning from the checkpoint of the last completed\
+                        cycle. The settings of the selection must be unchanged. The Adam\
+                        optimiser of -refine restarts from the restored hyperparameters.\
+                        [default: False]", default=False)
     parser.add_argument("-q", "--quan", help="Quantity of data for norepeat active learning\
                         [default: 1000]", type=int) 
     parser.add_argument("-stop", help="Minimum fraction of test set required for active learning\
@@ -113,9 +162,18 @@ def main():
     parser.add_argument("-include", action="store_true",
                         help="Include zero optical property values in the MEGNet training\
                         and/or Gaussian process analysis. [default: False]", default=False)
+    parser.add_argument("-multitask", action="store_true",
+                        help="Fit all the properties passed with -data jointly with a multi-output\
+                        MEGNet and a GP sharing one kernel over the structures common to their\
+                        datasets. Train-test split only. [default: False]", default=False)
     parser.add_argument("-nsplit",
                         help="Number of training set splits for k-fold cross-validation.\
                         [default: 1 i.e no cross-validation]", type=int)
+    parser.add_argument("-workers", help="Number of k-fold cross-validation folds run\
+                        concurrently. The cores are shared evenly between the workers. Each\
+                        concurrent fold starts from a fresh model and the -amp and -length\
+                        priors. Folds are run one after another with -prev. [default: 1]",
+                        type=int)
     
     parser.add_argument("-epochs", 
                         help="Epochs. [default: 0 ie. Perform no training with MEGNet]",
@@ -132,6 +190,21 @@ def main():
     parser.add_argument("-prev", action="store_true",
                        help="Use a pre-trained MEGNet model during training with MEGNet.\
                        [default: False]", default=False)
+    parser.add_argument("-pipeline", action="store_true",
+                        help="Train MEGNet from the graphs converted for the extraction of\
+                        activations through a tf.data pipeline with parallel batch assembly\
+                        and prefetching. [default: False]", default=False)
+    parser.add_argument("-maxatoms", help="Maximum total number of atoms per batch of graphs.\
+                        The graphs are grouped by size so that batches hold graphs of similar\
+                        sizes. Applies to the extraction of activations, which requires a layer\
+                        with one output per structure, and to training with -pipeline.\
+                        [default: 0 i.e no cap]", type=int)
+    parser.add_argument("-finetune", help="Number of epochs and weight of the newly acquired\
+                        samples separated by spaces for fine-tuning the best MEGNet model of the\
+                        previous cycle of repeat active learning. Training stops early when the\
+                        loss on the validation set of the pool, held out of fine-tuning, does\
+                        not improve for 3 epochs. [default: 0 1 i.e train\
+                        for -epochs in every cycle]", nargs=2, type=float)
     parser.add_argument("-layer",
                         help="MEGNet fitted model layer to analyse. [default: readout_0 i.e 32\
                         dense layer]", type=str)
@@ -146,6 +219,15 @@ def main():
     parser.add_argument("-niters",
                         help="Number of iterations for optimisation in tSNE. [default: 1000]",
                         type=int)
+    parser.add_argument("-reducer",
+                        help="Backend for dimension reduction. Use tsne, fft-tsne (openTSNE with\
+                        approximate nearest neighbours) or umap (UMAP with approximate nearest\
+                        neighbours). [default: tsne]", type=str)
+    parser.add_argument("-landmarks",
+                        help="Number of landmarks for dimension reduction. The reducer is\
+                        fitted on a subsample of landmarks stratified by the targets of the\
+                        pool, the candidates are drawn uniformly, and the remaining points are placed by interpolation of their nearest landmarks.\
+                        [default: 0 i.e fit on the full dataset]", type=int)
 
     parser.add_argument("-rate", 
                         help="Adam optimizer Learning rate. [default: 0.01]", type=float)
@@ -159,10 +241,29 @@ def main():
                         per fold and the other for training using train-test split.\
                         \nFor active learning and train-test split, a single input\
                         is required. [default: 0 i.e no GP training]", nargs="+", type=int) 
+    parser.add_argument("-refine",
+                        help="Number of Adam steps refining the GP hyperparameters of the previous\
+                        cycle of active learning, with the optimiser state carried over, in each\
+                        subsequent cycle. [default: 0 i.e the full -maxiters optimisation per\
+                        cycle for repeat and no GP training after cycle 0 for norepeat]", type=int)
+    parser.add_argument("-profile", nargs="+", metavar="STAGE",
+                        help="Profile the stages matching the patterns, e.g. graph_conversion\
+                        latent.* adam.*, with cProfile. The training.*, adam.* and multitask.*\
+                        stages are also traced with the TensorFlow profiler. Profiles are\
+                        written to profile/<property>. Folds run with -workers are not\
+                        profiled. [default: no profiling]", type=str)
     
     args = parser.parse_args()
     samp = args.samp or Params().samp
+    batchsel = args.batchsel or Params().batchsel
+    kappa = args.kappa if args.kappa is not None else Params().kappa
+    target = args.target if args.target is not None else Params().target
     cycle = args.cycle or Params().cycle
+    finetune = args.finetune or Params().finetune
+    workers = args.workers or Params().workers
+    jobs = args.jobs or Params().jobs
+    threads = args.threads or Params().threads
+    interop = args.interop or Params().interop
     quan = args.quan or Params().quan 
     stop = args.stop or Params().stop 
     fraction = args.frac or Params().frac
@@ -175,15 +276,19 @@ def main():
     cutoff = args.cutoff or Params().cutoff
     width = args.width or Params().width
     layer = args.layer or Params().layer
+    maxatoms = args.maxatoms or Params().maxatoms
 
     ndims = args.ndims or Params().ndims    
     perp = args.perp or Params().perp
     niters = args.niters or Params().niters
+    reducer = args.reducer or Params().reducer
+    landmarks = args.landmarks or Params().landmarks
     
     rate = args.rate or Params().rate 
     amp = args.amp or Params().amp
     length_scale = args.length or Params().length
     maxiters = args.maxiters or Params().maxiters
+    refine = args.refine or Params().refine
 
 
     # Display layers in a pre-fitted MEGNet model 
@@ -192,6 +297,16 @@ def main():
         show_layers(args.ltype)
         sys.exit()
 
+    if ndims > 1 and reducer not in REDUCERS:
+        logging.error("Dimension reduction backend not recognised!")
+        sys.exit()
+    if maxatoms < 0:
+        logging.error("-maxatoms must be non-negative!")
+        sys.exit()
+    if ndims > 1 and 0 < landmarks <= perp:
+        logging.error("-landmarks must be greater than the perplexity!")
+        sys.exit()
+
     if args.include:
         logging.info("Include zero optical property values ...")
     else:
@@ -210,6 +325,9 @@ def main():
 
     if args.noactive:
         logging.info("No active learning requested ...")
+        if args.resume:
+            logging.error("-resume is only supported with active learning!")
+            sys.exit()
         assert len(fraction) == 2, "-frac requires two inputs!"
         assert (fraction[0] + fraction[1]) == 1., "The sum of -frac must be 1!"
         if not (0 < (fraction[0] and fraction[1]) < 1): 
@@ -221,16 +339,37 @@ def main():
             maxiters = maxiters[0]
         else:
             print("%s-fold cross-validation requested ..." %nsplit)
+            assert workers >= 1, "-workers must be at least 1!"
+            if args.multitask:
+                logging.error("-multitask is only supported with the train-test split!")
+                sys.exit()
             assert len(maxiters) == 2, "-maxiters must have length 2!"
     else:
         logging.info("Perform active learning ...")
+        if args.multitask:
+            logging.error("-multitask is only supported with -noactive!")
+            sys.exit()
         assert stop < 1., "Stop argument should be less than 1!"
         assert nsplit == 1, "Active learning with k-fold cross validation not supported!"
         assert len(maxiters) == 1, "-maxiters must have length 1!"
         maxiters = maxiters[0]
-        if samp not in ("entropy", "random"):
+        assert refine >= 0, "-refine must be non-negative!"
+        assert finetune[0] >= 0 and finetune[1] > 0,\
+            "-finetune requires non-negative epochs and a positive weight!"
+        from aux.pool_sampling import ACQUISITIONS
+        if samp != "random" and samp not in ACQUISITIONS:
             logging.error("Sampling type not recognised!")
             sys.exit()
+        if batchsel not in ("topk", "greedy", "dpp", "believer"):
+            logging.error("Batch selection type not recognised!")
+            sys.exit()
+        if samp == "random" and batchsel != "topk":
+            logging.error("Random sampling only supports -batchsel topk!")
+            sys.exit()
+        if batchsel in ("greedy", "dpp") and samp != "entropy":
+            logging.error("-batchsel %s is built from the variance and requires -samp entropy!"
+                          %batchsel)
+            sys.exit()
             
         if args.repeat:
             logging.info("MEGNet train and perform activation analysis per cycle of active learning ...")
@@ -259,6 +398,16 @@ def main():
         logging.error("No input data provided. Use -data or -key option!")
         sys.exit()
 
+    # Convert pickled datasets into the columnar format
+    if args.convert:
+        from aux.dataset import convert_data
+        from aux.get_info import find_data
+        # Datasets downloaded with -key are found by their property
+        for dat in args.data or [find_data(prop) for prop in properties]:
+            if dat.endswith(".pkl"):
+                convert_data(dat)
+        sys.exit()
+
     # Check number of entries in dataset
     if args.checkdata:
         from aux.get_info import ReadData
@@ -267,11 +416,102 @@ def main():
                 ReadData(dat, args.include)
         sys.exit()    
 
+    # Thread limits of all the stages, set before TensorFlow is loaded
+    from aux.resources import configure
+    assert threads >= 0 and interop >= 0, "-threads and -interop must be non-negative!"
+    configure(threads, interop)
+
+    # Fit all properties jointly over one latent space
+    if args.multitask:
+        if len(properties) < 2:
+            logging.error("-multitask requires the datasets of at least two properties!")
+            sys.exit()
+        from aux.get_info import megnet_input
+        from aux.activations import latent
+        from train.MEGNetTrain import training
+        from optimizers.multitask import multitask
+
+        label = "_".join(properties)
+        datadir = "multitask/%s_results" %label
+        enable_profiling(args.profile, "profile/%s" %label)
+        model, activations_input_full, Xfull, yfull, Xpool, ypool, Xtest, ytest =\
+            megnet_input(properties, args.include, bond, nfeat_global, cutoff, width, fraction,
+                         cache=args.graphcache)
+        graphs = None
+        if args.pipeline:
+            from train.input_pipeline import graph_lookup
+            graphs = graph_lookup(Xfull, activations_input_full)
+
+        if not args.nomeg and epochs > 0:
+            logging.info("Training a multi-output MEGNet on the pool ...")
+            training.train_test_split(datadir, label, args.prev, model, batch, epochs, Xpool,
+                                      ypool, Xtest, ytest, graphs, maxatoms)
+
+        logging.info("Obtaining latent points for the full dataset ...")
+        latent_pool, latent_test = latent.train_test_split(
+            datadir, label, layer, activations_input_full, Xpool, ytest[:, 0], perp, ndims,
+            niters, reducer, landmarks, yfull[:, 0], maxatoms)
+
+        logging.info("Multi-output Gaussian Process initiated ...")
+        multitask.train_test_split(datadir, properties, latent_pool, latent_test, ypool, ytest,
+                                   maxiters, amp, length_scale, rate)
+        writer.flush()
+        write_profile("%s/profile.json" %datadir)
+        sys.exit()
+
+    # Process several properties concurrently after a shared graph stage
+    if jobs > 1 and len(properties) > 1:
+        import subprocess
+        import time
+        from aux.get_info import cache_graphs, find_data
+        from aux.resources import threads_per_worker, thread_limits
+
+        if not args.nomeg:
+            logging.info("Converting the structures of all properties into graphs ...")
+            cache_graphs(properties, bond, cutoff, width)
+
+        jobs = min(jobs, len(properties))
+        threads = threads_per_worker(jobs)
+        print("Running %s properties on %s processes with %s threads each ..."
+              %(len(properties), jobs, threads))
+        # The last occurrences of -data, -jobs and -threads take precedence
+        status = { }
+        running = { }
+        with thread_limits(threads):
+            for prop in properties:
+                while len(running) == jobs:
+                    for done in [p for p in running if running[p].poll() is not None]:
+                        status[done] = running.pop(done).returncode
+                    time.sleep(1)
+                with open("%s.log" %prop, "w") as log:
+                    running[prop] = subprocess.Popen(
+                        [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                        ["-graphcache", "-jobs", "1", "-threads", str(threads), "-data",
+                         find_data(prop)],
+                        stdout=log, stderr=subprocess.STDOUT)
+            for prop, process in running.items():
+                status[prop] = process.wait()
+        for prop in properties:
+            print("%s: %s (log in %s.log)" %(prop, "failed" if status[prop] else "done", prop))
+        sys.exit(1 if any(status.values()) else 0)
+
+    from aux.get_info import megnet_input
+    from aux.activations import latent
+    from aux.plotting import plot
+    from train.MEGNetTrain import training
+    from optimizers.adam import adam, WarmStart
+    from aux.dataset import save_splits
+    if args.pipeline:
+        from train.input_pipeline import graph_lookup
+
     for prop in properties:
+        enable_profiling(args.profile, "profile/%s" %prop)
         if args.noactive:
             if not args.nomeg:
                 model, activations_input_full, Xfull, yfull, Xpool, ypool, Xtest, ytest =\
-                    megnet_input(prop, args.include, bond, nfeat_global, cutoff, width, fraction)
+                    megnet_input(prop, args.include, bond, nfeat_global, cutoff, width, fraction,
+                                 cache=args.graphcache)
+                graphs = graph_lookup(Xfull, activations_input_full) if args.pipeline else None
             
             if nsplit == 1:
                 #*****************************
@@ -282,12 +522,13 @@ def main():
                 if not args.nomeg and epochs > 0:
                     logging.info("Training MEGNet on the pool ...")
                     training.train_test_split(datadir, prop, args.prev, model, batch,
-                                              epochs, Xpool, ypool, Xtest, ytest)
+                                              epochs, Xpool, ypool, Xtest, ytest, graphs,
+                                              maxatoms)
                     
                 logging.info("Obtaining latent points for the full dataset ...")
                 latent_pool, latent_test = latent.train_test_split(
                     datadir, prop, layer, activations_input_full, Xpool, ytest, perp,
-                    ndims, niters)
+                    ndims, niters, reducer, landmarks, yfull, maxatoms)
             
                 logging.info("Gaussian Process initiated ...")
                 OptLoss, OptAmp, OptLength, Optmae, Optmse, Optsae, gp_mean, gp_stddev, R =\
@@ -295,9 +536,9 @@ def main():
                                           maxiters, amp, length_scale, rate)
 
                 logging.info("Saving optimised hyperparameters and GP posterior plots ...")
-                plot.train_test_split(datadir, prop, layer, maxiters, rate, OptLoss, OptAmp,
-                                      OptLength, ytest, gp_mean, gp_stddev, None, None, Optmae,
-                                      Optmse, Optsae, R)
+                writer.submit(plot.train_test_split, datadir, prop, layer, maxiters, rate,
+                              OptLoss, OptAmp, OptLength, ytest, gp_mean, gp_stddev, None, None,
+                              Optmae, Optmse, Optsae, R)
                 
             elif nsplit > 1:
                 #***************************
@@ -311,25 +552,46 @@ def main():
                 Optmse_val_fold = np.array([])
                 mae_test_fold = np.array([])
                 kf = KFold(n_splits=nsplit, shuffle=True, random_state=0)
-                for fold, (train_idx, val_idx) in enumerate(kf.split(Xpool)):
-                    datadir = "k_fold/%s_results/0%s_fold" %(prop, fold)
-                    Xtrain, Xval = Xpool[train_idx], Xpool[val_idx]
-                    ytrain, yval = ypool[train_idx], ypool[val_idx]
-
-                    if not args.nomeg and epochs > 0:
-                        print("\nTraining MEGNet on fold %s training set ..." %fold)
-                        training.k_fold(datadir, fold, prop, args.prev, model, batch, epochs,
-                                        Xtrain, ytrain, Xval, yval)
-
-                    logging.info("Obtaining latent points for the full dataset ...")
-                    latent_train, latent_val, latent_test = latent.k_fold(
-                        datadir, fold, prop, layer, activations_input_full, train_idx, val_idx,
-                        Xpool, perp, ndims, niters)
-
-                    logging.info("Gaussian Process initiated ...")
-                    amp, length_scale, Optmae_val, Optmse_val, mae_test = adam.k_fold(
-                        datadir, prop, latent_train, latent_val, latent_test, ytrain, yval, ytest,
-                        maxiters[0], amp, length_scale, rate)
+                folds = list(kf.split(Xpool))
+                if workers > 1 and args.prev:
+                    logging.info("Each fold starts from the model of the previous fold with -prev. Running the folds one after another ...")
+                if workers > 1 and not args.prev:
+                    # The folds are independent and start from the same priors
+                    from aux.parallel import run_folds
+                    fold_results = run_folds(
+                        folds, workers,
+                        dict(prop=prop, nomeg=args.nomeg, epochs=epochs, batch=batch, bond=bond,
+                             nfeat_global=nfeat_global, cutoff=cutoff, width=width, layer=layer,
+                             perp=perp, ndims=ndims, niters=niters, reducer=reducer,
+                             landmarks=landmarks, maxatoms=maxatoms, maxiters=maxiters[0],
+                             amp=amp, length_scale=length_scale, rate=rate),
+                        Xpool=Xpool, ypool=ypool, ytest=ytest,
+                        activations_input_full=activations_input_full, yfull=yfull,
+                        graphs=graphs)
+                else:
+                    fold_results = [ ]
+                    for fold, (train_idx, val_idx) in enumerate(folds):
+                        datadir = "k_fold/%s_results/0%s_fold" %(prop, fold)
+                        Xtrain, Xval = Xpool[train_idx], Xpool[val_idx]
+                        ytrain, yval = ypool[train_idx], ypool[val_idx]
+
+                        if not args.nomeg and epochs > 0:
+                            print("\nTraining MEGNet on fold %s training set ..." %fold)
+                            training.k_fold(datadir, fold, prop, args.prev, model, batch, epochs,
+                                            Xtrain, ytrain, Xval, yval, graphs, maxatoms)
+
+                        logging.info("Obtaining latent points for the full dataset ...")
+                        latent_train, latent_val, latent_test = latent.k_fold(
+                            datadir, fold, prop, layer, activations_input_full, train_idx, val_idx,
+                            Xpool, perp, ndims, niters, reducer, landmarks, yfull, maxatoms)
+
+                        logging.info("Gaussian Process initiated ...")
+                        fold_results.append(adam.k_fold(
+                            datadir, prop, latent_train, latent_val, latent_test, ytrain, yval,
+                            ytest, maxiters[0], amp, length_scale, rate))
+                        amp, length_scale = fold_results[-1][:2]
+
+                for amp, length_scale, Optmae_val, Optmse_val, mae_test in fold_results:
                     OptAmp_fold = np.append(OptAmp_fold, amp) 
                     OptLength_fold = np.append(OptLength_fold, length_scale)
                     Optmae_val_fold = np.append(Optmae_val_fold, Optmae_val)
@@ -351,11 +613,12 @@ def main():
                 datadir = "k_fold/%s_results" %prop
                 if not args.nomeg and epochs > 0:
                     training.train_test_split(datadir, prop, args.prev, model, batch, epochs,
-                                              Xpool, ypool, Xtest, ytest)
+                                              Xpool, ypool, Xtest, ytest, graphs, maxatoms)
                     
                 logging.info("Obtaining latent points for the full dataset ...")
                 latent_pool, latent_test = latent.train_test_split(
-                    datadir, prop, layer, activations_input_full, Xpool, ytest, perp, ndims, niters)
+                    datadir, prop, layer, activations_input_full, Xpool, ytest, perp, ndims, niters,
+                    reducer, landmarks, yfull, maxatoms)
                 
                 logging.info("Gaussian Process initiated ...")
                 OptLoss, OptAmp, OptLength, Optmae, Optmse, Optsae, gp_mean, gp_stddev, R =\
@@ -363,19 +626,25 @@ def main():
                                           maxiters[1], amp, length_scale, rate)
 
                 logging.info("Saving optimised hyperparameters and GP posterior plots ...")
-                plot.train_test_split(datadir, prop, layer, maxiters[1], rate, OptLoss, OptAmp,
-                                      OptLength, ytest, gp_mean, gp_stddev, Optmae_val_fold,
-                                      mae_test_fold, Optmae, Optmse, Optsae, R)
+                writer.submit(plot.train_test_split, datadir, prop, layer, maxiters[1], rate,
+                              OptLoss, OptAmp, OptLength, ytest, gp_mean, gp_stddev,
+                              Optmae_val_fold, mae_test_fold, Optmae, Optmse, Optsae, R)
         else:
-             import subprocess
-             from aux.pool_sampling import selection_fn
+             from aux.pool_sampling import Pool, selection_fn, acquisition_scores
+             from aux.checkpoint import save_checkpoint, load_checkpoint
+             from optimizers.posterior import Posterior
              EntropySelection = selection_fn.EntropySelection
              RandomSelection = selection_fn.RandomSelection
+             BatchSelection = selection_fn.BatchSelection
+             AcquisitionSelection = selection_fn.AcquisitionSelection
 
              query = cycle[0]
              max_query = cycle[1]
              print("Number of cycle(s): ", max_query)
              print("Number of samples to move per cycle: ", query)
+             # A run is only resumed from a checkpoint with the same selection
+             settings = dict(query=query, max_query=max_query, batchsel=batchsel, kappa=kappa,
+                             target=target, refine=refine)
 
              if args.repeat:
                  #********************************************
@@ -391,31 +660,75 @@ def main():
                  if not args.nomeg:
                      (model, activations_input_full, Xfull, yfull, Xpool, ypool, Xtest,
                       ytest, Xtrain, ytrain, Xval, yval) = megnet_input(
-                          prop, args.include, bond, nfeat_global, cutoff, width, fraction)
+                          prop, args.include, bond, nfeat_global, cutoff, width, fraction,
+                          cache=args.graphcache)
+                     graphs = (graph_lookup(Xfull, activations_input_full) if args.pipeline
+                               else None)
+
+                 # The splits of megnet_input are contiguous in the full dataset
+                 pool = Pool(len(yfull),
+                             np.arange(len(ytrain)),
+                             np.arange(len(ytrain), len(ypool)),
+                             np.arange(len(ypool), len(yfull)))
                      
                  # Ensure there is adequate data in test set before proceeding
                  assert (query * max_query) < int(stop * len(ytest)),\
                      "Test set size should be at least %s%% the dataset after active learning. Reduce stop and/or cycle parameters!" %stop                     
 
-                 for i in range(max_query+1):
+                 checkpoint = "active_learn/repeat/%s_results/%s/checkpoint.npz" %(prop, samp)
+                 last = -1
+                 if args.resume:
+                     last, state = load_checkpoint(checkpoint, pool, settings)
+                 if last >= 0:
+                     # The next cycle trains the model of the last completed cycle
+                     fitted = "active_learn/repeat/%s_results/%s/0%s_model/fitted_%s_model.hdf5" %(
+                         prop, samp, last, prop)
+                     if not args.nomeg and epochs > 0:
+                         if not os.path.isfile(fitted):
+                             logging.error("Fitted model %s of cycle %s is missing!" %(fitted, last))
+                             sys.exit()
+                         logging.info("Loading the weights of %s ..." %fitted)
+                         model.load_weights(fitted)
+                     if refine > 0:
+                         logging.info("The Adam optimiser of -refine restarts on resume ...")
+                     amp, length_scale = float(state["amp"]), float(state["length_scale"])
+                     training_data = state["training_data"]
+                     Optmae_val_cycle = state["Optmae_val_cycle"]
+                     mae_test_cycle = state["mae_test_cycle"]
+                     mse_test_cycle = state["mse_test_cycle"]
+                     sae_test_cycle = state["sae_test_cycle"]
+
+                 # Hyperparameters and optimiser state are carried across cycles
+                 warm = WarmStart(rate) if refine > 0 else None
+
+                 for i in range(last+1, max_query+1):
                      print("\nQuery number ", i)
                      datadir = "active_learn/repeat/%s_results/%s/0%s_model" %(prop, samp, i)
+                     Xpool, ypool = Xfull[pool.pool], yfull[pool.pool]
+                     Xtest, ytest = Xfull[pool.candidates], yfull[pool.candidates]
+                     ytrain, yval = yfull[pool.train], yfull[pool.val]
 
                      if not args.nomeg and epochs > 0:
                          logging.info("Training MEGNet on the pool ...")
+                         new = np.isin(pool.pool, pool.acquired[-query:]) if i > 0 else None
                          training.active(datadir, i, prop, args.prev, model, samp,
-                                         batch, epochs, Xpool, ypool, Xtest, ytest)
+                                         batch, epochs, Xpool, ypool, Xtest, ytest,
+                                         finetune, new, graphs=graphs, max_atoms=maxatoms,
+                                         val=np.isin(pool.pool, pool.val))
                          
                      logging.info("Obtaining latent points for the full dataset ...")
                      latent_train, latent_val, latent_test = latent.active(
-                         datadir, prop, layer, samp, activations_input_full, Xfull, Xtest,
-                         ytest, Xtrain, Xval, perp, ndims, niters)
+                         datadir, prop, layer, samp, activations_input_full, Xfull, ytest,
+                         pool.train, pool.val, pool.candidates, perp, ndims, niters, reducer,
+                         landmarks, yfull, maxatoms)
 
                      logging.info("Gaussian Process initiated ...")
+                     cycle_iters = refine if (refine > 0 and i > 0) else maxiters
                      (OptLoss, OptAmp, OptLength, amp, length_scale, gp_mean, gp_stddev,
                       gp_variance, Optmae_val, mae_test, mse_test, sae_test, R) =\
                           adam.active(datadir, prop, latent_train, latent_val, latent_test,
-                                      ytrain, yval, ytest, maxiters, amp, length_scale, rate)
+                                      ytrain, yval, ytest, cycle_iters, amp, length_scale, rate,
+                                      warm)
                      
                      # Save some parameters for plotting purposes.
                      training_data = np.append(training_data, len(ytrain)) 
@@ -425,25 +738,47 @@ def main():
                      sae_test_cycle = np.append(sae_test_cycle, sae_test)
 
                      logging.info("Saving optimised hyperparameters and GP posterior plots ...")
-                     plot.active(datadir, prop, layer, maxiters, rate, OptLoss, OptAmp, OptLength,
-                                 samp, query, training_data, ytest, gp_mean, gp_stddev,
-                                 Optmae_val_cycle, mae_test_cycle, mae_test, mse_test, sae_test, R)
+                     writer.submit(plot.active, datadir, prop, layer, cycle_iters, rate, OptLoss,
+                                   OptAmp, OptLength, samp, query, training_data, ytest, gp_mean,
+                                   gp_stddev, Optmae_val_cycle, mae_test_cycle, mae_test,
+                                   mse_test, sae_test, R)
 
                      # Sample using variance on the predictions 
                      if i < max_query:
-                         if samp == "entropy":
+                         # adam.active has predicted all the candidates, i.e. the test set,
+                         # so the selection is made on the full arrays
+                         if batchsel != "topk":
+                             if i == 0:
+                                 logging.info("Batch sampling for active learning enabled ...")
+                             BatchSelection(i, pool, batchsel, Posterior(
+                                 latent_train, ytrain, amp, length_scale), latent_test, query,
+                                 max_query, lambda mean, variance: next(acquisition_scores(
+                                     samp, [(mean, variance)], ytrain, kappa=kappa, target=target)))
+                         elif samp == "entropy":
                              if i == 0:
                                  logging.info("Entropy sampling for active learning enabled ...")
-                             Xpool, ypool, Xtrain, ytrain, Xtest, ytest = EntropySelection(
-                                 i, Xtrain, ytrain, Xtest, ytest, Xval, yval, gp_variance, query, max_query)
+                             EntropySelection(i, pool, gp_variance, query, max_query)
+                         elif samp != "random":
+                             if i == 0:
+                                 logging.info("%s sampling for active learning enabled ..." %samp.upper())
+                             AcquisitionSelection(i, pool, samp, next(acquisition_scores(
+                                 samp, [(gp_mean, gp_variance)], ytrain, kappa=kappa,
+                                 target=target)), query, max_query)
                          elif samp == "random":
                              if	i == 0:
                                  logging.info("Random sampling for active learning enabled ...")
-                             Xpool, ypool, Xtrain, ytrain, Xtest, ytest = RandomSelection(
-                                 i, Xtrain, ytrain, Xtest, ytest, Xval, yval, gp_variance, query, max_query)
-                     elif i == max_query:
-                         if os.path.isdir("callback/"):
-                             subprocess.call(["rm", "-r", "callback"])
+                             RandomSelection(i, pool, gp_variance, query, max_query)
+
+                     # The results of the cycle are on disk before it is recorded as done
+                     writer.flush()
+                     save_checkpoint(checkpoint, pool, i, settings, amp=amp,
+                                     length_scale=length_scale,
+                                     latent="%s/latent_full.npy" %datadir,
+                                     training_data=training_data,
+                                     Optmae_val_cycle=Optmae_val_cycle,
+                                     mae_test_cycle=mae_test_cycle,
+                                     mse_test_cycle=mse_test_cycle,
+                                     sae_test_cycle=sae_test_cycle)
                              
              else:
                  import matplotlib
@@ -459,31 +794,30 @@ def main():
                  mae_test_cycle = np.array([]) 
                  mse_test_cycle = np.array([]) 
                  sae_test_cycle = np.array([])
-                 samp_idx = np.array([])
                  
                  if not args.nomeg:
                      model, activations_input_full, Xfull, yfull =\
                          megnet_input(prop, args.include, bond, nfeat_global, cutoff, width,
-                                      fraction, quan)
+                                      fraction, quan, cache=args.graphcache)
+                     graphs = (graph_lookup(Xfull, activations_input_full) if args.pipeline
+                               else None)
 
                  datadir = "active_learn/norepeat/%s_results/%s_model" %(prop, quan)
                  if not os.path.isdir(datadir):
                      os.makedirs(datadir)
-                         
-                 Xpool = Xfull[:quan]
-                 ypool = yfull[:quan]
-                 Xtest = Xfull[quan:]
-                 ytest = yfull[quan:]
+
+                 val_boundary = int(quan * val_frac)
+                 pool = Pool(len(yfull),
+                             np.arange(quan - val_boundary),
+                             np.arange(quan - val_boundary, quan),
+                             np.arange(quan, len(yfull)))
+                 Xpool, ypool = Xfull[pool.pool], yfull[pool.pool]
+                 Xtest, ytest = Xfull[pool.candidates], yfull[pool.candidates]
+                 ytrain, yval = yfull[pool.train], yfull[pool.val]
 
                  # Ensure there is adequate data in test set before proceeding
                  assert (query * max_query) < int(stop * len(ytest)),\
                      "Test set size should be at least %s%% the dataset after active learning. Reduce stop and/or cycle parameters!" %stop
-                     
-                 val_boundary = int(len(Xpool) * val_frac)
-                 Xtrain = Xpool[:-val_boundary]
-                 ytrain = ypool[:-val_boundary]
-                 Xval = Xpool[-val_boundary:]
-                 yval = ypool[-val_boundary:]
 
                  print("Requested validation set: %s%% of pool" %(val_frac*100))
                  print("Training set:", ytrain.shape)
@@ -491,40 +825,70 @@ def main():
                  print("Test set:", ytest.shape)
 
                  logging.info("Saving the data to file ...")
-                 np.save("%s/ytrain.npy" %datadir, ytrain)
-                 np.save("%s/yval.npy" %datadir, yval)
-
-                 print("\nProcessing %s samples ..." %quan)
-                 # MEGNet train and tSNE analyse or scale features once 
-                 if not args.nomeg and epochs > 0:
-                     training.train_test_split(datadir, prop, args.prev, model, batch,
-                                               epochs, Xpool, ypool, Xtest, ytest)
-                     
-                 logging.info("Obtaining latent points for the full dataset ...")
-                 latent.active(datadir, prop, layer, samp, activations_input_full,
-                               Xfull, Xtest, ytest, Xtrain, Xval, perp, ndims, niters)
-                     
-                 logging.info("Loading the latent points ...")
-                 latent_train = np.load("%s/latent_train.npy" %datadir)
-                 latent_test = np.load("%s/latent_test.npy" %datadir)
-                 latent_val = np.load("%s/latent_val.npy" %datadir)
+                 save_results(datadir, ytrain=ytrain, yval=yval)
 
                  # Lets create a new data directory and dump GP results into it 
-                 datadir = datadir + "/" + samp + "/%s_samples" %query
+                 resultdir = datadir + "/" + samp + "/%s_samples" %query
+                 checkpoint = "%s/checkpoint.npz" %resultdir
+                 last = -1
+                 if args.resume:
+                     last, state = load_checkpoint(checkpoint, pool, dict(settings, quan=quan))
+                     if last >= 0 and refine > 0:
+                         logging.info("The Adam optimiser of -refine restarts on resume ...")
+
+                 if last < 0:
+                     print("\nProcessing %s samples ..." %quan)
+                     # MEGNet train and tSNE analyse or scale features once 
+                     if not args.nomeg and epochs > 0:
+                         training.train_test_split(datadir, prop, args.prev, model, batch,
+                                                   epochs, Xpool, ypool, Xtest, ytest, graphs,
+                                                   maxatoms)
+
+                     logging.info("Obtaining latent points for the full dataset ...")
+                     latent.active(datadir, prop, layer, samp, activations_input_full,
+                                   Xfull, ytest, pool.train, pool.val, pool.candidates, perp,
+                                   ndims, niters, reducer, landmarks, yfull, maxatoms)
+                     latent_file = "%s/latent_full.npy" %datadir
+                 else:
+                     # MEGNet training and the latent points are shared by all cycles
+                     latent_file = str(state["latent"])
+                     amp, length_scale = float(state["amp"]), float(state["length_scale"])
+                     training_data = state["training_data"]
+                     Optmae_val_cycle = state["Optmae_val_cycle"]
+                     mae_test_cycle = state["mae_test_cycle"]
+                     mse_test_cycle = state["mse_test_cycle"]
+                     sae_test_cycle = state["sae_test_cycle"]
+
+                 logging.info("Loading the latent points ...")
+                 latent_full = np.load(latent_file, mmap_mode="r")
+
+                 datadir = resultdir
                  if not os.path.isdir(datadir):
                      os.makedirs(datadir)
                          
-                 for i in range(max_query+1):
+                 warm = WarmStart(rate) if refine > 0 else None
+                 for i in range(last+1, max_query+1):
                      print("\nQuery number ", i)
+                     latent_train, ytrain = latent_full[pool.train], yfull[pool.train]
+                     latent_val, yval = latent_full[pool.val], yfull[pool.val]
+                     latent_test, ytest = latent_full[pool.candidates], yfull[pool.candidates]
 
                      # Run the Gaussian Process
                      # GP train only at query 0 for the best hyperparameters
-                     # required for the subsequent queries 
+                     # required for the subsequent queries, which refine
+                     # them for -refine steps if requested
                      if i == 0:
                          (OptLoss, OptAmp, OptLength, amp, length_scale, gp_mean, gp_stddev,
                           gp_variance, Optmae_val, mae_test, mse_test, sae_test, R) =\
                               adam.active(datadir, prop, latent_train, latent_val, latent_test,
-                                          ytrain, yval, ytest, maxiters, amp, length_scale, rate)
+                                          ytrain, yval, ytest, maxiters, amp, length_scale, rate,
+                                          warm)
+                     elif refine > 0:
+                         (OptLoss, OptAmp, OptLength, amp, length_scale, gp_mean, gp_stddev,
+                          gp_variance, Optmae_val, mae_test, mse_test, sae_test, R) =\
+                              adam.active(datadir, prop, latent_train, latent_val, latent_test,
+                                          ytrain, yval, ytest, refine, amp, length_scale, rate,
+                                          warm)
                      else: 
                          maxiters = 0
                          (OptLoss, OptAmp, OptLength, Amp, Length_Scale, gp_mean, gp_stddev,
@@ -544,32 +908,61 @@ def main():
                          Optmae_val_cycle = np.append(Optmae_val_cycle, Optmae_val) 
 
                      if i < max_query: 
-                         if samp == "entropy":
+                         # adam.active has predicted all the candidates, i.e. the test set,
+                         # so the selection is made on the full arrays
+                         if batchsel != "topk":
+                             if i == 0:
+                                 logging.info("Batch sampling for active learning enabled ...")
+                             BatchSelection(i, pool, batchsel, Posterior(
+                                 latent_train, ytrain, amp, length_scale), latent_test, query,
+                                 max_query, lambda mean, variance: next(acquisition_scores(
+                                     samp, [(mean, variance)], ytrain, kappa=kappa, target=target)))
+                         elif samp == "entropy":
                              if i == 0:
                                  logging.info("Entropy sampling for active learning enabled ...")
-                             idx, latent_pool, ypool, latent_train, ytrain, latent_test, ytest  =\
-                                 EntropySelection(i, latent_train, ytrain, latent_test, ytest,
-                                                  latent_val, yval, gp_variance, query, max_query)
+                             EntropySelection(i, pool, gp_variance, query, max_query)
+                         elif samp != "random":
+                             if i == 0:
+                                 logging.info("%s sampling for active learning enabled ..." %samp.upper())
+                             AcquisitionSelection(i, pool, samp, next(acquisition_scores(
+                                 samp, [(gp_mean, gp_variance)], ytrain, kappa=kappa,
+                                 target=target)), query, max_query)
                          elif samp == "random":
                              if i == 0:
                                  logging.info("Random sampling for active learning enabled ...")
-                             idx, latent_pool, ypool, latent_train, ytrain, latent_test, ytest  =\
-                                 RandomSelection(i, latent_train, ytrain, latent_test, ytest,
-                                                 latent_val, yval, gp_variance, query, max_query)
-                         samp_idx = np.append(samp_idx, idx)
+                             RandomSelection(i, pool, gp_variance, query, max_query)
+
+                     # The results of the cycle are on disk before it is recorded as done
+                     writer.flush()
+                     save_checkpoint(checkpoint, pool, i, dict(settings, quan=quan), amp=amp,
+                                     length_scale=length_scale, latent=latent_file,
+                                     training_data=training_data,
+                                     Optmae_val_cycle=Optmae_val_cycle,
+                                     mae_test_cycle=mae_test_cycle,
+                                     mse_test_cycle=mse_test_cycle,
+                                     sae_test_cycle=sae_test_cycle)
                                  
                  logging.info("Writing the results to file ...")
-                 np.save("%s/training_data_for_plotting.npy" %datadir, training_data)
-                 np.save("%s/gp_mae.npy" %datadir, mae_test_cycle)
-                 np.save("%s/gp_mse.npy" %datadir, mse_test_cycle)
-                 np.save("%s/gp_sae.npy" %datadir, sae_test_cycle)
-                 np.save("%s/samp_indices.npy" %datadir, samp_idx)
-                 np.save("%s/Xtest.npy" %datadir, np.delete(Xtest, samp_idx))                 
+                 save_results(datadir, training_data_for_plotting=training_data,
+                              gp_mae=mae_test_cycle, gp_mse=mse_test_cycle,
+                              gp_sae=sae_test_cycle, samp_indices=pool.acquired)
+                 save_splits(datadir, Xtest=Xfull[pool.candidates])
                  if maxiters > 0:
-                     np.save("%s/val_mae.npy" %datadir, Optmae_val_cycle)
+                     save_results(datadir, val_mae=Optmae_val_cycle)
 
                  logging.info("Saving plots ...")
-                 plot.norepeat(datadir, prop, layer, samp, query, maxiters)
+                 # Runs after the writes above as the writer keeps their order
+                 writer.submit(plot.norepeat, datadir, prop, layer, samp, query, maxiters)
+
+        # Timings, memory and counters of the stages of this property
+        if args.noactive:
+            resultdir = "%s/%s_results" %("train_test_split" if nsplit == 1 else "k_fold", prop)
+        else:
+            resultdir = "active_learn/%s/%s_results" %("repeat" if args.repeat else "norepeat",
+                                                       prop)
+        writer.flush()
+        write_profile("%s/profile.json" %resultdir)
+        reset()
 
 
                  
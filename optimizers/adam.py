@@ -21,6 +21,46 @@ tfd = tfp.distributions
 tfk = tfp.math.psd_kernels
 tfb = tfp.bijectors 
 
+from aux.instrument import timed, count, maximum
+from aux.results import save_results
+
+
+class CountedRegressionModel:
+
+    def __init__(self, model):
+        """
+        CountedRegressionModel(model)
+
+        GP regression model of TFP 0.9 counting the factorisations of 
+        its kernel matrix. The model factorises the kernel matrix of 
+        the observations on every call of mean, stddev and variance.
+
+        Inputs:
+        model-      tfd.GaussianProcessRegressionModel.
+        """
+        self.model = model
+
+    def __getattr__(self, name):
+        method = getattr(self.model, name)
+        if name not in ("mean", "stddev", "variance"):
+            return method
+
+        def counted(*args, **kwargs):
+            count("cholesky")
+            return method(*args, **kwargs)
+        return counted
+
+
+def regression_model(**kwargs):
+    """
+    regression_model(**kwargs)
+
+    Outputs:
+    1-          tfd.GaussianProcessRegressionModel(**kwargs) counting
+                the factorisations of its kernel matrix.
+    """
+    return CountedRegressionModel(tfd.GaussianProcessRegressionModel(**kwargs))
+
 
 def convert_index_points(array):
     """
@@ -39,8 +79,55 @@ def convert_index_points(array):
     return tf.constant(array, dtype=tf.float64, shape=shape), shape[1]
 
 
+class WarmStart:
+
+    def __init__(self, rate):
+        """
+        WarmStart(rate)
+
+        Carries the trainable GP hyperparameters and the state of the 
+        Adam optimiser from one cycle of active learning to the next, 
+        so a cycle only refines the optimum of the previous cycle.
+
+        Inputs:
+        rate-           Learning rate for Adam optimisation.
+        """
+        self.optimizer = tf.optimizers.Adam(learning_rate=rate)
+        self.amp = None
+        self.length_scale = None
+
+    def variables(self, amp, length_scale):
+        """
+        warm.variables(amp, length_scale)
+
+        Inputs:
+        amp-            Starting value of the kernel amplitude.
+        length_scale-   Starting value of the kernel width.
+
+        Outputs:
+        1-              Trainable amplitude. It is created on the first 
+                        call and reset to amp afterwards, keeping the 
+                        moments of the optimiser.
+        2-              Trainable length scale.
+        """
+        if self.amp is None:
+            self.amp = tfp.util.TransformedVariable(initial_value=amp,
+                                                    bijector=tfb.Exp(),
+                                                    name="amp",
+                                                    dtype=tf.float64)
+            self.length_scale = tfp.util.TransformedVariable(initial_value=length_scale,
+                                                             bijector=tfb.Exp(),
+                                                             name="length_scale",
+                                                             dtype=tf.float64)
+        else:
+            self.amp.assign(amp)
+            self.length_scale.assign(length_scale)
+        return self.amp, self.length_scale
+
+
 class adam:
         
+    @timed
     def train_test_split(datadir, prop, tsne_pool, tsne_test, ypool_dft,
                          ytest_dft, maxiters, amp, length_scale, rate):
         """
@@ -76,6 +163,7 @@ class adam:
         latent_pool = convert_index_points(tsne_pool)[0]
         latent_test = convert_index_points(tsne_test)[0]
         feature_ndims = convert_index_points(tsne_pool)[1]
+        maximum("kernel_matrix_size", len(tsne_pool))
 
         # Define the DFT-calculated values
         ypool_dft = tf.constant(ypool_dft, dtype=tf.float64)
@@ -88,7 +176,7 @@ class adam:
             print("Prior on the width of the kernel = %.4f" %length_scale.numpy())
             logging.info("No bijector is applied to the priors ...")
 
-            gprm_dft = tfd.GaussianProcessRegressionModel(
+            gprm_dft = regression_model(
                 kernel=tfk.MaternOneHalf(amp,
                                          length_scale,
                                          feature_ndims=feature_ndims), 
@@ -136,10 +224,12 @@ class adam:
                     loss = loss_fn()
                 grads = tape.gradient(loss, trainables())
                 optimizer.apply_gradients(zip(grads, trainables()))
+                # The gradient reuses the factorisation of the loss
+                count("cholesky")
                 OptLoss = np.append(OptLoss, loss.numpy())
                 OptAmp = np.append(OptAmp, amp._value().numpy())
                 OptLength = np.append(OptLength, length_scale._value().numpy())
-                gprm_dft = tfd.GaussianProcessRegressionModel(
+                gprm_dft = regression_model(
                     kernel=tfk.MaternOneHalf(OptAmp[i],
                                              OptLength[i],
                                              feature_ndims=feature_ndims),
@@ -159,17 +249,12 @@ class adam:
 
         logging.info("Writing results to file ...")
         if maxiters > 0:
-            np.save("%s/OptLoss.npy" %datadir, OptLoss) 
-            np.save("%s/OptAmp.npy" %datadir, OptAmp) 
-            np.save("%s/OptLength.npy" %datadir, OptLength) 
-            np.save("%s/Optmae.npy" %datadir, Optmae) 
-            np.save("%s/Optmse.npy" %datadir, Optmse)
-            np.save("%s/Optsae.npy" %datadir, Optsae)
-        np.save("%s/ypool.npy" %datadir, ypool_dft.numpy())
-        np.save("%s/ytest.npy" %datadir, ytest_dft.numpy())
-        np.save("%s/gp_mean.npy" %datadir, gprm_dft.mean().numpy())
-        np.save("%s/gp_stddev.npy" %datadir, gprm_dft.stddev().numpy())
-        np.save("%s/gp_variance.npy" %datadir, gprm_dft.variance().numpy())
+            save_results(datadir, OptLoss=OptLoss, OptAmp=OptAmp, OptLength=OptLength,
+                         Optmae=Optmae, Optmse=Optmse, Optsae=Optsae)
+        save_results(datadir, attrs=dict(prop=prop, maxiters=maxiters, rate=rate),
+                     ypool=ypool_dft.numpy(), ytest=ytest_dft.numpy(),
+                     gp_mean=gprm_dft.mean().numpy(), gp_stddev=gprm_dft.stddev().numpy(),
+                     gp_variance=gprm_dft.variance().numpy())
 
         if maxiters <= 0:
             print("\nPrediction statistics: mae = %.4f, mse = %.4f, sae = %.4f, min(std) = %.4f, max(std) = %.4f, R = %.4f"
@@ -212,6 +297,7 @@ class adam:
                      R )
 
 
+    @timed
     def k_fold(datadir, prop, tsne_train, tsne_val, tsne_test, ytrain_dft,
                yval_dft, ytest_dft, maxiters, amp, length_scale, rate):
         """ 
@@ -246,6 +332,7 @@ class adam:
         latent_val = convert_index_points(tsne_val)[0]
         latent_test = convert_index_points(tsne_test)[0]
         feature_ndims = convert_index_points(tsne_train)[1] 
+        maximum("kernel_matrix_size", len(tsne_train))
         
         # Define the DFT-calculated values
         ytrain_dft = tf.constant(ytrain_dft, dtype=tf.float64)
@@ -263,10 +350,10 @@ class adam:
             Optkernel = tfk.MaternOneHalf(amp, 
                                           length_scale,
                                           feature_ndims=feature_ndims)
-            gprm_dft = tfd.GaussianProcessRegressionModel(kernel=Optkernel,
-                                                          index_points=latent_test,
-                                                          observation_index_points=latent_train,
-                                                          observations=ytrain_dft)
+            gprm_dft = regression_model(kernel=Optkernel,
+                                        index_points=latent_test,
+                                        observation_index_points=latent_train,
+                                        observations=ytrain_dft)
         else: 
             print("Requested optimisation with Adam algorithm at learning rate %s" %rate)
             print("Number of iterations = %s" %maxiters)
@@ -307,10 +394,12 @@ class adam:
                     loss = loss_fn()
                 grads = tape.gradient(loss, trainables())
                 optimizer.apply_gradients(zip(grads, trainables()))
+                # The gradient reuses the factorisation of the loss
+                count("cholesky")
                 OptLoss = np.append(OptLoss, loss.numpy()) 
                 OptAmp = np.append(OptAmp, amp._value().numpy())
                 OptLength = np.append(OptLength, length_scale._value().numpy())
-                gprm = tfd.GaussianProcessRegressionModel(
+                gprm = regression_model(
                     kernel=tfk.MaternOneHalf(OptAmp[i],
                                              OptLength[i],
                                              feature_ndims=feature_ndims),
@@ -333,10 +422,10 @@ class adam:
             Optkernel = tfk.MaternOneHalf(OptAmp[np.argmin(Optmae_val)],
                                           OptLength[np.argmin(Optmae_val)],
                                           feature_ndims=feature_ndims)
-            gprm_dft = tfd.GaussianProcessRegressionModel(kernel=Optkernel,
-                                                          index_points=latent_test,
-                                                          observation_index_points=latent_train,
-                                                          observations=ytrain_dft)
+            gprm_dft = regression_model(kernel=Optkernel,
+                                        index_points=latent_test,
+                                        observation_index_points=latent_train,
+                                        observations=ytrain_dft)
 
         # Compute the Pearson correlation coefficient, MAE, MSE and
         # standard deviation on the absolute error (SAE) on the test set 
@@ -354,21 +443,13 @@ class adam:
 
         logging.info("Writing results to file ...")
         if maxiters > 0:
-            np.save("%s/OptLoss.npy" %datadir, OptLoss)
-            np.save("%s/OptAmp.npy" %datadir, OptAmp)
-            np.save("%s/OptLength.npy" %datadir, OptLength)
-            np.save("%s/Optmae_val.npy" %datadir, Optmae_val)
-            np.save("%s/Optmse_val.npy" %datadir, Optmse_val)
-            np.save("%s/Optsae_val.npy" %datadir, Optsae_val)
-        np.save("%s/ytrain.npy" %datadir, ytrain_dft.numpy())
-        np.save("%s/yval.npy" %datadir, yval_dft.numpy())
-        np.save("%s/ytest.npy" %datadir, ytest_dft.numpy())
-        np.save("%s/mae_test.npy" %datadir, mae_test)
-        np.save("%s/mse_test.npy" %datadir, mse_test)
-        np.save("%s/sae_test.npy" %datadir, sae_test)
-        np.save("%s/gp_mean.npy" %datadir, gprm_dft.mean().numpy())
-        np.save("%s/gp_stddev.npy" %datadir, gprm_dft.stddev().numpy())
-        np.save("%s/gp_variance.npy" %datadir, gprm_dft.variance().numpy())
+            save_results(datadir, OptLoss=OptLoss, OptAmp=OptAmp, OptLength=OptLength,
+                         Optmae_val=Optmae_val, Optmse_val=Optmse_val, Optsae_val=Optsae_val)
+        save_results(datadir, attrs=dict(prop=prop, maxiters=maxiters, rate=rate),
+                     ytrain=ytrain_dft.numpy(), yval=yval_dft.numpy(), ytest=ytest_dft.numpy(),
+                     mae_test=mae_test, mse_test=mse_test, sae_test=sae_test,
+                     gp_mean=gprm_dft.mean().numpy(), gp_stddev=gprm_dft.stddev().numpy(),
+                     gp_variance=gprm_dft.variance().numpy())
 
         if maxiters <= 0:
             return ( amp.numpy(),
@@ -384,11 +465,12 @@ class adam:
                      mae_test )
 
         
+    @timed
     def active(datadir, prop, tsne_train, tsne_val, tsne_test, ytrain_dft,
-               yval_dft, ytest_dft, maxiters, amp, length_scale, rate):
+               yval_dft, ytest_dft, maxiters, amp, length_scale, rate, warm=None):
         """
         adam.active(datadir, prop, tsne_train, tsne_val, tsne_test, ytrain_dft, 
-                    yval_dft, ytest_dft, maxiters, amp, length_scale, rate)
+                    yval_dft, ytest_dft, maxiters, amp, length_scale, rate, warm)
 
         A Gaussian Process (GP) with a Matern One Half kernel. The GP is first
         trained to minimise the MAE on the validation set. The best hyperparameters
@@ -409,6 +491,9 @@ class adam:
         amp-            Maximum value of the kernel.
         length_scale-   The width of the kernel.
         rate-           Learning rate for Adam optimisation.
+        warm-           WarmStart carrying the hyperparameters and the
+                        optimiser state across cycles. None => new 
+                        hyperparameters and optimiser.
 
         Outputs:
         1-            Optimised loss.
@@ -429,6 +514,7 @@ class adam:
         latent_val = convert_index_points(tsne_val)[0]
         latent_test = convert_index_points(tsne_test)[0]
         feature_ndims = convert_index_points(tsne_train)[1]
+        maximum("kernel_matrix_size", len(tsne_train))
 
         # Define the DFT-calculated values 
         ytrain_dft = tf.constant(ytrain_dft, dtype=tf.float64)        
@@ -446,26 +532,31 @@ class adam:
             Optkernel = tfk.MaternOneHalf(amp, 
                                           length_scale,
                                           feature_ndims=feature_ndims) 
-            gprm_dft = tfd.GaussianProcessRegressionModel(kernel=Optkernel,
-                                                          index_points=latent_test,
-                                                          observation_index_points=latent_train,
-                                                          observations=ytrain_dft)
+            gprm_dft = regression_model(kernel=Optkernel,
+                                        index_points=latent_test,
+                                        observation_index_points=latent_train,
+                                        observations=ytrain_dft)
         else:
             print("Requested optimisation with Adam algorithm at learning rate %s" %rate)
             print("Number of iterations = %s" %maxiters)
             print("Prior on the amplitude of the kernel = %s" %amp)
             print("Prior on the width of the kernel = %s" %length_scale)
-            optimizer = tf.optimizers.Adam(learning_rate=rate)
-            
-            # Create a trainable variables and apply positive constraint
-            amp = tfp.util.TransformedVariable(initial_value=amp,
-                                               bijector=tfb.Exp(),
-                                               name="amp",
-                                               dtype=tf.float64)
-            length_scale = tfp.util.TransformedVariable(initial_value=length_scale,
-                                                        bijector=tfb.Exp(),
-                                                        name="length_scale",
-                                                        dtype=tf.float64)
+            if warm is not None:
+                logging.info("Warm start from the hyperparameters and optimiser of the previous cycle ...")
+                optimizer = warm.optimizer
+                amp, length_scale = warm.variables(amp, length_scale)
+            else:
+                optimizer = tf.optimizers.Adam(learning_rate=rate)
+
+                # Create a trainable variables and apply positive constraint
+                amp = tfp.util.TransformedVariable(initial_value=amp,
+                                                   bijector=tfb.Exp(),
+                                                   name="amp",
+                                                   dtype=tf.float64)
+                length_scale = tfp.util.TransformedVariable(initial_value=length_scale,
+                                                            bijector=tfb.Exp(),
+                                                            name="length_scale",
+                                                            dtype=tf.float64)
             def trainables():
                 return [var.trainable_variables[0] for var in [amp, length_scale]]
 
@@ -489,10 +580,12 @@ class adam:
                     loss = loss_fn()
                 grads = tape.gradient(loss, trainables())
                 optimizer.apply_gradients(zip(grads, trainables()))
+                # The gradient reuses the factorisation of the loss
+                count("cholesky")
                 OptLoss = np.append(OptLoss, loss.numpy())
                 OptAmp = np.append(OptAmp, amp._value().numpy())
                 OptLength = np.append(OptLength, length_scale._value().numpy())
-                gprm = tfd.GaussianProcessRegressionModel(
+                gprm = regression_model(
                     kernel=tfk.MaternOneHalf(OptAmp[i],
                                              OptLength[i],
                                              feature_ndims=feature_ndims),
@@ -516,10 +609,10 @@ class adam:
             Optkernel = tfk.MaternOneHalf(OptAmp[np.argmin(Optmae_val)],
                                           OptLength[np.argmin(Optmae_val)],
                                           feature_ndims=feature_ndims) 
-            gprm_dft = tfd.GaussianProcessRegressionModel(kernel=Optkernel,
-                                                          index_points=latent_test,
-                                                          observation_index_points=latent_train,
-                                                          observations=ytrain_dft)
+            gprm_dft = regression_model(kernel=Optkernel,
+                                        index_points=latent_test,
+                                        observation_index_points=latent_train,
+                                        observations=ytrain_dft)
 
         # Compute the Pearson correlation coefficient, MAE, MSE and
         # standard deviation on the absolute error (SAE) on the test set
@@ -537,18 +630,12 @@ class adam:
 
         logging.info("Writing results to file ...")
         if maxiters > 0:
-            np.save("%s/OptLoss.npy" %datadir, OptLoss)
-            np.save("%s/OptAmp.npy" %datadir, OptAmp)
-            np.save("%s/OptLength.npy" %datadir, OptLength)
-            np.save("%s/Optmae_val.npy" %datadir, Optmae_val)
-            np.save("%s/Optmse_val.npy" %datadir, Optmse_val)
-            np.save("%s/Optsae_val.npy" %datadir, Optsae_val)
-        np.save("%s/ytrain.npy" %datadir, ytrain_dft.numpy())
-        np.save("%s/yval.npy" %datadir, yval_dft.numpy())
-        np.save("%s/ytest.npy" %datadir, ytest_dft.numpy())        
-        np.save("%s/gp_mean.npy" %datadir, gprm_dft.mean().numpy())
-        np.save("%s/gp_stddev.npy" %datadir, gprm_dft.stddev().numpy())
-        np.save("%s/gp_variance.npy" %datadir, gprm_dft.variance().numpy())
+            save_results(datadir, OptLoss=OptLoss, OptAmp=OptAmp, OptLength=OptLength,
+                         Optmae_val=Optmae_val, Optmse_val=Optmse_val, Optsae_val=Optsae_val)
+        save_results(datadir, attrs=dict(prop=prop, maxiters=maxiters, rate=rate),
+                     ytrain=ytrain_dft.numpy(), yval=yval_dft.numpy(), ytest=ytest_dft.numpy(),
+                     gp_mean=gprm_dft.mean().numpy(), gp_stddev=gprm_dft.stddev().numpy(),
+                     gp_variance=gprm_dft.variance().numpy())
                     
         # Lets predict the test DFT values and estimate the
         # uncertainties on the prediction. Since a log-loss
@@ -0,0 +1,190 @@
+"""
+multitask.py, SciML-SCD, RAL
+
+Multi-output Gaussian Process over a latent space shared by several
+optical properties. The targets of each property are standardised
+and share the hyperparameters of one Matern One Half kernel, so a
+single Cholesky factorisation of the kernel matrix of the pool
+serves all the properties through a multi-right-hand-side solve,
+both during the optimisation of the hyperparameters and for the
+predictions.
+"""
+import logging
+import os
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
+                    format="%(levelname)s:gp-net: %(message)s")
+import numpy as np
+from scipy.spatial.distance import cdist
+from scipy.stats import pearsonr
+
+import tensorflow.compat.v2 as tf
+tf.enable_v2_behavior()
+import tensorflow_probability as tfp
+tfb = tfp.bijectors
+
+from optimizers.posterior import Posterior
+from aux.instrument import timed, count, maximum
+from aux.results import save_results
+
+
+def standardise(targets):
+    """
+    standardise(targets)
+
+    Inputs:
+    targets-        Targets of shape (samples, properties).
+
+    Outputs:
+    1-              Targets with zero mean and unit variance per property.
+    2-              Mean of each property.
+    3-              Standard deviation of each property.
+    """
+    mean = targets.mean(axis=0)
+    std = targets.std(axis=0)
+    std[std == 0.] = 1.
+    return (targets - mean) / std, mean, std
+
+
+def negative_log_marginal(distances, targets, amp, length_scale, jitter=1e-6):
+    """
+    negative_log_marginal(distances, targets, amp, length_scale, jitter)
+
+    Sum over the properties of the negative log marginal likelihoods
+    of independent GPs sharing one kernel. The kernel matrix is
+    factorised once for all the properties.
+
+    Inputs:
+    distances-      Pairwise distances between the latent points.
+    targets-        Standardised targets of shape (samples, properties).
+    amp-            Amplitude of the kernel.
+    length_scale-   The width of the kernel.
+    jitter-         Added to the diagonal of the kernel matrix.
+
+    Outputs:
+    1-              The loss.
+    """
+    nsamples = tf.cast(tf.shape(targets)[0], tf.float64)
+    ntasks = tf.cast(tf.shape(targets)[1], tf.float64)
+    kernel = amp**2 * tf.exp(-distances / length_scale)
+    chol = tf.linalg.cholesky(kernel + jitter * tf.eye(tf.shape(distances)[0], dtype=tf.float64))
+    alpha = tf.linalg.cholesky_solve(chol, targets)
+    return (0.5 * tf.reduce_sum(targets * alpha) +
+            ntasks * tf.reduce_sum(tf.math.log(tf.linalg.diag_part(chol))) +
+            0.5 * nsamples * ntasks * np.log(2 * np.pi))
+
+
+class multitask:
+
+    @timed
+    def train_test_split(datadir, props, tsne_pool, tsne_test, ypool_dft, ytest_dft,
+                         maxiters, amp, length_scale, rate):
+        """
+        multitask.train_test_split(datadir, props, tsne_pool, tsne_test, ypool_dft,
+                                   ytest_dft, maxiters, amp, length_scale, rate)
+
+        A multi-output GP with a Matern One Half kernel shared by the
+        properties in the case where a train-test data split approach
+        is used. The hyperparameters with the lowest loss are used for
+        prediction.
+
+        Inputs:
+        datadir-            Directory into which results are written into.
+        props-              Optical properties of interest.
+        tsne_pool-          Latent points for the pool.
+        tsne_test-          Latent points for the test set.
+        ypool_dft-          DFT-calculated set in the pool, one column
+                            per property.
+        ytest_dft-          DFT-calculated set for testing.
+        maxiters-           Number of iterations for optimising hyperparameters.
+        amp-                Maximum value of the kernel.
+        length_scale-       The width of the kernel.
+        rate                Learning rate for Adam optimisation.
+
+        Outputs:
+        1-                  Optimised loss.
+        2-                  Optimised kernel amplitude.
+        3-                  Optimised kernel length scale.
+        4-                  MAE, MSE and the standard deviation on the
+                            MAE on the test set of each property.
+        5-                  GP prediction.
+        6-                  Uncertainty on the GP prediction.
+        7-                  Pearson correlation coefficient between the DFT-
+                            calculated and GP-predicted properties.
+        """
+        tsne_pool = np.asarray(tsne_pool, dtype=np.float64).reshape(len(tsne_pool), -1)
+        tsne_test = np.asarray(tsne_test, dtype=np.float64).reshape(len(tsne_test), -1)
+        ypool_dft = np.asarray(ypool_dft, dtype=np.float64)
+        ytest_dft = np.asarray(ytest_dft, dtype=np.float64)
+        zpool, ymean, ystd = standardise(ypool_dft)
+
+        OptLoss = np.array([ ])
+        OptAmp = np.array([ ])
+        OptLength = np.array([ ])
+        if maxiters > 0:
+            print("Requested optimisation with Adam algorithm at learning rate %s" %rate)
+            print("Number of iterations = %s" %maxiters)
+            print("Number of properties sharing the kernel = %s" %len(props))
+            optimizer = tf.optimizers.Adam(learning_rate=rate)
+            amp = tfp.util.TransformedVariable(initial_value=amp, bijector=tfb.Exp(),
+                                               name="amp", dtype=tf.float64)
+            length_scale = tfp.util.TransformedVariable(initial_value=length_scale,
+                                                        bijector=tfb.Exp(),
+                                                        name="length_scale", dtype=tf.float64)
+            def trainables():
+                return [var.trainable_variables[0] for var in [amp, length_scale]]
+
+            # The distances are computed once and shared by all iterations
+            distances = tf.constant(cdist(tsne_pool, tsne_pool), dtype=tf.float64)
+            maximum("kernel_matrix_size", len(tsne_pool))
+            targets = tf.constant(zpool, dtype=tf.float64)
+
+            logging.info("Training the multi-output GP on the pool ...")
+            @tf.function
+            def loss_fn():
+                return negative_log_marginal(distances, targets, amp, length_scale)
+
+            for i in range(maxiters):
+                with tf.GradientTape() as tape:
+                    loss = loss_fn()
+                count("cholesky")
+                grads = tape.gradient(loss, trainables())
+                optimizer.apply_gradients(zip(grads, trainables()))
+                OptLoss = np.append(OptLoss, loss.numpy())
+                OptAmp = np.append(OptAmp, amp._value().numpy())
+                OptLength = np.append(OptLength, length_scale._value().numpy())
+                if i % 10 == 0 or i + 1 == maxiters:
+                    print("At step %d: loss=%.4f, amplitude=%.4f, length_scale=%.4f"
+                          %(i, OptLoss[i], OptAmp[i], OptLength[i]))
+            amp = OptAmp[np.argmin(OptLoss)]
+            length_scale = OptLength[np.argmin(OptLoss)]
+            logging.info("Best-fitted parameters:")
+            print("          amplitude: %.4f" %amp)
+            print("          length_scale: %.4f" %length_scale)
+        else:
+            print("Prior on the amplitude of the kernel = %.4f" %amp)
+            print("Prior on the width of the kernel = %.4f" %length_scale)
+
+        logging.info("GP predicting the test set for all properties ...")
+        mean, variance = Posterior(tsne_pool, zpool, amp, length_scale).predict(tsne_test)
+        gp_mean = mean * ystd + ymean
+        gp_stddev = np.sqrt(variance)[:, None] * ystd
+
+        error = np.abs(gp_mean - ytest_dft)
+        mae_test = error.mean(axis=0)
+        mse_test = (error**2).mean(axis=0)
+        sae_test = error.std(axis=0)
+        R = np.array([pearsonr(ytest_dft[:, t], gp_mean[:, t])[0] for t in range(len(props))])
+        for t, prop in enumerate(props):
+            print("Prediction of %s: mae = %.4f, mse = %.4f, sae = %.4f, min(std) = %.4f, max(std) = %.4f, R = %.4f"
+                  %(prop, mae_test[t], mse_test[t], sae_test[t], gp_stddev[:, t].min(),
+                    gp_stddev[:, t].max(), R[t]))
+
+        logging.info("Writing results to file ...")
+        if maxiters > 0:
+            save_results(datadir, OptLoss=OptLoss, OptAmp=OptAmp, OptLength=OptLength)
+        save_results(datadir, attrs=dict(prop=",".join(props), maxiters=maxiters, rate=rate),
+                     ypool=ypool_dft, ytest=ytest_dft, gp_mean=gp_mean, gp_stddev=gp_stddev,
+                     gp_metrics=np.stack((mae_test, mse_test, sae_test, R)))
+
+        return (OptLoss, OptAmp, OptLength, (mae_test, mse_test, sae_test), gp_mean,
+                gp_stddev, R)
@@ -0,0 +1,118 @@
+"""
+posterior.py, SciML-SCD, RAL
+
+NumPy implementation of the posterior of the Matern One Half kernel
+Gaussian Process trained in adam.py. The training kernel matrix is
+factorised once and the posterior mean and variance are predicted
+in chunks, so large candidate sets never need to be held in memory
+as a whole.
+"""
+import numpy as np
+from scipy.linalg import cho_solve, solve_triangular
+from scipy.spatial.distance import cdist
+
+from aux.instrument import count, maximum
+
+
+def matern_one_half(x1, x2, amp, length_scale):
+    """
+    matern_one_half(x1, x2, amp, length_scale)
+
+    Inputs:
+    x1-             Latent points of shape (n1, features).
+    x2-             Latent points of shape (n2, features).
+    amp-            Amplitude of the kernel.
+    length_scale-   The width of the kernel.
+
+    Outputs:
+    1-              Kernel matrix of shape (n1, n2).
+    """
+    x1 = np.asarray(x1, dtype=np.float64).reshape(len(x1), -1)
+    x2 = np.asarray(x2, dtype=np.float64).reshape(len(x2), -1)
+    return amp**2 * np.exp(-cdist(x1, x2) / length_scale)
+
+
+class Posterior:
+
+    def __init__(self, latent_train, ytrain, amp, length_scale, jitter=1e-6):
+        """
+        Posterior(latent_train, ytrain, amp, length_scale, jitter)
+
+        Factorises the kernel matrix of the training set.
+
+        Inputs:
+        latent_train-   Latent points for the training set.
+        ytrain-         Targets for training. A 2D array holds one target
+                        per column and shares the factorisation.
+        amp-            Amplitude of the kernel.
+        length_scale-   The width of the kernel.
+        jitter-         Added to the diagonal of the kernel matrix for
+                        numerical stability, as in the TensorFlow
+                        Probability regression model.
+        """
+        self.latent_train = np.asarray(latent_train, dtype=np.float64)
+        self.amp = float(amp)
+        self.length_scale = float(length_scale)
+        self.jitter = jitter
+
+        kernel = matern_one_half(self.latent_train, self.latent_train, self.amp,
+                                 self.length_scale)
+        kernel[np.diag_indices_from(kernel)] += jitter
+        self.chol = np.linalg.cholesky(kernel)
+        count("cholesky")
+        maximum("kernel_matrix_size", len(kernel))
+        self.alpha = cho_solve((self.chol, True), np.asarray(ytrain, dtype=np.float64))
+
+    def predict(self, latent):
+        """
+        posterior.predict(latent)
+
+        Inputs:
+        latent-         Latent points to be predicted.
+
+        Outputs:
+        1-              Posterior mean.
+        2-              Posterior variance.
+        """
+        cross = matern_one_half(latent, self.latent_train, self.amp, self.length_scale)
+        mean = cross @ self.alpha
+        v = solve_triangular(self.chol, cross.T, lower=True)
+        variance = np.maximum(self.amp**2 - np.einsum("ij,ij->j", v, v), 0.)
+        return mean, variance
+
+    def covariance(self, latent_a, latent_b):
+        """
+        posterior.covariance(latent_a, latent_b)
+
+        Inputs:
+        latent_a-       Latent points of shape (na, features).
+        latent_b-       Latent points of shape (nb, features).
+
+        Outputs:
+        1-              Posterior covariance of shape (na, nb).
+        """
+        va = solve_triangular(self.chol, matern_one_half(
+            self.latent_train, latent_a, self.amp, self.length_scale), lower=True)
+        vb = solve_triangular(self.chol, matern_one_half(
+            self.latent_train, latent_b, self.amp, self.length_scale), lower=True)
+        return matern_one_half(latent_a, latent_b, self.amp, self.length_scale) - va.T @ vb
+
+    def predict_chunks(self, latent, idx=None, chunk=10000):
+        """
+        posterior.predict_chunks(latent, idx, chunk)
+
+        Generator over the posterior predictions of chunks of latent points.
+
+        Inputs:
+        latent-         Latent points, possibly memory-mapped.
+        idx-            Indices of the points of interest in latent.
+                        [default: all points]
+        chunk-          Number of points predicted at a time.
+
+        Outputs:
+        1-              Posterior mean and variance of each chunk.
+        """
+        if idx is None:
+            idx = np.arange(len(latent))
+        for start in range(0, len(idx), chunk):
+            yield self.predict(latent[idx[start:start+chunk]])
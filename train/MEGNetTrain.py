@@ -3,7 +3,8 @@ MEGNetTrain.py, SciML-SCD, RAL
 
 Trains on the optical properties of materials using the MEGNet 
 of materials. Refer to https://github.com/materialsvirtuallab/megnet 
-for more information on MEGNet. 
+for more information on MEGNet. When pre-converted graphs are passed,
+training is fed by the tf.data pipeline of train/input_pipeline.py.
 """
 import sys
 import subprocess 
@@ -13,16 +14,21 @@ logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
                     format="%(levelname)s:gp-net: %(message)s")
 
 import numpy as np
-from keras.callbacks import ModelCheckpoint
+from keras.callbacks import ModelCheckpoint, EarlyStopping
+
+from aux.instrument import timed
+from aux.dataset import save_splits
+from aux.results import save_results
 
 
 class training:
  
+    @timed
     def train_test_split(datadir, prop, prev, model, batch, epochs, Xpool,
-                         ypool, Xtest, ytest):
+                         ypool, Xtest, ytest, graphs=None, max_atoms=0):
         """
         training.train_test_split(datadir, prop, prev, model, batch, epochs,
-                                  Xpool, ypool, Xtest, ytest)
+                                  Xpool, ypool, Xtest, ytest, graphs, max_atoms)
         
         MEGNet training on train-test split dataset. In this instance, the 
         pool is the training set. 
@@ -38,6 +44,10 @@ class training:
         ypool-        Targets for training. 
         Xtest-        Structures for testing.
         ytest-        targets for testing. 
+        graphs-       Pre-converted graph inputs keyed by structure_key.
+                      None => structures converted by MEGNet.
+        max_atoms-    Maximum total number of atoms per batch of graphs
+                      grouped by size. 0 => no cap.
 
         Outputs:
         1-            A fitted model of the optical property of interest.
@@ -47,10 +57,9 @@ class training:
             os.makedirs(datadir)
             
         logging.info("Writing data to file ...")
-        np.save("%s/Xpool.npy" %datadir, Xpool)
-        np.save("%s/ypool.npy" %datadir, ypool)
-        np.save("%s/Xtest.npy" %datadir, Xtest) 
-        np.save("%s/ytest.npy" %datadir, ytest) 
+        save_splits(datadir, Xpool=Xpool, Xtest=Xtest)
+        save_results(datadir, attrs=dict(prop=prop, epochs=epochs, batch=batch), ypool=ypool,
+                     ytest=ytest)
             
         if type(prev) == bool:
             if prev == False:
@@ -79,19 +88,27 @@ class training:
         checkpoint = ModelCheckpoint("%s/model-best-new-%s.h5" %(datadir, prop),
                                      verbose=1, monitor="val_loss",
                                      save_best_only=True, mode="auto")
-        model.train(Xpool, ypool, epochs=epochs, batch_size=batch,
-                    validation_structures=Xtest, validation_targets=ytest,
-                    scrub_failed_structures=True, prev_model=prev_file,
-                    callbacks=[checkpoint])
+        if graphs is not None:
+            from train.input_pipeline import train_from_inputs
+            train_from_inputs(model, graphs, Xpool, ypool, Xtest, ytest, epochs, batch,
+                              prev_model=prev_file, callbacks=[checkpoint], max_atoms=max_atoms)
+        else:
+            # Processes training other properties run in the same directory
+            model.train(Xpool, ypool, epochs=epochs, batch_size=batch,
+                        validation_structures=Xtest, validation_targets=ytest,
+                        scrub_failed_structures=True, prev_model=prev_file,
+                        callbacks=[checkpoint], dirname="%s/callback" %datadir)
         model.save_model("%s/fitted_%s_model.hdf5" %(datadir, prop))
-        subprocess.call(["rm", "-r", "callback/"])
+        if os.path.isdir("%s/callback" %datadir):
+            subprocess.call(["rm", "-r", "%s/callback" %datadir])
 
 
+    @timed
     def k_fold(datadir, fold, prop, prev, model, batch, epochs, Xtrain, ytrain,
-               Xval, yval):
+               Xval, yval, graphs=None, max_atoms=0):
         """
         training.k_fold(fold, prop, prev, model, batch, epochs, Xtrain, ytrain
-                        Xval, yval)
+                        Xval, yval, graphs, max_atoms)
 
         MEGNet training on each fold of the k-fold cross-validation datasets.
         
@@ -107,6 +124,10 @@ class training:
         ytrain-     Targets for training.   
         Xval-       Structures for validation. 
         yval-       Targets for validation. 
+        graphs-     Pre-converted graph inputs keyed by structure_key.
+                    None => structures converted by MEGNet.
+        max_atoms-  Maximum total number of atoms per batch of graphs
+                    grouped by size. 0 => no cap.
 
         Outputs:
         1-          A fitted model of the optical property of interest.
@@ -116,10 +137,9 @@ class training:
             os.makedirs(datadir) 
 
         logging.info("Writing data to file ...")
-        np.save("%s/Xtrain.npy" %datadir, Xtrain)
-        np.save("%s/ytrain.npy" %datadir, ytrain)
-        np.save("%s/Xval.npy" %datadir, Xval)
-        np.save("%s/yval.npy" %datadir, yval)
+        save_splits(datadir, Xtrain=Xtrain, Xval=Xval)
+        save_results(datadir, attrs=dict(prop=prop, epochs=epochs, batch=batch), ytrain=ytrain,
+                     yval=yval)
 
         if prev == False:
             logging.info("No previous model will be used ...")
@@ -142,21 +162,36 @@ class training:
         checkpoint = ModelCheckpoint("%s/model-best-new-%s.h5" %(datadir, prop),
                                      verbose=1, monitor="val_loss",
                                      save_best_only=True, mode="auto")
-        model.train(Xtrain, ytrain, epochs=epochs, batch_size=batch,
-                    validation_structures=Xval, validation_targets=yval,
-                    scrub_failed_structures=True, prev_model=prev_file,
-                    callbacks=[checkpoint])
+        if graphs is not None:
+            from train.input_pipeline import train_from_inputs
+            train_from_inputs(model, graphs, Xtrain, ytrain, Xval, yval, epochs, batch,
+                              prev_model=prev_file, callbacks=[checkpoint], max_atoms=max_atoms)
+        else:
+            # Folds run concurrently with -workers
+            model.train(Xtrain, ytrain, epochs=epochs, batch_size=batch,
+                        validation_structures=Xval, validation_targets=yval,
+                        scrub_failed_structures=True, prev_model=prev_file,
+                        callbacks=[checkpoint], dirname="%s/callback" %datadir)
         model.save_model("%s/fitted_%s_model.hdf5" %(datadir, prop))
+        if os.path.isdir("%s/callback" %datadir):
+            subprocess.call(["rm", "-r", "%s/callback" %datadir])
 
 
+    @timed
     def active(datadir, i, prop, prev, model, sampling, batch, epochs, Xpool,
-               ypool, Xtest, ytest):
+               ypool, Xtest, ytest, finetune=(0, 1.), new=None, patience=3, graphs=None,
+               max_atoms=0, val=None):
         """
         training.active(datadir, i, prop, prev, model, sampling, batch, epochs, 
-                        Xpool, ypool, Xtest, ytest)
+                        Xpool, ypool, Xtest, ytest, finetune, new, patience, graphs,
+                        max_atoms, val)
         
         MEGNet training for active learning purposes. A pre-trained model
-        in a previous query is used in the next query. 
+        in a previous query is used in the next query. In fine-tuning mode,
+        the best model of the previous query is trained for a few epochs 
+        with the newly acquired samples weighted up, and training stops 
+        early once the loss on the validation set of the pool no longer 
+        improves. The candidates are never used to stop fine-tuning. 
     
         Inputs:
         datadir-            Directory into which results are written into.
@@ -174,6 +209,23 @@ class training:
         ypool-              Targets for training. 
         Xtest-              Structures for testing.
         ytest-              Targets for testing. 
+        finetune-           Number of fine-tuning epochs and weight of the
+                            newly acquired samples after query 0. 0 epochs
+                            => train for epochs in every query.
+        new-                Boolean mask of the newly acquired samples in
+                            the pool.
+        patience-           Number of fine-tuning epochs without 
+                            improvement of the validation loss before 
+                            training stops.
+        graphs-             Pre-converted graph inputs keyed by 
+                            structure_key. None => structures converted
+                            by MEGNet.
+        max_atoms-          Maximum total number of atoms per batch of 
+                            graphs grouped by size. 0 => no cap.
+        val-                Boolean mask of the validation samples in the 
+                            pool. They are held out of fine-tuning and 
+                            validate it. None => fine-tune on the pool and
+                            validate on the test set.
 
         Outputs:
         1-                  A fitted model of the optical property of 
@@ -185,10 +237,9 @@ class training:
             os.makedirs(datadir)
 
         logging.info("Writing data to file ...")
-        np.save("%s/Xpool.npy" %datadir, Xpool) 
-        np.save("%s/ypool.npy" %datadir, ypool) 
-        np.save("%s/Xtest.npy" %datadir, Xtest) 
-        np.save("%s/ytest.npy" %datadir, ytest) 
+        save_splits(datadir, Xpool=Xpool, Xtest=Xtest)
+        save_results(datadir, attrs=dict(prop=prop, epochs=epochs, batch=batch), ypool=ypool,
+                     ytest=ytest)
 
         # For identifying location of best models to be used in the next iteration, i
         if i == 0:
@@ -196,7 +247,8 @@ class training:
         else:
             j = i - 1
             
-        if prev == False:
+        tune = i > 0 and finetune[0] > 0
+        if prev == False and not tune:
             logging.info("No previous model will be used ...")
             prev_file = None
         else:
@@ -213,7 +265,32 @@ class training:
 
         checkpoint = ModelCheckpoint("%s/model-best-new-%s.h5" %(datadir, prop), verbose=1,
                                      monitor="val_loss", save_best_only=True, mode="auto")
-        model.train(Xpool, ypool, epochs=epochs, batch_size=batch, validation_structures=Xtest,
-                    validation_targets=ytest, scrub_failed_structures=True, prev_model=prev_file,
-                    callbacks=[checkpoint])
-        model.save_model("%s/fitted_%s_model.hdf5" %(datadir, prop)) 
+        callbacks = [checkpoint]
+        sample_weights = None
+        Xfit, yfit, Xval, yval = Xpool, ypool, Xtest, ytest
+        if tune:
+            epochs, weight = finetune
+            logging.info("Fine-tuning for at most %s epochs ..." %epochs)
+            callbacks.append(EarlyStopping(monitor="val_loss", patience=patience, mode="auto"))
+            if new is not None:
+                print("Weight of the %s newly acquired samples = %s" %(np.sum(new), weight))
+                sample_weights = np.where(new, weight, 1.)
+            if val is not None:
+                val = np.asarray(val, dtype=bool)
+                Xfit, yfit, Xval, yval = Xpool[~val], ypool[~val], Xpool[val], ypool[val]
+                if sample_weights is not None:
+                    sample_weights = sample_weights[~val]
+        if graphs is not None or sample_weights is not None:
+            # MEGNetModel.train of megnet 1.1.1 does not pass sample weights
+            # to Keras, so weighted fine-tuning converts the missing graphs
+            from train.input_pipeline import train_from_inputs
+            train_from_inputs(model, graphs or {}, Xfit, yfit, Xval, yval, int(epochs), batch,
+                              sample_weights, prev_file, callbacks, max_atoms)
+        else:
+            model.train(Xfit, yfit, epochs=int(epochs), batch_size=batch,
+                        validation_structures=Xval, validation_targets=yval,
+                        scrub_failed_structures=True, prev_model=prev_file,
+                        callbacks=callbacks, dirname="%s/callback" %datadir)
+        model.save_model("%s/fitted_%s_model.hdf5" %(datadir, prop))
+        if os.path.isdir("%s/callback" %datadir):
+            subprocess.call(["rm", "-r", "%s/callback" %datadir])
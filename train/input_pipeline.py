@@ -0,0 +1,252 @@
+"""
+input_pipeline.py, SciML-SCD, RAL
+
+Trains MEGNet from pre-converted graph inputs through a tf.data
+pipeline. The graphs of a batch are assembled by parallel map calls
+and prefetched, so that the optimiser steps are not interleaved with
+graph conversion and batch assembly on the Python thread as in
+MEGNetModel.train.
+
+Crystal graphs range from a few atoms to hundreds. With a cap on the
+atoms of a batch, the structures are grouped by size and packed into
+batches of similar graphs, which bounds the memory of a batch and
+wastes less compute on uneven batches.
+"""
+import logging
+import os
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"),
+                    format="%(levelname)s:gp-net: %(message)s")
+
+import numpy as np
+import tensorflow as tf
+
+from aux.get_info import structure_key, graph_input
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def graph_lookup(structures, inputs):
+    """
+    graph_lookup(structures, inputs)
+
+    Inputs:
+    structures-     Structures, e.g. all the valid structures.
+    inputs-         Graph inputs to MEGNet of the structures, e.g. the
+                    inputs used for the extraction of activations.
+
+    Outputs:
+    1-              Dictionary of the graph inputs keyed by
+                    structure_key, as the graph cache.
+    """
+    return {structure_key(s): g for s, g in zip(structures, inputs)}
+
+
+def lookup_inputs(structures, targets, graphs, graph_converter):
+    """
+    lookup_inputs(structures, targets, graphs, graph_converter)
+
+    Inputs:
+    structures-         Structures of the set.
+    targets-            Targets of the set.
+    graphs-             Graph inputs keyed by structure_key. Structures
+                        missing from graphs are converted.
+    graph_converter-    The graph converter of the structures.
+
+    Outputs:
+    1-                  Graph inputs of the structures which could be
+                        converted.
+    2-                  Their targets.
+    3-                  Positions of these structures in the set.
+    """
+    inputs = [ ]
+    keep = [ ]
+    for k, structure in enumerate(structures):
+        graph = graphs.get(structure_key(structure))
+        if graph is None:
+            graph = graph_input(structure, graph_converter)
+        if graph is None:
+            print("Skipping structure with isolated atom ...")
+            continue
+        inputs.append(graph)
+        keep.append(k)
+    keep = np.array(keep, dtype=int)
+    return inputs, np.asarray(targets)[keep], keep
+
+
+def batch_indices(natoms, batch, max_atoms=0, rng=None):
+    """
+    batch_indices(natoms, batch, max_atoms, rng)
+
+    Inputs:
+    natoms-         Number of atoms of each structure.
+    batch-          Maximum number of structures per batch.
+    max_atoms-      Maximum total number of atoms per batch. The 
+                    structures are sorted by size and packed greedily,
+                    and a structure larger than the cap forms a batch 
+                    of its own. 0 => batches of batch structures in
+                    the order of the structures.
+    rng-            Random generator shuffling the structures and the 
+                    order of the batches. None => no shuffling.
+
+    Outputs:
+    1-              List of the indices of the structures of each batch.
+    """
+    natoms = np.asarray(natoms)
+    order = np.arange(len(natoms)) if rng is None else rng.permutation(len(natoms))
+    if max_atoms <= 0:
+        return [order[start:start+batch] for start in range(0, len(order), batch)]
+
+    # A stable sort keeps the shuffled order between structures of equal size
+    order = order[np.argsort(natoms[order], kind="stable")]
+    batches = [ ]
+    start = 0
+    total = 0
+    for k, i in enumerate(order):
+        if k > start and (k - start == batch or total + natoms[i] > max_atoms):
+            batches.append(order[start:k])
+            start = k
+            total = 0
+        total += natoms[i]
+    batches.append(order[start:])
+    if rng is not None:
+        batches = [batches[b] for b in rng.permutation(len(batches))]
+    return batches
+
+
+def assemble(inputs, targets=None, weights=None):
+    """
+    assemble(inputs, targets, weights)
+
+    Assembles the graph inputs of single structures into the inputs of
+    one MEGNet batch, offsetting the bond indices of each graph by the
+    atoms of the graphs before it.
+
+    Inputs:
+    inputs-         Graph inputs of the structures of the batch, each
+                    [atom, bond, state, index1, index2, gnode, gbond].
+    targets-        Targets of shape (structures, ntarget). None =>
+                    inputs only, e.g. for extraction of activations.
+    weights-        Sample weights. None => unweighted.
+
+    Outputs:
+    1-              Flat list of the batch inputs, the targets and, if
+                    weighted, the sample weights.
+    """
+    natoms = [g[0].shape[1] for g in inputs]
+    nbonds = [g[1].shape[1] for g in inputs]
+    offsets = np.cumsum([0] + natoms[:-1])
+    batch = [np.concatenate([g[0] for g in inputs], axis=1),
+             np.concatenate([g[1] for g in inputs], axis=1),
+             np.concatenate([g[2] for g in inputs], axis=1),
+             np.concatenate([g[3] + o for g, o in zip(inputs, offsets)], axis=1).astype(np.int32),
+             np.concatenate([g[4] + o for g, o in zip(inputs, offsets)], axis=1).astype(np.int32),
+             np.repeat(np.arange(len(inputs), dtype=np.int32), natoms)[None, :],
+             np.repeat(np.arange(len(inputs), dtype=np.int32), nbonds)[None, :]]
+    if targets is not None:
+        batch.append(np.asarray(targets, dtype=np.float32)[None, ...])
+    if weights is not None:
+        batch.append(np.asarray(weights, dtype=np.float32)[None, :])
+    return batch
+
+
+def graph_dataset(inputs, targets, batch, weights=None, shuffle=True, seed=0, max_atoms=0):
+    """
+    graph_dataset(inputs, targets, batch, weights, shuffle, seed, max_atoms)
+
+    Endless tf.data pipeline of MEGNet batches. The indices of the 
+    batches of each epoch are drawn by batch_indices, and the batches
+    are assembled by parallel map calls and prefetched.
+
+    Inputs:
+    inputs-         Graph inputs of the structures.
+    targets-        Targets of shape (structures, ntarget).
+    batch-          Batch size.
+    weights-        Sample weights. None => unweighted.
+    shuffle-        Shuffle the structures every epoch.
+    seed-           Seed of the shuffling.
+    max_atoms-      Maximum total number of atoms per batch. 0 => no
+                    cap.
+
+    Outputs:
+    1-              The dataset.
+    2-              Number of batches per epoch.
+    """
+    targets = np.asarray(targets).reshape(len(inputs), -1)
+
+    def assemble_batch(idx):
+        return assemble([inputs[i] for i in idx], targets[idx],
+                        None if weights is None else weights[idx])
+
+    natoms = [g[0].shape[1] for g in inputs]
+    steps = len(batch_indices(natoms, batch, max_atoms))
+    rng = np.random.RandomState(seed) if shuffle else None
+
+    def epochs():
+        while True:
+            for idx in batch_indices(natoms, batch, max_atoms, rng):
+                yield idx
+
+    example = assemble_batch(batch_indices(natoms, batch, max_atoms)[0])
+    dtypes = [tf.as_dtype(a.dtype) for a in example]
+
+    def load(idx):
+        flat = tf.numpy_function(assemble_batch, [idx], dtypes)
+        # The numbers of structures, atoms and bonds vary between batches
+        for tensor, array in zip(flat, example):
+            tensor.set_shape([None, None, array.shape[-1]] if array.ndim == 3
+                             else [None] * array.ndim)
+        if weights is None:
+            return tuple(flat[:7]), flat[7]
+        return tuple(flat[:7]), flat[7], flat[8]
+
+    # Only the indices are drawn on the Python thread
+    dataset = tf.data.Dataset.from_generator(epochs, tf.int64, tf.TensorShape([None]))
+    dataset = dataset.map(load, num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE), steps
+
+
+def train_from_inputs(model, graphs, Xtrain, ytrain, Xval, yval, epochs, batch,
+                      sample_weights=None, prev_model=None, callbacks=None, max_atoms=0):
+    """
+    train_from_inputs(model, graphs, Xtrain, ytrain, Xval, yval, epochs, batch,
+                      sample_weights, prev_model, callbacks, max_atoms)
+
+    Counterpart of MEGNetModel.train fed by the tf.data pipeline.
+
+    Inputs:
+    model-              MEGNet model.
+    graphs-             Pre-converted graph inputs keyed by structure_key.
+    Xtrain-             Structures for training.
+    ytrain-             Targets for training.
+    Xval-               Structures for validation.
+    yval-               Targets for validation.
+    epochs-             Number of training iterations.
+    batch-              Batch size.
+    sample_weights-     Weights of the training structures. None =>
+                        unweighted.
+    prev_model-         File of the weights training starts from. None
+                        => the current weights.
+    callbacks-          Keras callbacks.
+    max_atoms-          Maximum total number of atoms per batch. 0 => 
+                        no cap.
+    """
+    train_inputs, ytrain, keep = lookup_inputs(Xtrain, ytrain, graphs, model.graph_converter)
+    val_inputs, yval, _ = lookup_inputs(Xval, yval, graphs, model.graph_converter)
+    print("Training on %s structures from pre-converted graphs ..." %len(train_inputs))
+    if sample_weights is not None:
+        sample_weights = np.asarray(sample_weights)[keep]
+
+    # Targets are scaled per structure as in MEGNetModel.train
+    ytrain = np.array([model.target_scaler.transform(t, g[0].shape[1])
+                       for t, g in zip(ytrain, train_inputs)])
+    yval = np.array([model.target_scaler.transform(t, g[0].shape[1])
+                     for t, g in zip(yval, val_inputs)])
+
+    if prev_model:
+        model.load_weights(prev_model)
+    train_data, train_steps = graph_dataset(train_inputs, ytrain, batch, sample_weights,
+                                            max_atoms=max_atoms)
+    val_data, val_steps = graph_dataset(val_inputs, yval, batch, shuffle=False,
+                                        max_atoms=max_atoms)
+    model.fit(train_data, steps_per_epoch=train_steps, epochs=epochs,
+              validation_data=val_data, validation_steps=val_steps, callbacks=callbacks)